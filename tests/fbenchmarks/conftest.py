@@ -0,0 +1,41 @@
+import pytest
+
+from tools.xi_fbenchmark_results import XiBenchmarkResults
+
+_results = XiBenchmarkResults()
+_regressions = []
+
+
+def pytest_addoption(parser):
+    parser.addoption("--xi-bench-json", default="xi_fbenchmark_results.json",
+                     help="file to write the benchmark results to")
+    parser.addoption("--xi-bench-baseline", default=None,
+                     help="benchmark results of an earlier run to compare to")
+    parser.addoption("--xi-bench-threshold", type=float, default=0.1,
+                     help="largest accepted regression, a fraction of the baseline value")
+
+
+@pytest.fixture(scope="session")
+def bench_results():
+    return _results
+
+
+def pytest_sessionfinish(session, exitstatus):
+    config = session.config
+    _results.save(config.getoption("--xi-bench-json"))
+
+    baseline_path = config.getoption("--xi-bench-baseline")
+    if baseline_path is None:
+        return
+
+    threshold = config.getoption("--xi-bench-threshold")
+    _regressions.extend(_results.regressions(XiBenchmarkResults.load(baseline_path), threshold))
+    if _regressions:
+        session.exitstatus = 1
+
+
+def pytest_terminal_summary(terminalreporter):
+    if _regressions:
+        terminalreporter.section("benchmark regressions")
+    for name, baseline_value, value, change in _regressions:
+        terminalreporter.write_line("%s: %g -> %g (%+.1f%%)" % (name, baseline_value, value, change * 100))
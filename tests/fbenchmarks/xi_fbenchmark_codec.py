@@ -0,0 +1,48 @@
+import pytest
+
+from tools.xi_fbenchmark_results import operations_per_second
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec, MQTT_DECODER_CHUNK_SIZE
+from tools.xi_mock_broker.mqtt_messages import MQTT_ERR_SUCCESS, MQTT_LOG_ERR
+
+# Packets per call of the measured functions
+BATCH = 100
+
+
+def new_codec(on_packet_encoded=None, on_packet_decoded=None):
+    codec = MQTTCodec(None, None, MQTT_DECODER_CHUNK_SIZE)
+    codec.log_level_set(MQTT_LOG_ERR)
+    codec.on_packet_encoded = on_packet_encoded
+    codec.on_packet_decoded = on_packet_decoded
+    return codec
+
+
+@pytest.mark.parametrize("qos", [0, 1, 2])
+@pytest.mark.parametrize("payload_size", [16, 1024, 65536])
+def test_codec_encodePublish(bench_results, qos, payload_size):
+    packets = []
+    codec = new_codec(on_packet_encoded=lambda command, packet, mid, qos: packets.append(packet) or MQTT_ERR_SUCCESS)
+    payload = bytearray(payload_size)
+
+    def encode():
+        for mid in range(1, BATCH + 1):
+            codec.encode_publish(mid, "xi/blue/v1/benchmark", payload, qos)
+        del packets[:]
+
+    bench_results.record("codec/encode_publish_qos%d_%dB" % (qos, payload_size),
+                         operations_per_second(encode, BATCH), "packet/s")
+
+
+@pytest.mark.parametrize("qos", [0, 1, 2])
+@pytest.mark.parametrize("payload_size", [16, 1024, 65536])
+def test_codec_decodePublish(bench_results, qos, payload_size):
+    data = b"".join(MQTTCodec.pack_publish(mid, "xi/blue/v1/benchmark", bytearray(payload_size), qos)
+                    for mid in range(1, BATCH + 1))
+    decoded = []
+    codec = new_codec(on_packet_decoded=lambda in_packet: decoded.append(in_packet.command) or MQTT_ERR_SUCCESS)
+
+    def decode():
+        codec.decode_data(data)
+
+    bench_results.record("codec/decode_publish_qos%d_%dB" % (qos, payload_size),
+                         operations_per_second(decode, BATCH), "packet/s")
+    assert len(decoded) % BATCH == 0
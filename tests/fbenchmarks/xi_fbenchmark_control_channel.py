@@ -0,0 +1,63 @@
+import pytest
+
+import tools.xi_control_channel_protocol_pb2 as xi_ccp
+from tools.xi_control_channel_codec_protobuf_runner import XiControlChannel_codec_protobuf_runner
+from tools.xi_control_channel_framing import frame, XiControlChannelDeframer
+from tools.xi_fbenchmark_results import operations_per_second
+
+# Messages per call of the measured functions
+BATCH = 20
+
+
+class ControlChannelLoopback(object):
+    """Stands in for the transport and the driver: the API calls sent by the runner codec are decoded the way
+    the driver does and answered with an on_message_received callback of the same payload."""
+
+    def __init__(self, length_delimited):
+        self.runner = None
+        self.deframer = XiControlChannelDeframer() if length_delimited else None
+
+    def send(self, data):
+        if self.deframer is not None:
+            self.deframer.feed(data)
+            data = next(self.deframer.messages())
+        api_call = xi_ccp.XiClientAPI()
+        api_call.ParseFromString(data)
+
+        callback = xi_ccp.XiClientCallback()
+        callback.on_message_received.topic_name = api_call.publish_binary.publish_common_data.topic_name
+        callback.on_message_received.qos = api_call.publish_binary.publish_common_data.qos
+        callback.on_message_received.payload = api_call.publish_binary.payload
+        data = callback.SerializeToString()
+        self.runner.handle_message(frame(data) if self.deframer is not None else data)
+
+
+class CallbackCounter(object):
+
+    def __init__(self):
+        self.messages = 0
+
+    def on_message_received(self, topic, message):
+        self.messages += 1
+
+
+@pytest.mark.parametrize("length_delimited", [False, True])
+@pytest.mark.parametrize("payload_size", [16, 1024])
+def test_controlChannel_publishRoundTrip(bench_results, capsys, payload_size, length_delimited):
+    # Only on_message_received is called back, it has no error code to map
+    runner = XiControlChannel_codec_protobuf_runner(lambda error_code: error_code, length_delimited)
+    runner.control_channel = ControlChannelLoopback(length_delimited)
+    runner.control_channel.runner = runner
+    runner.xi_callback_sink = CallbackCounter()
+    payload = bytearray(payload_size)
+
+    def round_trip():
+        for i in range(BATCH):
+            runner.publish_binary("xi/blue/v1/benchmark", payload, 1, False)
+        # The codecs log every message
+        capsys.readouterr()
+
+    bench_results.record("control_channel/publish_round_trip_%dB%s" % (payload_size,
+                                                                         "_framed" if length_delimited else ""),
+                         operations_per_second(round_trip, BATCH), "msg/s")
+    assert runner.xi_callback_sink.messages > 0
@@ -0,0 +1,116 @@
+import pytest
+
+from tools.xi_ftest_fixture import xift
+from tools.xi_ftest_fixture import sut_platform
+from tools.xi_ftest_fixture import TestEssentials
+from tools.xi_ftest_fixture import act
+
+from tools.xi_mock_broker import mqtt_messages
+
+import time
+
+# Messages per benchmark, they must fit into the 5 seconds of act()
+MESSAGES = 50
+
+# "tcp" connects without TLS, WebSocket is chosen by the socket type of the platform under test
+TRANSPORTS = ["tcp", "tls"]
+
+
+def platform_label(sut_platform):
+    return "%s_%s" % (sut_platform["platform"].name, sut_platform["socket_type"].name)
+
+
+def record_round_trips(bench_results, name, start, end, latencies):
+    latencies = sorted(latencies)
+    bench_results.record(name + "/throughput", len(latencies) / (end - start), "msg/s")
+    bench_results.record(name + "/p50_latency", latencies[len(latencies) // 2] * 1e3, "ms", False)
+    bench_results.record(name + "/p99_latency", latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1e3,
+                         "ms", False)
+
+
+def accept_connection_and_subscriptions(xift):
+    xift.broker.on_client_connect.side_effect = lambda userdata, connect_options: \
+        xift.broker.send_connack(mqtt_messages.CONNACK_ACCEPTED)
+
+    xift.broker.on_client_subscribe.side_effect = lambda userdata, msg_id, topics_and_qos, dup: \
+        xift.broker.send_suback(msg_id, topics_and_qos)
+
+    xift.broker.on_client_disconnect.side_effect = lambda *args: \
+        xift.broker.trigger_shutdown()
+
+    xift.client_sut.on_disconnect.side_effect = lambda result: \
+        xift.client_sut.stop()
+
+
+@pytest.mark.parametrize("transport", TRANSPORTS)
+@pytest.mark.parametrize("qos", [0, 1, 2])
+def test_roundTrip_brokerPublishes_clientReceivesAll(xift, sut_platform, bench_results, transport, qos):
+    """
+        Broker to client delivery: the time from broker.publish() to the on_message_received callback
+        of the client, which arrives through the control channel.
+    """
+    publish_times = []
+    latencies = []
+    end_time = []
+
+    accept_connection_and_subscriptions(xift)
+
+    xift.client_sut.on_connect_finish.side_effect = lambda connect_response: \
+        xift.client_sut.subscribe([[TestEssentials.topic, qos]])
+
+    def on_subscribe_finish(granted_access_list):
+        for i in range(MESSAGES):
+            publish_times.append(time.perf_counter())
+            xift.broker.publish(TestEssentials.topic, "%d" % i, qos)
+
+    def on_message_received(topic, message):
+        latencies.append(time.perf_counter() - publish_times[int(message.payload)])
+        if len(latencies) == MESSAGES:
+            end_time.append(time.perf_counter())
+            xift.client_sut.disconnect()
+
+    xift.client_sut.on_subscribe_finish.side_effect = on_subscribe_finish
+    xift.client_sut.on_message_received.side_effect = on_message_received
+
+    act(xift, setup_default_cert=(transport == "tls"))
+
+    assert len(latencies) == MESSAGES
+    record_round_trips(bench_results, "%s/%s/broker_to_client_qos%d" % (platform_label(sut_platform), transport, qos),
+                       publish_times[0], end_time[0], latencies)
+
+
+@pytest.mark.parametrize("transport", TRANSPORTS)
+@pytest.mark.parametrize("qos", [0, 1, 2])
+def test_roundTrip_clientPublishes_allPublishesFinished(xift, sut_platform, bench_results, transport, qos):
+    """
+        Client to broker delivery: the time from the publish API call of the client to its
+        on_publish_finish callback. The broker acknowledges the messages as they arrive.
+    """
+    publish_times = []
+    latencies = []
+    end_time = []
+
+    accept_connection_and_subscriptions(xift)
+    xift.broker.auto_ack_set(True)
+    xift.broker.on_message.side_effect = None
+
+    def on_connect_finish(connect_response):
+        for i in range(MESSAGES):
+            publish_times.append(time.perf_counter())
+            xift.client_sut.publish_string(TestEssentials.topic, "%d" % i, qos)
+
+    def on_publish_finish(return_code):
+        # The publishes finish in order
+        latencies.append(time.perf_counter() - publish_times[len(latencies)])
+        if len(latencies) == MESSAGES:
+            end_time.append(time.perf_counter())
+            xift.client_sut.disconnect()
+
+    xift.client_sut.on_connect_finish.side_effect = on_connect_finish
+    xift.client_sut.on_publish_finish.side_effect = on_publish_finish
+
+    act(xift, setup_default_cert=(transport == "tls"))
+
+    assert len(latencies) == MESSAGES
+    record_round_trips(bench_results, "%s/%s/client_to_broker_qos%d" % (platform_label(sut_platform), transport, qos),
+                       publish_times[0], end_time[0], latencies)
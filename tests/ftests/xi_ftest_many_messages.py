@@ -61,9 +61,10 @@ def test_publish_many_messages_in_one_buffer(xift, publish_parameters_setup ):
     messages_received = []
 
     def on_subscribe_finish( result_queue ):
-        for i in range(0, messages_to_send):
-            xift.broker.publish(TestEssentials.topic
-                , gen_message_payload(publish_parameters_setup.mqtt_msg_payload_size_min_max))
+        # the messages are written with a single send, glued together
+        xift.broker.publish_many([ ( TestEssentials.topic
+                , gen_message_payload(publish_parameters_setup.mqtt_msg_payload_size_min_max) )
+                for i in range(0, messages_to_send) ])
 
     def on_message_received( topic, message ):
         global messages_to_receive
@@ -14,12 +14,13 @@ def __xi_driver_init(argv):
     #print('Argument List:', str(argv))
 
     try:
-        opts, args = getopt.getopt(argv[1:],"h:p:w")
+        opts, args = getopt.getopt(argv[1:],"h:p:wl")
     except getopt.GetoptError:
         print('error during command line parsing')
         sys.exit(2)
 
     is_websocket = False
+    length_delimited = False
 
     for opt, arg in opts:
         if opt == '-h':
@@ -31,13 +32,16 @@ def __xi_driver_init(argv):
         elif opt == '-w':
             #print("websocket")
             is_websocket = True
+        elif opt == '-l':
+            # control channel messages framed with their length
+            length_delimited = True
 
-    return host, port, is_websocket
+    return host, port, is_websocket, length_delimited
 
 
 if __name__ == '__main__':
 
-    cc_host, cc_port, xi_is_websocket = __xi_driver_init(sys.argv)
+    cc_host, cc_port, xi_is_websocket, cc_length_delimited = __xi_driver_init(sys.argv)
 
     # transport <--> codec <--> xi_client
 
@@ -47,7 +51,8 @@ if __name__ == '__main__':
 
     xi_client = XivelyClient()
 
-    control_channel_codec = XiControlChannel_codec_protobuf_driver(xi_client, xi_client_connection_params)
+    control_channel_codec = XiControlChannel_codec_protobuf_driver(xi_client, xi_client_connection_params,
+                                                                   cc_length_delimited)
     control_channel_transport = XiControlChannel_transp_socket(control_channel_codec)
 
     xi_client.on_connect_finished = control_channel_codec.on_connect_finish
@@ -15,10 +15,11 @@ def get_platform_folder():
 
     return ""
 
-def generate_command_line_arguments(host, port, is_websocket=False):
-    return "-h " + host + " -p " + str(port) + (" -w" if is_websocket else "")
+def generate_command_line_arguments(host, port, is_websocket=False, length_delimited=False):
+    return "-h " + host + " -p " + str(port) + (" -w" if is_websocket else "") + (" -l" if length_delimited else "")
 
 class XiClientDriverStarter_C:
+    length_delimited = False
 
     def start_driver(self, host, port):
         commandline_start = ("../../../xively-client-c/bin/" + get_platform_folder() + "/tests/tools/xi_libxively_driver " + generate_command_line_arguments(host, port)).split()
@@ -39,6 +40,9 @@ class XiClientDriverStarter_C:
 
 
 class XiClientDriverStarter_py:
+    # the python driver frames the control channel messages with their length
+    length_delimited = True
+
     def __init__(self, python_platform, mqtt_connect_through_websocket):
         self._mqtt_connect_through_websocket = mqtt_connect_through_websocket
         xi_platform_interpreter_map = {
@@ -49,7 +53,7 @@ class XiClientDriverStarter_py:
 
     def start_driver(self, host, port):
         #print("*** py interpreter = " + self._py_interpreter)
-        commandline_start = (self._py_interpreter + " ../tools/xi_client_driver_python.py " + generate_command_line_arguments(host, port, self._mqtt_connect_through_websocket)).split()
+        commandline_start = (self._py_interpreter + " ../tools/xi_client_driver_python.py " + generate_command_line_arguments(host, port, self._mqtt_connect_through_websocket, self.length_delimited)).split()
         self._client_process = subprocess.Popen( commandline_start )
 
     def prepare_environment(self, ca_cert_file):
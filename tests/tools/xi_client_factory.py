@@ -20,7 +20,8 @@ from xiPy.xively_error_codes import XivelyErrorCodes as xec
 class XiClientFactory:
     @staticmethod
     def __instantiate_xi_client_runner(function_error_code_map, driver_starter, is_transport_socket):
-        control_channel_codec = XiControlChannel_codec_protobuf_runner(function_error_code_map)
+        control_channel_codec = XiControlChannel_codec_protobuf_runner(function_error_code_map,
+                                                                       driver_starter.length_delimited)
         control_channel_transport = XiControlChannel_transp_socket(control_channel_codec)
 
         client_runner = xi_client_runner.XiClientRunner(
@@ -1,13 +1,18 @@
 import tools.xi_control_channel_protocol_pb2 as xi_ccp
 from tools.xi_mock_broker import mqtt_messages
+from tools.xi_control_channel_framing import frame, XiControlChannelDeframer
 import google.protobuf as protobuf
 import threading
 
 class XiControlChannel_codec_protobuf_runner:
 
-    def __init__(self, function_map_error_codes):
+    def __init__(self, function_map_error_codes, length_delimited=False):
         self._data_accumulator = bytes()
+        # the driver frames the messages with their length, see xi_control_channel_framing
+        self._deframer = XiControlChannelDeframer() if length_delimited else None
         self._function_map_error_codes = function_map_error_codes
+        # optional PacketTracer of the mock broker, marks the arrival of the callbacks
+        self.packet_tracer = None
 
     def connect(self, server_address, connect_options, connection_timeout):
 
@@ -32,7 +37,7 @@ class XiControlChannel_codec_protobuf_runner:
         self.__log("sending connect API call = " + message_API_call.__str__() +
             ", message size in bytes = " + str(message_API_call.ByteSize()))
 
-        self.control_channel.send(message_API_call.SerializeToString())
+        self.__send(message_API_call)
 
     def disconnect(self):
         self.__log("disconnect requested by test FW")
@@ -43,7 +48,7 @@ class XiControlChannel_codec_protobuf_runner:
 
         self.__log("sending api call = " + message_API_call.__str__())
 
-        self.control_channel.send(message_API_call.SerializeToString())
+        self.__send(message_API_call)
 
     def subscribe(self, topic_and_qos_list):
         self.__log("subscribe requested by test FW: " + str(topic_and_qos_list))
@@ -55,7 +60,7 @@ class XiControlChannel_codec_protobuf_runner:
             message_topic_and_qos.topic_name = topic_and_qos[0]
             message_topic_and_qos.qos = topic_and_qos[1]
 
-        self.control_channel.send(message_API_call.SerializeToString())
+        self.__send(message_API_call)
 
     def publish_string(self, topic, message, qos, retain):
         self.__log("publish_string requested by test FW: " + topic + ", payload = " + str(message ) )
@@ -67,7 +72,7 @@ class XiControlChannel_codec_protobuf_runner:
         message_API_call.publish_string.publish_common_data.qos = qos
         message_API_call.publish_string.retain = retain
 
-        self.control_channel.send(message_API_call.SerializeToString())
+        self.__send(message_API_call)
 
     def publish_binary(self, topic, message, qos, retain):
         self.__log("publish_binary requested by test FW: " + topic + ", payload = " + str(message ) )
@@ -79,7 +84,7 @@ class XiControlChannel_codec_protobuf_runner:
         message_API_call.publish_binary.publish_common_data.qos = qos
         message_API_call.publish_binary.retain = retain
 
-        self.control_channel.send(message_API_call.SerializeToString())
+        self.__send(message_API_call)
 
     def setup_tls(self, ca_cert_file):
         self.__log("setup_tls requested by test FW: " + ca_cert_file )
@@ -87,13 +92,21 @@ class XiControlChannel_codec_protobuf_runner:
         message_FTFW_control = xi_ccp.XiClientAPI()
         message_FTFW_control.setup_tls.ca_cert_file = ca_cert_file
 
-        self.control_channel.send(message_FTFW_control.SerializeToString())
+        self.__send(message_FTFW_control)
 
     def handle_message(self, data):
         # protobuf decode
 
         self.__log( "data - " + str( data ) )
 
+        if self._deframer is not None:
+            self._deframer.feed(data)
+            for message in self._deframer.messages():
+                xi_client_callback = xi_ccp.XiClientCallback()
+                xi_client_callback.ParseFromString(message)
+                self.__handle_callback(xi_client_callback)
+            return
+
         self._data_accumulator = b"".join( [ self._data_accumulator, data ] )
 
         while self._data_accumulator:
@@ -116,35 +129,46 @@ class XiControlChannel_codec_protobuf_runner:
             # cut parsed prefix, process remaining part in next iteration
             self._data_accumulator = self._data_accumulator[xi_client_callback.ByteSize():]
 
-            self.__log("decoded incoming data:\n" + xi_client_callback.__str__())
-
-            # map message to API call
-            if (xi_client_callback.HasField('on_connect_finish')):
-                self.__log("arrived message: on_connect_finish")
-                self.xi_callback_sink.on_connect_finish(
-                    self._function_map_error_codes(xi_client_callback.on_connect_finish.connect_result)
-                    if xi_client_callback.on_connect_finish.connect_result
-                    else 0)
-
-            if (xi_client_callback.HasField('on_disconnect')):
-                self.__log("arrived message: on_disconnect")
-                self.xi_callback_sink.on_disconnect(
-                    self._function_map_error_codes(xi_client_callback.on_disconnect.error_code)
-                    if xi_client_callback.on_disconnect.error_code
-                    else 0)
-
-            if (xi_client_callback.HasField('on_subscribe_finish')):
-                self.xi_callback_sink.on_subscribe_finish(xi_client_callback.on_subscribe_finish.subscribe_result_list)
-
-            if (xi_client_callback.HasField('on_message_received')):
-                message = mqtt_messages.MQTTMessage()
-                message.topic = xi_client_callback.on_message_received.topic_name
-                message.qos = xi_client_callback.on_message_received.qos
-                message.payload = xi_client_callback.on_message_received.payload
-                self.xi_callback_sink.on_message_received(xi_client_callback.on_message_received.topic_name, message)
-
-            if (xi_client_callback.HasField('on_publish_finish')):
-                self.xi_callback_sink.on_publish_finish(xi_client_callback.on_publish_finish.return_code)
+            self.__handle_callback(xi_client_callback)
+
+    def __handle_callback(self, xi_client_callback):
+        self.__log("decoded incoming data:\n" + xi_client_callback.__str__())
+
+        if self.packet_tracer is not None:
+            self.packet_tracer.mark(",".join(field.name for field, value in xi_client_callback.ListFields()),
+                                    "control channel")
+
+        # map message to API call
+        if (xi_client_callback.HasField('on_connect_finish')):
+            self.__log("arrived message: on_connect_finish")
+            self.xi_callback_sink.on_connect_finish(
+                self._function_map_error_codes(xi_client_callback.on_connect_finish.connect_result)
+                if xi_client_callback.on_connect_finish.connect_result
+                else 0)
+
+        if (xi_client_callback.HasField('on_disconnect')):
+            self.__log("arrived message: on_disconnect")
+            self.xi_callback_sink.on_disconnect(
+                self._function_map_error_codes(xi_client_callback.on_disconnect.error_code)
+                if xi_client_callback.on_disconnect.error_code
+                else 0)
+
+        if (xi_client_callback.HasField('on_subscribe_finish')):
+            self.xi_callback_sink.on_subscribe_finish(xi_client_callback.on_subscribe_finish.subscribe_result_list)
+
+        if (xi_client_callback.HasField('on_message_received')):
+            message = mqtt_messages.MQTTMessage()
+            message.topic = xi_client_callback.on_message_received.topic_name
+            message.qos = xi_client_callback.on_message_received.qos
+            message.payload = xi_client_callback.on_message_received.payload
+            self.xi_callback_sink.on_message_received(xi_client_callback.on_message_received.topic_name, message)
+
+        if (xi_client_callback.HasField('on_publish_finish')):
+            self.xi_callback_sink.on_publish_finish(xi_client_callback.on_publish_finish.return_code)
+
+    def __send(self, message):
+        data = message.SerializeToString()
+        self.control_channel.send(frame(data) if self._deframer is not None else data)
 
     def __getLogPrefix(self):
         return "[ PR  proto  ] [" + threading.current_thread().getName() + "]: "
@@ -0,0 +1,66 @@
+"""
+Length-delimited framing of the control channel messages, shared by the runner and the driver codecs.
+
+Every message is preceded by its length as a base 128 varint, the same way as protobuf's
+writeDelimitedTo/parseDelimitedFrom, so the receiver finds the message boundaries without parsing.
+"""
+
+# A 64 bit varint is at most 10 bytes long
+VARINT_MAX_BYTES = 10
+
+
+def varint_encode(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def frame(message):
+    """Return message, the serialized bytes of a protobuf message, with its length prepended."""
+    return varint_encode(len(message)) + message
+
+
+class XiControlChannelDeframer:
+    """Splits the data arriving on the control channel into the framed messages. Data is appended by feed(),
+    messages() yields the complete messages and keeps the rest until the next feed(). Each byte is looked
+    at once, however the data is split into chunks."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0
+
+    def feed(self, data):
+        if self._start > 0:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+    def messages(self):
+        buffer = self._buffer
+        while True:
+            length = 0
+            shift = 0
+            pos = self._start
+            while True:
+                if pos == len(buffer):
+                    return
+                byte = buffer[pos]
+                pos += 1
+                length |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    break
+                shift += 7
+                if pos - self._start == VARINT_MAX_BYTES:
+                    raise ValueError("Invalid length prefix on the control channel.")
+
+            if len(buffer) - pos < length:
+                return
+            self._start = pos + length
+            yield bytes(buffer[pos:self._start])
+
+    def pending(self):
+        """The number of bytes received but not yet returned as a message."""
+        return len(self._buffer) - self._start
@@ -1,36 +1,51 @@
+import errno
+import logging
+import select
 import socket
 import threading
 from threading import Thread
 
-import sys
-if sys.version_info[0] < 3:
-    import Queue as queue
-else:
-    import queue as queue
+# Bytes read from the control channel at once
+READ_CHUNK_SIZE = 65536
 
 class XiControlChannel_transp_socket:
+    """Socket transport of the control channel. A thread waits in select() for incoming data, for room to
+    write the queued data and for the wakeup of send() calls made by other threads, so messages go out and
+    are handed to message_sink.handle_message() without polling delays. Only the log messages at or above
+    log_level (one of the logging module levels) are printed, DEBUG shows every chunk of data."""
 
-    def __init__(self, message_sink):
+    def __init__(self, message_sink, log_level=logging.INFO):
         self.__xi_message_sink = message_sink
-        self._send_data_queue = queue.Queue()
+        self.__log_prefix = ""
+        self.__log_level = log_level
+        self.__send_buffer = bytearray()
+        self.__send_lock = threading.Lock()
         self.__socket = None
         self.__socket_thread = None
+        self._listen_on_socket = False
+        # created with the socket thread, which closes them
+        self.__wakeup_receiver = None
+        self.__wakeup_sender = None
+        # set while the socket thread does not take data to send
+        self.__send_closed = True
 
     def __del__(self):
-        self._listen_on_socket = False
-        if (self.__socket):
-            self.__socket.close()
+        self.stop()
+        if (self.__socket_thread):
             self.__socket_thread.join()
 
+    def log_level_set(self, log_level):
+        self.__log_level = log_level
+
     def stop(self):
+        # the thread sends the queued data, then closes the socket
         self._listen_on_socket = False
-        if (self.__socket):
-            self.__socket.close()
+        self.__wake()
 
     def join(self, timeout):
         if (self.__socket_thread):
             self.__socket_thread.join(timeout)
-            return not self.__socket_thread.isAlive()
+            return not self.__socket_thread.is_alive()
         return True
 
     # server behaviour
@@ -47,83 +62,133 @@ class XiControlChannel_transp_socket:
 
     def wait_for_connection(self):
         self.__log_prefix = "PR "
-        self.__log("Control channel listening on " + str(self._listensock.getsockname()))
+        self.__log(logging.INFO, "Control channel listening on %s", self._listensock.getsockname())
 
         try:
             self.__socket, address = self._listensock.accept()
         except socket.timeout:
-            self.__log("ERROR: timeout: Xively Client did not connect to control channel in time")
+            self.__log(logging.ERROR, "ERROR: timeout: Xively Client did not connect to control channel in time")
             raise
 
         #self._socket_control_channel.setblocking(0)
         self._listensock.close()
-        self.__log("Control channel accepted connection: " + str(self.__socket.getsockname()))
+        self.__log(logging.INFO, "Control channel accepted connection: %s", self.__socket.getsockname())
 
-        self._listen_on_socket = True
-        self.__socket_thread = Thread(target = self.__socket_thread_function)
-        self.__socket_thread.start()
+        self.__socket_thread_start()
 
     # client behaviour
     def connect(self, host, port):
         self.__log_prefix = "PD "
-        self.__log("connecting to " + host + ":" + str(port))
+        self.__log(logging.INFO, "connecting to %s:%s", host, port)
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_IP)
         self.__socket.connect((host, port))
 
+        self.__socket_thread_start()
+
+    def send(self, data):
+        """Queue data to be written by the socket thread, thread safe. Returns False without queuing the data
+        if the socket thread is not running."""
+        with self.__send_lock:
+            if self.__send_closed:
+                self.__log(logging.ERROR, "ERROR: control channel is closed, dropping %d bytes", len(data))
+                return False
+            was_empty = not self.__send_buffer
+            self.__send_buffer += data
+        if was_empty and threading.current_thread() is not self.__socket_thread:
+            self.__wake()
+        return True
+
+    def __socket_thread_start(self):
+        self.__wakeup_receiver, self.__wakeup_sender = socket.socketpair()
+        self.__send_closed = False
         self._listen_on_socket = True
         self.__socket_thread = Thread(target = self.__socket_thread_function)
         self.__socket_thread.start()
 
-    def send(self, data):
-        # thread safe functionality is turned off for now, seems no need for that currently
-        if (True or threading.get_ident() == self.__socket_thread.ident):
-            self.__socket.sendall(data)
-        else:
-            self.__log("queuing send")
-            self._send_data_queue.put(data)
+    def __wake(self):
+        try:
+            if self.__wakeup_sender is not None:
+                self.__wakeup_sender.send(b"0")
+        except socket.error:
+            pass
+
+    def __flush(self):
+        # returns False if the socket is closed
+        with self.__send_lock:
+            while self.__send_buffer:
+                try:
+                    sent = self.__socket.send(self.__send_buffer)
+                except socket.error as err:
+                    if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return True
+                    self.__log(logging.ERROR, "Exception during sending data on control channel: %s", err)
+                    return False
+                if self.__log_enabled(logging.DEBUG):
+                    self.__log(logging.DEBUG, "Data sent on control channel: %s", bytes(self.__send_buffer[:sent]))
+                del self.__send_buffer[:sent]
+        return True
 
     def __socket_thread_function(self):
-        self.__log("Control channel endpoint thread started: " + threading.current_thread().getName())
+        self.__log(logging.INFO, "Control channel endpoint thread started: %s", threading.current_thread().name)
 
-        # if threadsafety turned on use non-blocking socket not to make listening block the sending
-        self.__socket.setblocking(1)
-        self.__socket.settimeout(0.1)
+        self.__socket.setblocking(0)
 
         while self._listen_on_socket:
-            try:
-                self.__socket.sendall(self._send_data_queue.get(False))
-            except queue.Empty as empty:
-                pass
+            if not self.__flush():
+                break
 
-            data = ""
-            try:
-                data = self.__socket.recv(1024)
-            except socket.timeout:
-                continue
-            except socket.error:
+            with self.__send_lock:
+                wlist = [self.__socket] if self.__send_buffer else []
+            rlist, wlist, xlist = select.select([self.__socket, self.__wakeup_receiver], wlist, [])
+
+            if self.__wakeup_receiver in rlist:
+                self.__wakeup_receiver.recv(4096)
+
+            if self.__socket not in rlist:
                 continue
-            except Exception as ex_recv:
-                self.__log("Exception during receiving data on control channel: " + str(ex_recv))
-                break;
 
-            # log("data len = " + str(len(data)) + ", content = " + str(data))
+            try:
+                data = self.__socket.recv(READ_CHUNK_SIZE)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                self.__log(logging.ERROR, "Exception during receiving data on control channel: %s", err)
+                break
 
             if data:
-                self.__log("Data arrived on control channel: " + str(data))
+                self.__log(logging.DEBUG, "Data arrived on control channel: %s", data)
                 self.__xi_message_sink.handle_message(data)
-                #self.__handle_incoming_message(data)
             else:
-                # recv returned with zero data without timeout -> closed?
+                # the other end closed the connection
                 if (self._listen_on_socket):
-                    self.__log("WARNING: empty Data arrived, exiting")
-                break;
-                #pass
+                    self.__log(logging.WARNING, "WARNING: empty Data arrived, exiting")
+                break
 
-        self.__log("Control channel endpoint closed, exiting thread.")
-        pass
+        # the data queued before stop() still goes out
+        self.__socket.setblocking(1)
+        self.__socket.settimeout(1)
+        with self.__send_lock:
+            self.__send_closed = True
+            try:
+                self.__socket.sendall(self.__send_buffer)
+            except socket.error:
+                pass
+            del self.__send_buffer[:]
+        self.__socket.close()
+        self.__wakeup_receiver.close()
+        self.__wakeup_sender.close()
+
+        self.__log(logging.INFO, "Control channel endpoint closed, exiting thread.")
 
     def __getLogPrefix(self):
-        return "[ " + self.__log_prefix + " transp ] [" + threading.current_thread().getName() + "]: "
+        return "[ " + self.__log_prefix + " transp ] [" + threading.current_thread().name + "]: "
+
+    def __log_enabled(self, level):
+        return level >= self.__log_level
 
-    def __log(self, msg):
-        print(self.__getLogPrefix() + msg)
+    def __log(self, level, msg, *args):
+        # The message is formatted with args only if it is going to be printed
+        if self.__log_enabled(level):
+            if args:
+                msg = msg % args
+            print(self.__getLogPrefix() + msg)
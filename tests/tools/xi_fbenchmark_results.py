@@ -0,0 +1,63 @@
+"""
+Results of the functional benchmarks and their comparison to a stored baseline.
+"""
+import json
+import time
+
+
+class XiBenchmarkResults(object):
+    """Named benchmark results. A result is a value with a unit and a direction: higher_is_better is True
+    for throughputs and False for latencies and durations.
+
+    The results are saved as JSON:
+
+    { "results": { "<name>": { "value": 1234.5, "unit": "msg/s", "higher_is_better": true }, ... } }
+
+    A saved file is the baseline of later runs, see regressions()."""
+
+    def __init__(self, results=None):
+        self.results = results if results is not None else {}
+
+    def record(self, name, value, unit, higher_is_better=True):
+        self.results[name] = {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+    def save(self, path):
+        with open(path, "w") as results_file:
+            json.dump({"results": self.results}, results_file, indent=2, sort_keys=True)
+
+    @staticmethod
+    def load(path):
+        with open(path) as results_file:
+            return XiBenchmarkResults(json.load(results_file)["results"])
+
+    def regressions(self, baseline, threshold):
+        """Return the (name, baseline value, value, change) of the results that are worse than in baseline by
+        more than threshold, a fraction of the baseline value. change is the relative difference, negative when
+        a throughput drops and positive when a latency grows. Results missing from either side are ignored."""
+        regressions = []
+        for name, result in sorted(self.results.items()):
+            baseline_result = baseline.results.get(name)
+            if baseline_result is None or baseline_result["value"] == 0:
+                continue
+            change = (result["value"] - baseline_result["value"]) / baseline_result["value"]
+            worse = -change if result["higher_is_better"] else change
+            if worse > threshold:
+                regressions.append((name, baseline_result["value"], result["value"], change))
+        return regressions
+
+
+def operations_per_second(function, operations_per_call=1, repeat=5, min_seconds=0.05):
+    """Return the operations per second of the fastest of repeat runs of function. A run calls function
+    until min_seconds have passed, every call doing operations_per_call operations."""
+    best = 0.0
+    for i in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+        best = max(best, calls * operations_per_call / elapsed)
+    return best
@@ -30,6 +30,8 @@ class TestEssentials(object):
     client_id = "default client id"
     connection_timeout = 10
     test_timeout = 5.0
+    # Set to mqtt_messages.MQTT_LOG_DEBUG to see every packet of the mock broker
+    broker_log_level = mqtt_messages.MQTT_LOG_INFO
 
 @pytest.fixture(scope="module", ids=PLATFORMS_UNDER_TEST['names'], params=PLATFORMS_UNDER_TEST['values'])
 def sut_platform(request):
@@ -43,6 +45,7 @@ def xift(request, sut_platform):
     tess.broker = MockBroker(sut_platform["socket_type"] == XiClientSocketType.WEBSOCKET)
     tess.client_sut = XiClientFactory.generate_xi_client(sut_platform["platform"], sut_platform["socket_type"])
     tess.broker.on_log = basic_console_log
+    tess.broker.log_level_set(TestEssentials.broker_log_level)
     tess.sut_platform = sut_platform["platform"]
 
     tess.mock_call_history_client = StrictMock()
@@ -34,6 +34,7 @@ except:
 import struct
 import sys
 import threading
+import time
 
 HAVE_DNS = True
 try:
@@ -46,36 +47,135 @@ if platform.system() == 'Windows':
 else:
     EAGAIN = errno.EAGAIN
 
+# Default size of a single read in buffered decoding mode
+MQTT_DECODER_CHUNK_SIZE = 65536
 
-class MQTTCodec(object):
+# Largest remaining length of an MQTT packet
+MQTT_MAX_REMAINING_LENGTH = 268435455
+
+# Precompiled structures used by the encoders and decoders
+_STRUCT_UINT16 = struct.Struct("!H")
+_STRUCT_SIMPLE_COMMAND = struct.Struct("!BB")
+_STRUCT_COMMAND_WITH_MID = struct.Struct("!BBH")
+
+
+def _encode_remaining_length(remaining_length):
+    remaining_bytes = bytearray()
+    while True:
+        byte = remaining_length % 128
+        remaining_length = remaining_length // 128
+        # If there are more digits to encode, set the top bit of this digit
+        if remaining_length > 0:
+            byte = byte | 0x80
+
+        remaining_bytes.append(byte)
+        if remaining_length == 0:
+            return bytes(remaining_bytes)
+
+# Pre-encoded fixed packets
+_SIMPLE_COMMAND_PACKETS = dict((command, _STRUCT_SIMPLE_COMMAND.pack(command, 0))
+                               for command in (PINGREQ, PINGRESP, DISCONNECT))
+_CONNACK_PACKETS = tuple(_STRUCT_COMMAND_WITH_MID.pack(CONNACK, 2, connack_result_code)
+                         for connack_result_code in range(CONNACK_REFUSED_NOT_AUTHORIZED + 1))
+
+# Number of acknowledgements the buffered decoder collects before handing them over
+MQTT_ACK_BATCH_SIZE = 256
+
+# Encoded remaining lengths of the packets smaller than this size are looked up from a table
+_REMAINING_LENGTH_TABLE_SIZE = 4096
+_REMAINING_LENGTH_TABLE = tuple(_encode_remaining_length(n) for n in range(_REMAINING_LENGTH_TABLE_SIZE))
+
+
+class MQTTInPacket(object):
+    """Decoder state of the packet being received, passed to on_packet_decoded.
 
-    def __init__(self, socket, ssl_socket):
+    Members:
+
+    command : Integer. The first byte of the fixed header.
+    remaining_length : Integer. Length of the variable header and payload.
+    packet : The variable header and payload, bytes or a memoryview into the read buffer.
+
+    The other members track the progress of the unbuffered decoder. A single instance
+    is reused for every packet of a connection, it is only valid until on_packet_decoded
+    returns.
+    """
+    __slots__ = ("command", "have_remaining", "remaining_count", "remaining_mult", "remaining_length",
+                 "packet", "to_process", "pos")
+
+    def __init__(self):
+        self.remaining_count = []
+        self.reset()
+
+    def reset(self):
+        self.command = 0
+        self.have_remaining = 0
+        del self.remaining_count[:]
+        self.remaining_mult = 1
+        self.remaining_length = 0
+        self.packet = b""
+        self.to_process = 0
+        self.pos = 0
+
+
+class MQTTCodec(object):
+    """MQTT packet encoder/decoder bound to a client socket.
+
+    By default decode_packet() reads the socket the way the original client
+    did: one recv() for the command byte, one per remaining length byte and
+    then the payload. If read_chunk_size is greater than zero the codec works
+    in buffered mode instead: it reads up to read_chunk_size bytes at once into
+    a reusable buffer and frames as many complete packets as the buffer holds.
+    In buffered mode the packet member of the MQTTInPacket handed to
+    on_packet_decoded is a memoryview into the read buffer, which is only valid
+    until the callback returns. Copy it (bytes(...)) if it has to be kept.
+
+    If on_packets_encoded is set, the PUBACK, PUBREC, PUBREL, PUBCOMP and
+    UNSUBACK packets encoded by the decoding thread while it handles a
+    buffered read are packed into a reusable buffer and passed to
+    on_packets_encoded(packet, batch, qos) together, before any other packet
+    of that thread and at the end of the read. batch is the list of the
+    (command, mid, length) of the packets in packet, in order. Without
+    on_packets_encoded every packet goes to on_packet_encoded on its own.
+    """
+
+    def __init__(self, socket, ssl_socket, read_chunk_size=0):
         self._userdata = "MQTT Codec"
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._in_packet = MQTTInPacket()
         self._sock = socket
         self._ssl = ssl_socket
 
         self.on_log = None
-
-        self._out_packet_mutex = threading.Lock()
-        self._current_out_packet_mutex = threading.Lock()
+        self._log_mask = log_level_mask(MQTT_LOG_DEBUG)
 
         self.on_packet_encoded = None
+        self.on_packets_encoded = None
         self.on_packet_decoded = None
+        # BrokerMetrics that gets the encoding time of PUBLISH packets, or None
+        self.metrics = None
+
+        self._read_chunk_size = read_chunk_size
+        self._read_buffer = bytearray(read_chunk_size)
+        self._read_view = memoryview(self._read_buffer)
+        self._read_start = 0
+        self._read_end = 0
+
+        self._ack_buffer = bytearray(_STRUCT_COMMAND_WITH_MID.size * MQTT_ACK_BATCH_SIZE)
+        self._ack_end = 0
+        self._ack_batch = []
+        self._ack_batch_thread = None
 
     def __del__(self):
         pass
 
+    def log_level_set(self, log_level):
+        """Set the least severe log level passed to on_log. See MockBroker.log_level_set()."""
+        self._log_mask = log_level_mask(log_level)
+
     def decode_packet(self):
+        if self._read_chunk_size > 0:
+            return self._decode_buffered_packets()
+
         # This gets called if pselect() indicates that there is network data
         # available - ie. at least one byte.  What we do depends on what data we
         # already have.
@@ -89,7 +189,7 @@ class MQTTCodec(object):
         # fail due to longer length, so save current data and current position.
         # After all data is read, send to _mqtt_handle_packet() to deal with.
         # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
+        if self._in_packet.command == 0:
             try:
                 if self._ssl:
                     command = self._ssl.read(1)
@@ -100,15 +200,15 @@ class MQTTCodec(object):
                     return MQTT_ERR_AGAIN
                 if err.errno == EAGAIN:
                     return MQTT_ERR_AGAIN
-                print(err)
+                self._easy_log(MQTT_LOG_ERR, "Failed to read packet! Error: %s", err)
                 return 1
             else:
                 if len(command) == 0:
                     return 1
                 command = struct.unpack("!B", command)
-                self._in_packet['command'] = command[0]
+                self._in_packet.command = command[0]
 
-        if self._in_packet['have_remaining'] == 0:
+        if self._in_packet.have_remaining == 0:
             # Read remaining
             # Algorithm for decoding taken from pseudo code at
             # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
@@ -123,112 +223,103 @@ class MQTTCodec(object):
                         return MQTT_ERR_AGAIN
                     if err.errno == EAGAIN:
                         return MQTT_ERR_AGAIN
-                    print(err)
+                    self._easy_log(MQTT_LOG_ERR, "Failed to read packet! Error: %s", err)
                     return 1
                 else:
+                    if len(byte) == 0:
+                        return 1
                     byte = struct.unpack("!B", byte)
                     byte = byte[0]
-                    self._in_packet['remaining_count'].append(byte)
+                    self._in_packet.remaining_count.append(byte)
                     # Max 4 bytes length for remaining length as defined by protocol.
                     # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
+                    if len(self._in_packet.remaining_count) > 4:
                         return MQTT_ERR_PROTOCOL
 
-                    self._in_packet['remaining_length'] = self._in_packet['remaining_length'] + (byte & 127)*self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
+                    self._in_packet.remaining_length = self._in_packet.remaining_length + (byte & 127)*self._in_packet.remaining_mult
+                    self._in_packet.remaining_mult = self._in_packet.remaining_mult * 128
 
                 if (byte & 128) == 0:
                     break
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
+            self._in_packet.have_remaining = 1
+            self._in_packet.to_process = self._in_packet.remaining_length
 
-        while self._in_packet['to_process'] > 0:
+        while self._in_packet.to_process > 0:
             try:
                 if self._ssl:
-                    data = self._ssl.read(self._in_packet['to_process'])
+                    data = self._ssl.read(self._in_packet.to_process)
                 else:
-                    data = self._sock.recv(self._in_packet['to_process'])
+                    data = self._sock.recv(self._in_packet.to_process)
             except socket.error as err:
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
                 if err.errno == EAGAIN:
                     return MQTT_ERR_AGAIN
-                print(err)
+                self._easy_log(MQTT_LOG_ERR, "Failed to read packet! Error: %s", err)
                 return 1
             else:
-                self._in_packet['to_process'] = self._in_packet['to_process'] - len(data)
-                self._in_packet['packet'] = self._in_packet['packet'] + data
+                if len(data) == 0:
+                    return 1
+                self._in_packet.to_process = self._in_packet.to_process - len(data)
+                self._in_packet.packet = self._in_packet.packet + data
 
         # All data for this packet is read and decoded.
-        self._in_packet['pos'] = 0
+        self._in_packet.pos = 0
         rc = self.on_packet_decoded(self._in_packet)
 
         # Free data and reset values
-        self._in_packet = dict(
-            command=0,
-            have_remaining=0,
-            remaining_count=[],
-            remaining_mult=1,
-            remaining_length=0,
-            packet=b"",
-            to_process=0,
-            pos=0)
+        self._in_packet.reset()
 
         return rc
 
+    def decode_data(self, data):
+        """Decode packets from data that the caller has received, e.g. an asyncio protocol.
+
+        The data is appended to the read buffer and all the complete packets are
+        passed to on_packet_decoded, the same way as in buffered mode. The codec
+        must have been created with read_chunk_size greater than zero.
+
+        Returns the first error reported by on_packet_decoded or MQTT_ERR_SUCCESS."""
+        self._read_buffer_reserve(self._read_end - self._read_start + len(data))
+        self._read_buffer[self._read_end:self._read_end + len(data)] = data
+        self._read_end += len(data)
+        return self._frame_buffered_packets()
+
     def encode_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
-        utopic = topic.encode('utf-8')
-        command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
+        if self.metrics is not None:
+            start = time.perf_counter()
+        upayload = self._publish_payload(payload)
         if payload is None:
-            remaining_length = 2+len(utopic)
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%s, q%s, r%s, m%s, '%s' (NULL payload)", dup, qos, int(retain), mid, topic)
         else:
-            if isinstance(payload, str):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-            elif isinstance(payload, bytearray):
-                payloadlen = len(payload)
-            elif isinstance(payload, unicode):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-
-            remaining_length = 2+len(utopic) + payloadlen
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%s, q%s, r%s, m%s, '%s', ... (%s bytes)",
+                           dup, qos, int(retain), mid, topic, len(upayload))
 
-        if qos > 0:
-            # For message id
-            remaining_length = remaining_length + 2
+        packet = self._pack_publish(mid, topic.encode('utf-8'), upayload, qos, retain, dup)
+        if self.metrics is not None:
+            self.metrics.encode_time(time.perf_counter() - start)
+        return self._packet_encoded(PUBLISH, packet, mid, qos)
 
-        self._pack_remaining_length(packet, remaining_length)
-        self._pack_str16(packet, topic)
+    @staticmethod
+    def pack_publish(mid, topic, payload=None, qos=0, retain=False, dup=False):
+        """Return an encoded PUBLISH packet without passing it to on_packet_encoded.
 
-        if qos > 0:
-            # For message id
-            packet.extend(struct.pack("!H", mid))
-
-        if payload is not None:
-            if isinstance(payload, str):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            elif isinstance(payload, bytearray):
-                packet.extend(payload)
-            elif isinstance(payload, unicode):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            else:
-                raise TypeError('payload must be a string, unicode or a bytearray.')
+        The same packet can be sent by several codecs with send_encoded(), e.g.
+        a QoS 0 message delivered to many clients is encoded only once."""
+        return MQTTCodec._pack_publish(mid, topic.encode('utf-8'), MQTTCodec._publish_payload(payload), qos, retain,
+                                       dup)
 
-        return self.on_packet_encoded(PUBLISH, packet, mid, qos)
+    def send_encoded(self, command, packet, mid=0, qos=0):
+        """Pass a packet encoded earlier, e.g. by pack_publish(), to on_packet_encoded."""
+        return self._packet_encoded(command, packet, mid, qos)
 
     def encode_pubrec(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %s)", mid)
         return self._encode_command_with_mid(PUBREC, mid, False)
 
     def encode_pubrel(self, mid, dup=False):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: %s)", mid)
         return self._encode_command_with_mid(PUBREL|2, mid, dup)
 
     def encode_connect(self, keepalive, clean_session):
@@ -284,8 +375,14 @@ class MQTTCodec(object):
         # return self._packet_queue(command, packet, 0, 0)
         pass # TODO - Implement encoding CONNECT later, first we are focusing on the server's needs
 
-    def encode_connack(self, connack_result_code):
-        return self._encode_command_with_mid(CONNACK, connack_result_code, 0)
+    def encode_connack(self, connack_result_code, session_present=False):
+        if session_present:
+            packet = _STRUCT_COMMAND_WITH_MID.pack(CONNACK, 2, 0x100 | connack_result_code)
+        elif 0 <= connack_result_code < len(_CONNACK_PACKETS):
+            packet = _CONNACK_PACKETS[connack_result_code]
+        else:
+            packet = _STRUCT_COMMAND_WITH_MID.pack(CONNACK, 2, connack_result_code)
+        return self._packet_encoded(CONNACK, packet, connack_result_code, 1)
 
     def encode_disconnect(self):
         return self._encode_simple_command(DISCONNECT)
@@ -320,19 +417,20 @@ class MQTTCodec(object):
         pass ## TODO - Implement encoding SUBSCRIBE later, first we are focusing on the server's needs
 
     def encode_suback(self, mid, topics_and_qos):
-        remaining_length = 2
-        for t in topics_and_qos:
-            remaining_length += 1
-
         command = SUBACK
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        self._pack_remaining_length(packet, remaining_length)
-        local_mid = mid
-        packet.extend(struct.pack("!H", local_mid))
+        remaining_length = 2 + len(topics_and_qos)
+        remaining_length_bytes = self._pack_remaining_length(remaining_length)
+        position = 1 + len(remaining_length_bytes)
+
+        packet = bytearray(position + remaining_length)
+        packet[0] = command
+        packet[1:position] = remaining_length_bytes
+        _STRUCT_UINT16.pack_into(packet, position, mid)
+        position += 2
         for t in topics_and_qos:
-            packet.extend(struct.pack("B", t[1]))
-        return (self.on_packet_encoded(command, packet, local_mid, 1), local_mid)
+            packet[position] = t[1]
+            position += 1
+        return (self._packet_encoded(command, packet, mid, 1), mid)
 
     def encode_unsubscribe(self, dup, topics):
         #     remaining_length = 2
@@ -350,8 +448,8 @@ class MQTTCodec(object):
         #     return (self._packet_queue(command, packet, local_mid, 1), local_mid)
         pass # TODO - Implement encoding UNSUBSCRIBE later, first we are focusing on the server's needs
 
-    def encode_unsuback(self, mid):
-        return self._encode_command_with_mid(UNSUBACK, mid)
+    def encode_unsuback(self, mid, topics=None):
+        return self._encode_command_with_mid(UNSUBACK, mid, False)
 
 
     # ============================================================
@@ -364,59 +462,222 @@ class MQTTCodec(object):
             command = command | 8
 
         remaining_length = 2
-        packet = struct.pack('!BBH', command, remaining_length, mid)
+        if self._ack_batch_thread is not None and self._ack_batch_thread is threading.current_thread() and \
+                self.on_packets_encoded is not None:
+            if self._ack_end == len(self._ack_buffer):
+                rc = self._ack_batch_flush()
+                if rc != MQTT_ERR_SUCCESS:
+                    return rc
+            _STRUCT_COMMAND_WITH_MID.pack_into(self._ack_buffer, self._ack_end, command, remaining_length, mid)
+            self._ack_end += _STRUCT_COMMAND_WITH_MID.size
+            self._ack_batch.append((command, mid, _STRUCT_COMMAND_WITH_MID.size))
+            return MQTT_ERR_SUCCESS
+
+        packet = _STRUCT_COMMAND_WITH_MID.pack(command, remaining_length, mid)
         return self.on_packet_encoded(command, packet, mid, 1)
 
     def _encode_simple_command(self, command):
         # For DISCONNECT, PINGREQ and PINGRESP
-        remaining_length = 0
-        packet = struct.pack('!BB', command, remaining_length)
-        return self.on_packet_encoded(command, packet, 0, 0)
+        return self._packet_encoded(command, _SIMPLE_COMMAND_PACKETS[command], 0, 0)
+
+    def acks_flush(self):
+        """Pass the acknowledgements collected so far to on_packets_encoded, if
+        called from the decoding thread. Packets queued without the codec go
+        after them this way, in the order of the calls."""
+        if self._ack_end > 0 and self._ack_batch_thread is threading.current_thread():
+            return self._ack_batch_flush()
+        return MQTT_ERR_SUCCESS
+
+    def _packet_encoded(self, command, packet, mid, qos):
+        # Keeps the order of the packets of the decoding thread: the collected acknowledgements go first
+        rc = self.acks_flush()
+        if rc != MQTT_ERR_SUCCESS:
+            return rc
+        return self.on_packet_encoded(command, packet, mid, qos)
+
+    def _ack_batch_flush(self):
+        if self._ack_end == 0:
+            return MQTT_ERR_SUCCESS
+        packet = bytes(self._ack_buffer[:self._ack_end])
+        batch = self._ack_batch
+        self._ack_end = 0
+        self._ack_batch = []
+        return self.on_packets_encoded(packet, batch, 1)
+
+    def _decode_buffered_packets(self):
+        # Buffered counterpart of decode_packet(). A single read fetches as much
+        # data as is available (up to the free space of the buffer), then every
+        # complete packet in the buffer is passed to on_packet_decoded. A partial
+        # packet stays in the buffer until the next call.
+        # Returns the first error reported by on_packet_decoded, 1 if the
+        # connection is lost or MQTT_ERR_AGAIN once the available data is
+        # consumed - the caller should wait for the socket to become readable.
+        while True:
+            self._read_buffer_reserve(self._read_end - self._read_start + self._read_chunk_size // 2)
+            try:
+                if self._ssl:
+                    nbytes = self._ssl.recv_into(self._read_view[self._read_end:])
+                else:
+                    nbytes = self._sock.recv_into(self._read_view[self._read_end:])
+            except socket.error as err:
+                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
+                    return MQTT_ERR_AGAIN
+                if err.errno == EAGAIN:
+                    return MQTT_ERR_AGAIN
+                self._easy_log(MQTT_LOG_ERR, "Failed to read packet! Error: %s", err)
+                return 1
 
-    def _easy_log(self, level, buf):
-        if self.on_log:
-            self.on_log(self, self._userdata, level, buf)
+            if nbytes == 0:
+                return 1
 
-    def _pack_remaining_length(self, packet, remaining_length):
-        remaining_bytes = []
-        while True:
-            byte = remaining_length % 128
-            remaining_length = remaining_length // 128
-            # If there are more digits to encode, set the top bit of this digit
-            if remaining_length > 0:
-                byte = byte | 0x80
-
-            remaining_bytes.append(byte)
-            packet.extend(struct.pack("!B", byte))
-            if remaining_length == 0:
-                # FIXME - this doesn't deal with incorrectly large payloads
-                return packet
-
-    def _pack_str16(self, packet, data):
-        if sys.version_info[0] < 3:
-            if isinstance(data, bytearray):
-                packet.extend(struct.pack("!H", len(data)))
-                packet.extend(data)
-            elif isinstance(data, str):
-                udata = data.encode('utf-8')
-                pack_format = "!H" + str(len(udata)) + "s"
-                packet.extend(struct.pack(pack_format, len(udata), udata))
-            elif isinstance(data, unicode):
-                udata = data.encode('utf-8')
-                pack_format = "!H" + str(len(udata)) + "s"
-                packet.extend(struct.pack(pack_format, len(udata), udata))
-            else:
-                raise TypeError
+            self._read_end += nbytes
+
+            rc = self._frame_buffered_packets()
+            if rc != MQTT_ERR_SUCCESS:
+                return rc
+
+            # Decrypted data kept inside the SSL object does not make the socket
+            # readable again, so it has to be consumed now.
+            if not self._ssl or self._ssl.pending() == 0:
+                return MQTT_ERR_AGAIN
+
+    def _frame_buffered_packets(self):
+        self._ack_batch_thread = threading.current_thread()
+        try:
+            rc = self._frame_buffered_packets_batched()
+        finally:
+            self._ack_batch_thread = None
+        flush_rc = self._ack_batch_flush()
+        return rc if rc != MQTT_ERR_SUCCESS else flush_rc
+
+    def _frame_buffered_packets_batched(self):
+        buf = self._read_buffer
+        end = self._read_end
+        in_packet = self._in_packet
+        in_packet.have_remaining = 1
+
+        while self._read_start < end:
+            start = self._read_start
+
+            # Read remaining length, at most 4 bytes
+            remaining_length = 0
+            multiplier = 1
+            pos = start + 1
+            complete = False
+            while pos < end:
+                byte = buf[pos]
+                pos += 1
+                remaining_length += (byte & 127) * multiplier
+                if (byte & 128) == 0:
+                    complete = True
+                    break
+                if pos - start > 4:
+                    return MQTT_ERR_PROTOCOL
+                multiplier *= 128
+
+            if not complete:
+                break
+
+            packet_end = pos + remaining_length
+            if packet_end > end:
+                # Make sure the whole packet fits into the buffer for the next read
+                self._read_buffer_reserve(packet_end - start)
+                break
+
+            self._read_start = packet_end
+            in_packet.command = buf[start]
+            in_packet.remaining_length = remaining_length
+            in_packet.packet = self._read_view[pos:packet_end]
+            rc = self.on_packet_decoded(in_packet)
+            in_packet.packet = b""
+            if rc:
+                return rc
+
+        if self._read_start == self._read_end:
+            self._read_start = 0
+            self._read_end = 0
+
+        return MQTT_ERR_SUCCESS
+
+    @staticmethod
+    def _publish_payload(payload):
+        if payload is None:
+            return b""
+        if isinstance(payload, bytearray) or isinstance(payload, bytes) or isinstance(payload, memoryview):
+            return payload
+        elif isinstance(payload, str):
+            return payload.encode('utf-8')
+        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
+            return payload.encode('utf-8')
         else:
-            if isinstance(data, bytearray) or isinstance(data, bytes):
-                packet.extend(struct.pack("!H", len(data)))
-                packet.extend(data)
-            elif isinstance(data, str):
-                udata = data.encode('utf-8')
-                pack_format = "!H" + str(len(udata)) + "s"
-                packet.extend(struct.pack(pack_format, len(udata), udata))
-            else:
-                raise TypeError
+            raise TypeError('payload must be a string, unicode or a bytearray.')
+
+    @staticmethod
+    def _pack_publish(mid, utopic, upayload, qos, retain, dup):
+        # The size of the header is computed first, the header is packed into a buffer of that size and
+        # the payload is appended with a single copy
+        command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
+        topic_length = len(utopic)
+        header_length = 2 + topic_length
+        if qos > 0:
+            # For message id
+            header_length += 2
+
+        remaining_length_bytes = MQTTCodec._pack_remaining_length(header_length + len(upayload))
+        position = 1 + len(remaining_length_bytes)
+        packet = bytearray(position + header_length)
+        packet[0] = command
+        packet[1:position] = remaining_length_bytes
+        _STRUCT_UINT16.pack_into(packet, position, topic_length)
+        position += 2
+        packet[position:position + topic_length] = utopic
+        position += topic_length
+
+        if qos > 0:
+            _STRUCT_UINT16.pack_into(packet, position, mid)
+            position += 2
+
+        packet += upayload
+        return packet
+
+    def _read_buffer_reserve(self, size):
+        # Makes sure that 'size' bytes fit into the buffer starting from the first
+        # unprocessed byte.
+        if self._read_start + size <= len(self._read_buffer):
+            return
+
+        pending = self._read_end - self._read_start
+        if size <= len(self._read_buffer):
+            # Move the unprocessed data to the front of the buffer. Slice assignment of
+            # equal length does not resize the bytearray, so this is allowed while
+            # memoryviews handed out earlier still exist.
+            self._read_buffer[0:pending] = self._read_buffer[self._read_start:self._read_end]
+        else:
+            # Packet is larger than the buffer. Allocate a new one, views of the
+            # old buffer remain valid.
+            new_buffer = bytearray(size)
+            new_buffer[0:pending] = self._read_buffer[self._read_start:self._read_end]
+            self._read_buffer = new_buffer
+            self._read_view = memoryview(new_buffer)
+
+        self._read_start = 0
+        self._read_end = pending
+
+    def _easy_log(self, level, buf, *args):
+        # The message is formatted with args only if it is going to be logged
+        if self.on_log and (level & self._log_mask):
+            if args:
+                buf = buf % args
+            self.on_log(self, self._userdata, level, buf)
+
+    @staticmethod
+    def _pack_remaining_length(remaining_length):
+        # Returns the encoded remaining length field of a packet
+        if remaining_length < _REMAINING_LENGTH_TABLE_SIZE:
+            return _REMAINING_LENGTH_TABLE[remaining_length]
+        if remaining_length > MQTT_MAX_REMAINING_LENGTH:
+            raise ValueError('remaining length must not exceed ' + str(MQTT_MAX_REMAINING_LENGTH) + ' bytes.')
+        return _encode_remaining_length(remaining_length)
 
     @staticmethod
     def decode_subscribe_packet(subscribe_packet, remaining_length):
@@ -442,6 +703,31 @@ class MQTTCodec(object):
 
         return mid, topics_and_qos
 
+    @staticmethod
+    def decode_publish_packet(publish_packet, qos):
+        """Decode the variable header of a PUBLISH packet without copying its payload.
+
+        Returns a (topic, mid, payload) tuple, where topic is bytes, mid is 0 for QoS 0 and payload is
+        a memoryview slice of publish_packet. The topic is None if the packet is too short."""
+        packet_view = memoryview(publish_packet)
+        packet_length = len(packet_view)
+        if packet_length < 2:
+            return None, 0, None
+
+        (topic_length,) = _STRUCT_UINT16.unpack_from(packet_view, 0)
+        position = 2 + topic_length
+        if qos > 0:
+            position += 2
+        if packet_length < position:
+            return None, 0, None
+
+        topic = packet_view[2:2 + topic_length].tobytes()
+        mid = 0
+        if qos > 0:
+            (mid,) = _STRUCT_UINT16.unpack_from(packet_view, position - 2)
+
+        return topic, mid, packet_view[position:]
+
     @staticmethod
     def decode_unsubscribe_packet(unsubscribe_packet, remaining_length):
         topics = []
@@ -460,7 +746,7 @@ class MQTTCodec(object):
                 pack_format += str(remaining_length - position) + 's'
                 (topic_name, rest) = struct.unpack(pack_format, rest)
             else:
-                (topic_name, rest) = struct.unpack(pack_format, rest)
+                (topic_name,) = struct.unpack(pack_format, rest)
                 rest = None
             topics.append(topic_name)
 
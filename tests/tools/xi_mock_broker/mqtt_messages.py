@@ -48,6 +48,12 @@ PINGREQ = 0xC0
 PINGRESP = 0xD0
 DISCONNECT = 0xE0
 
+# Names of the message types, e.g. for logs, metrics and traces
+COMMAND_NAMES = {
+    CONNECT: "CONNECT", CONNACK: "CONNACK", PUBLISH: "PUBLISH", PUBACK: "PUBACK", PUBREC: "PUBREC",
+    PUBREL: "PUBREL", PUBCOMP: "PUBCOMP", SUBSCRIBE: "SUBSCRIBE", SUBACK: "SUBACK", UNSUBSCRIBE: "UNSUBSCRIBE",
+    UNSUBACK: "UNSUBACK", PINGREQ: "PINGREQ", PINGRESP: "PINGRESP", DISCONNECT: "DISCONNECT"}
+
 # CONNECT flags
 USERNAME_FLAG = 0x80
 PASSWORD_FLAG = 0x40
@@ -63,6 +69,19 @@ MQTT_LOG_WARNING = 0x04
 MQTT_LOG_ERR = 0x08
 MQTT_LOG_DEBUG = 0x10
 
+# Log levels from the most to the least severe
+MQTT_LOG_LEVELS = (MQTT_LOG_ERR, MQTT_LOG_WARNING, MQTT_LOG_NOTICE, MQTT_LOG_INFO, MQTT_LOG_DEBUG)
+
+
+def log_level_mask(log_level):
+    """Return the mask of log_level and all the log levels more severe than log_level."""
+    mask = 0
+    for level in MQTT_LOG_LEVELS:
+        mask |= level
+        if level == log_level:
+            return mask
+    raise ValueError('Invalid log level.')
+
 # CONNACK codes
 CONNACK_ACCEPTED = 0
 CONNACK_REFUSED_PROTOCOL_VERSION = 1
@@ -100,9 +119,10 @@ MQTT_ERR_AUTH = 11
 MQTT_ERR_ACL_DENIED = 12
 MQTT_ERR_UNKNOWN = 13
 MQTT_ERR_ERRNO = 14
+MQTT_ERR_QUEUE_SIZE = 15
 
 
-class MQTTMessage:
+class MQTTMessage(object):
     """ This is a class that describes an incoming message. It is passed to the
     on_message callback as the message parameter.
 
@@ -110,20 +130,58 @@ class MQTTMessage:
 
     topic : String. topic that the message was published on.
     payload : String/bytes the message payload.
+    payload_view : memoryview of the payload. Incoming payloads are kept as a view
+                   into the received packet and are copied to bytes only when the
+                   payload member is read.
     qos : Integer. The message Quality of Service 0, 1 or 2.
     retain : Boolean. If true, the message is a retained message and not fresh.
     mid : Integer. The message id.
     """
+    __slots__ = ("timestamp", "state", "dup", "mid", "topic", "_payload", "_payload_view", "qos", "retain")
+
     def __init__(self):
         self.timestamp = 0
         self.state = mqtt_ms_invalid
         self.dup = False
         self.mid = 0
         self.topic = ""
-        self.payload = None
+        self._payload = None
+        self._payload_view = None
         self.qos = 0
         self.retain = False
 
+    @property
+    def payload(self):
+        self.payload_detach()
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self._payload_view = None
+
+    def payload_detach(self):
+        """Copy a payload kept as a view into the received packet to bytes, so the message no longer refers to
+        the packet's buffer."""
+        if self._payload_view is not None:
+            self._payload = self._payload_view.tobytes()
+            self._payload_view = None
+
+    @property
+    def payload_view(self):
+        if self._payload_view is not None:
+            return self._payload_view
+        if self._payload is None:
+            return None
+        if sys.version_info[0] >= 3 and isinstance(self._payload, str):
+            return memoryview(self._payload.encode('utf-8'))
+        return memoryview(self._payload)
+
+    @payload_view.setter
+    def payload_view(self, payload_view):
+        self._payload = None
+        self._payload_view = payload_view
+
 
 class MQTTConnectOptions(object):
     """ This class represents the connect options available for an MQTT client on connection time.
@@ -0,0 +1,85 @@
+"""
+Helpers of the dev tests that talk to a mock broker over a raw socket: MQTT packet encoders and a TestCase base
+running a broker with a connected client.
+"""
+
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_mock_broker import MockBroker
+from tools.xi_mock_broker.mqtt_messages import CONNECT, CLEAN_SESSION_FLAG, PROTOCOL_NAMEv311, MQTTv311, \
+    MQTT_LOG_INFO
+import tools.xi_utils as xi_utils
+import socket
+import struct
+import unittest
+
+
+def encode_packet(command, body):
+    packet = bytearray([command])
+    remaining_length = len(body)
+    while True:
+        byte = remaining_length % 128
+        remaining_length = remaining_length // 128
+        packet.append(byte | 0x80 if remaining_length > 0 else byte)
+        if remaining_length == 0:
+            return bytes(packet) + body
+
+
+def encode_str16(data):
+    return struct.pack("!H", len(data)) + data
+
+
+def encode_connect(client_id=b"xi_dev_test", connect_flags=CLEAN_SESSION_FLAG):
+    return encode_packet(CONNECT, encode_str16(PROTOCOL_NAMEv311) + struct.pack("!BBH", MQTTv311, connect_flags, 60) +
+                         encode_str16(client_id))
+
+
+def recv_exactly_from(client, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = client.recv(length - len(data))
+        if not chunk:
+            raise AssertionError("Connection closed by the broker.")
+        data.extend(chunk)
+    return bytes(data)
+
+
+class ConnectedBrokerTestCase(unittest.TestCase):
+    """A broker running its network thread and the raw socket client connected by _connect(). Subclasses set the
+    broker up before its loop starts in _broker_setup()."""
+
+    _client_id = b"xi_dev_test"
+
+    def setUp(self):
+        self.broker = self._broker_new()
+        self.broker.on_log = xi_utils.basic_console_log
+        self.broker.log_level_set(MQTT_LOG_INFO)
+        self._broker_setup()
+        self.broker.loop_start()
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        self.broker.trigger_shutdown()
+
+    def _broker_new(self):
+        return MockBroker(False)
+
+    def _broker_setup(self):
+        pass
+
+    def _connect(self, connect_flags=CLEAN_SESSION_FLAG, connack=b"\x20\x02\x00\x00", rcvbuf=None):
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf is not None:
+            self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.client.connect(self.broker.bind_address)
+        self.client.sendall(encode_connect(self._client_id, connect_flags))
+        self.assertEqual(connack, self._recv_exactly(4))
+
+    def _recv_exactly(self, length):
+        return recv_exactly_from(self.client, length)
@@ -0,0 +1,95 @@
+"""
+Memory benchmark of the queued outgoing QoS 1 messages of the MockBroker. Each message is kept the way
+publish() keeps it while it waits for its PUBACK: an MQTTMessage in the in-flight store and the encoded
+PUBLISH in the outbound packet queue. It compares the bytes allocated per message by the current __slots__
+records to those of the original records, a plain MQTTMessage object and a dict per queued packet.
+
+Usage: python3 xi_dev_benchmark_message_memory.py [message count, at most 65535]
+"""
+
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec
+from tools.xi_mock_broker.mqtt_messages import *
+from tools.xi_mock_broker.xi_mock_broker import _OutPacket
+from collections import OrderedDict, deque
+import time
+import tracemalloc
+
+
+class LegacyMQTTMessage(object):
+    """MQTTMessage before __slots__, every instance has its own attribute dict."""
+
+    def __init__(self):
+        self.timestamp = 0
+        self.state = mqtt_ms_invalid
+        self.dup = False
+        self.mid = 0
+        self.topic = ""
+        self._payload = None
+        self._payload_view = None
+        self.qos = 0
+        self.retain = False
+
+
+def legacy_out_packet(command, mid, qos, packet):
+    return {
+        'command': command,
+        'mid': mid,
+        'qos': qos,
+        'pos': 0,
+        'to_process': len(packet),
+        'packet': packet}
+
+
+TOPIC = "xi/blue/v1/topic"
+PAYLOAD = bytearray(16)
+
+
+def queue_messages(message_class, out_packet_class, count):
+    out_messages = OrderedDict()
+    out_packet = deque()
+
+    codec = MQTTCodec(None, None)
+    codec.log_level_set(MQTT_LOG_ERR)
+    codec.on_packet_encoded = lambda command, packet, mid, qos: \
+        out_packet.append(out_packet_class(command, mid, qos, packet)) or MQTT_ERR_SUCCESS
+
+    for mid in range(1, count + 1):
+        message = message_class()
+        message.timestamp = time.time()
+        message.mid = mid
+        message.topic = TOPIC
+        message.payload = PAYLOAD
+        message.qos = 1
+        message.state = mqtt_ms_wait_for_puback
+        out_messages[mid] = message
+        codec.encode_publish(mid, message.topic, message.payload, message.qos)
+
+    return out_messages, out_packet
+
+
+def bytes_per_message(message_class, out_packet_class, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queues = queue_messages(message_class, out_packet_class, count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del queues
+    return (after - before) / float(count)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    legacy = bytes_per_message(LegacyMQTTMessage, legacy_out_packet, count)
+    current = bytes_per_message(MQTTMessage, _OutPacket, count)
+
+    print("%-40s %12s" % ("queued QoS1 message, 16B payload", "bytes/msg"))
+    print("%-40s %12.0f" % ("legacy (dict records)", legacy))
+    print("%-40s %12.0f" % ("current (__slots__ records)", current))
+    print("%-40s %11.0f%%" % ("saved", 100.0 * (legacy - current) / legacy))
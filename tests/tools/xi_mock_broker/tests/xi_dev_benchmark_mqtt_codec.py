@@ -0,0 +1,125 @@
+"""
+Micro-benchmark of the MQTTCodec encoders. It compares the packets/sec of the current encoders to the
+encoders of the original codec, which built struct format strings per call and assembled packets byte
+by byte.
+
+Usage: python3 xi_dev_benchmark_mqtt_codec.py [packet count]
+"""
+
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec
+from tools.xi_mock_broker.mqtt_messages import *
+import struct
+import timeit
+
+
+class LegacyMQTTCodec(MQTTCodec):
+    """The encoders of MQTTCodec before the precompiled structures and single allocation packet assembly."""
+
+    def encode_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
+        utopic = topic.encode('utf-8')
+        command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
+        packet = bytearray()
+        packet.extend(struct.pack("!B", command))
+        if payload is None:
+            remaining_length = 2+len(utopic)
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+        else:
+            if isinstance(payload, str):
+                upayload = payload.encode('utf-8')
+                payloadlen = len(upayload)
+            elif isinstance(payload, bytearray):
+                payloadlen = len(payload)
+
+            remaining_length = 2+len(utopic) + payloadlen
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
+
+        if qos > 0:
+            # For message id
+            remaining_length = remaining_length + 2
+
+        self._legacy_pack_remaining_length(packet, remaining_length)
+        self._legacy_pack_str16(packet, topic)
+
+        if qos > 0:
+            # For message id
+            packet.extend(struct.pack("!H", mid))
+
+        if payload is not None:
+            if isinstance(payload, str):
+                pack_format = str(payloadlen) + "s"
+                packet.extend(struct.pack(pack_format, upayload))
+            elif isinstance(payload, bytearray):
+                packet.extend(payload)
+
+        return self.on_packet_encoded(PUBLISH, packet, mid, qos)
+
+    def encode_suback(self, mid, topics_and_qos):
+        remaining_length = 2
+        for t in topics_and_qos:
+            remaining_length += 1
+
+        command = SUBACK
+        packet = bytearray()
+        packet.extend(struct.pack("!B", command))
+        self._legacy_pack_remaining_length(packet, remaining_length)
+        local_mid = mid
+        packet.extend(struct.pack("!H", local_mid))
+        for t in topics_and_qos:
+            packet.extend(struct.pack("B", t[1]))
+        return (self.on_packet_encoded(command, packet, local_mid, 1), local_mid)
+
+    def encode_puback(self, mid):
+        return self.on_packet_encoded(PUBACK, struct.pack('!BBH', PUBACK, 2, mid), mid, 1)
+
+    def _legacy_pack_remaining_length(self, packet, remaining_length):
+        while True:
+            byte = remaining_length % 128
+            remaining_length = remaining_length // 128
+            if remaining_length > 0:
+                byte = byte | 0x80
+
+            packet.extend(struct.pack("!B", byte))
+            if remaining_length == 0:
+                return packet
+
+    def _legacy_pack_str16(self, packet, data):
+        udata = data.encode('utf-8')
+        pack_format = "!H" + str(len(udata)) + "s"
+        packet.extend(struct.pack(pack_format, len(udata), udata))
+
+
+PAYLOAD_1K = bytearray(1024)
+PAYLOAD_256K = bytearray(262144)
+
+SCENARIOS = [
+    ("PUBLISH QoS0 string 16B", lambda codec: codec.encode_publish(0, "xi/blue/v1/topic", "p" * 16, 0)),
+    ("PUBLISH QoS1 bytearray 1kB", lambda codec: codec.encode_publish(1, "xi/blue/v1/topic", PAYLOAD_1K, 1)),
+    ("PUBLISH QoS1 bytearray 256kB", lambda codec: codec.encode_publish(1, "xi/blue/v1/topic", PAYLOAD_256K, 1)),
+    ("SUBACK 4 topics", lambda codec: codec.encode_suback(1, [("a", 0), ("b", 1), ("c", 2), ("d", 1)])),
+    ("PUBACK", lambda codec: codec.encode_puback(1)),
+]
+
+
+def packets_per_second(codec, encode, count):
+    return count / min(timeit.repeat(lambda: encode(codec), number=count, repeat=3))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    codecs = []
+    for codec_class in (LegacyMQTTCodec, MQTTCodec):
+        codec = codec_class(None, None)
+        codec.on_packet_encoded = lambda command, packet, mid, qos: MQTT_ERR_SUCCESS
+        codecs.append(codec)
+
+    print("%-30s %15s %15s %8s" % ("packet", "legacy pkt/s", "current pkt/s", "speedup"))
+    for name, encode in SCENARIOS:
+        legacy, current = [packets_per_second(codec, encode, count) for codec in codecs]
+        print("%-30s %15.0f %15.0f %7.2fx" % (name, legacy, current, current / legacy))
@@ -0,0 +1,122 @@
+"""
+Reconnect storm benchmark of the persistent sessions. Every client has a stored session with queued QoS 1
+messages. All the clients reconnect at once with clean_session=False to a MultiClientMockBroker, the broker
+resumes their sessions and redelivers the messages, the clients acknowledge them and disconnect, which saves
+the sessions again. It reports the time of the storm and the redelivered messages per second for the in-memory
+and the SQLite session store.
+
+Usage: python3 xi_dev_benchmark_session_resume.py [client count] [queued messages per client]
+"""
+
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_multi_client_broker import MultiClientMockBroker
+from tools.xi_mock_broker.xi_session_store import MQTTSession, SessionStore, SqliteSessionStore
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import encode_packet, encode_str16, encode_connect
+from tools.xi_mock_broker.mqtt_messages import *
+import os
+import socket
+import tempfile
+import time
+
+TOPIC = "xi/blue/v1/session"
+PAYLOAD = bytearray(64)
+
+
+def client_id(i):
+    return "client %d" % i
+
+
+def sessions_seed(store, client_count, message_count):
+    for i in range(client_count):
+        session = MQTTSession(client_id(i))
+        session.subscriptions[TOPIC] = 1
+        for j in range(message_count):
+            session.message_queue(TOPIC, PAYLOAD, 1)
+        store.save(session)
+
+
+def recv_exactly(client, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = client.recv(length - len(data))
+        if not chunk:
+            raise RuntimeError("Connection closed by the broker.")
+        data.extend(chunk)
+    return data
+
+
+def reconnect_storm(store, client_count, message_count):
+    broker = MultiClientMockBroker()
+    broker.log_level_set(MQTT_LOG_ERR)
+    broker.session_store_set(store)
+    broker.loop_start()
+
+    publish_length = len(encode_packet(PUBLISH | 2, encode_str16(TOPIC.encode()) + b"\x00\x00" + PAYLOAD))
+    start = time.time()
+    clients = []
+    for i in range(client_count):
+        client = socket.create_connection(broker.bind_address)
+        client.sendall(encode_connect(client_id(i).encode(), 0))
+        clients.append(client)
+
+    # The broker sends at most max_inflight_messages PUBLISHes before they are acknowledged
+    mid_offset = publish_length - len(PAYLOAD) - 2
+    for client in clients:
+        if recv_exactly(client, 4) != b"\x20\x02\x01\x00":
+            raise RuntimeError("Session not resumed.")
+        received = 0
+        pending = bytearray()
+        while received < message_count:
+            pending.extend(client.recv(65536))
+            count = len(pending) // publish_length
+            client.sendall(b"".join(encode_packet(PUBACK, pending[i * publish_length + mid_offset:][:2])
+                                    for i in range(count)))
+            del pending[:count * publish_length]
+            received += count
+        client.sendall(encode_packet(DISCONNECT, b""))
+
+    for client in clients:
+        client.recv(1)
+        client.close()
+
+    # Every session is saved again when its connection is closed
+    while broker.connections():
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    broker.loop_stop()
+    return elapsed
+
+
+def run(name, store, client_count, message_count):
+    sessions_seed(store, client_count, message_count)
+    elapsed = reconnect_storm(store, client_count, message_count)
+    messages = client_count * message_count
+    print("%-10s %8d %12.3f %12d" % (name, messages, elapsed, messages / elapsed))
+    # The messages are acknowledged, the resumed sessions are empty
+    if any(store.load(client_id(i)).out_messages for i in range(client_count)):
+        raise RuntimeError("Acknowledged messages left in the sessions.")
+
+
+if __name__ == "__main__":
+    client_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    print("%-10s %8s %12s %12s" % ("store", "messages", "seconds", "messages/s"))
+    run("memory", SessionStore(), client_count, message_count)
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "sessions.db")
+    store = SqliteSessionStore(path)
+    try:
+        run("sqlite", store, client_count, message_count)
+    finally:
+        store.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        os.rmdir(directory)
@@ -0,0 +1,279 @@
+"""
+Load generator built on the vendored paho client. It simulates devices in a pool of worker processes: every
+device connects at the configured connect rate, subscribes to its own topics and publishes messages to them
+at the configured rate, QoS mix and payload sizes. The broker routes the messages back to the device, which
+timestamps them on arrival. The report shows the throughput and the p50/p99/p999 publish to delivery
+latency, overall and per QoS.
+
+Without --broker a MultiClientMockBroker is started in routing mode, with the QoS>0 messages acknowledged
+on arrival. --broker host:port runs the load against any local broker instead.
+
+Usage: python3 xi_dev_load_generator.py [--devices N] [--processes N] [--connect-rate N] [--publish-rate N]
+       [--duration SECONDS] [--qos-mix 0:W,1:W,2:W] [--payload-size N|MIN-MAX|N,N,...] [--subscriptions N]
+       [--broker HOST:PORT]
+"""
+
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_multi_client_broker import MultiClientMockBroker
+from tools.xi_mock_broker.mqtt_messages import *
+import tools.xi_mock_broker.tests.paho_mqtt_client as paho_client
+import argparse
+import array
+import heapq
+import multiprocessing
+import random
+import struct
+import threading
+import time
+
+# Every payload starts with the time.perf_counter() of the publish
+_STRUCT_TIMESTAMP = struct.Struct("!d")
+
+# Time allowed for the messages in flight to arrive after the last publish
+DRAIN_TIMEOUT = 5.0
+
+
+class LoadProfile(object):
+    """Settings of a load generator run.
+
+    devices: number of simulated devices, each with its own client connection.
+    processes: number of worker processes, the devices are split evenly among them.
+    connect_rate: new connections per second, all the processes together.
+    publish_rate: messages per second of a single device.
+    duration: seconds of publishing, after the devices of a process are connected.
+    qos_mix: weights of QoS 0, 1 and 2, e.g. (70, 25, 5).
+    payload_sizes: (minimum, maximum) for uniformly distributed sizes or a list of sizes to choose from.
+      A payload is at least 8 bytes long, the publish timestamp.
+    subscriptions: topics a device subscribes to, its messages are spread over them.
+    host, port: the broker.
+    """
+
+    def __init__(self, devices=10, processes=2, connect_rate=100.0, publish_rate=10.0, duration=10.0,
+                 qos_mix=(1, 0, 0), payload_sizes=(64, 64), subscriptions=1, host="localhost", port=1883):
+        self.devices = devices
+        self.processes = processes
+        self.connect_rate = connect_rate
+        self.publish_rate = publish_rate
+        self.duration = duration
+        self.qos_mix = tuple(qos_mix)
+        self.payload_sizes = payload_sizes
+        self.subscriptions = subscriptions
+        self.host = host
+        self.port = port
+
+    def payload_size(self, rng):
+        if isinstance(self.payload_sizes, tuple):
+            size = rng.randint(*self.payload_sizes)
+        else:
+            size = rng.choice(self.payload_sizes)
+        return max(size, _STRUCT_TIMESTAMP.size)
+
+
+def qos_mix_parse(text):
+    """Parse "0:70,1:25,2:5" into the (70, 25, 5) weights of QoS 0, 1 and 2."""
+    weights = [0, 0, 0]
+    for item in text.split(","):
+        qos, weight = item.split(":")
+        weights[int(qos)] = float(weight)
+    if sum(weights) <= 0:
+        raise ValueError("The QoS mix has no positive weight.")
+    return tuple(weights)
+
+
+def payload_sizes_parse(text):
+    """Parse "64" and "16-1024" into (minimum, maximum) and "16,256,4096" into a list of sizes."""
+    if "," in text:
+        return [int(size) for size in text.split(",")]
+    if "-" in text:
+        minimum, maximum = text.split("-")
+        return int(minimum), int(maximum)
+    return int(text), int(text)
+
+
+class _Device(object):
+    """A simulated device: a paho client that publishes to its own topics and times the messages it gets back."""
+
+    def __init__(self, profile, index, results):
+        self.client_id = "xi-load-%d" % index
+        self.topics = ["xi/load/%d/%d" % (index, i) for i in range(profile.subscriptions)]
+        self.results = results
+        self.connected = threading.Event()
+        self.client = paho_client.Client(self.client_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+
+    def connect(self, profile):
+        self.client.connect(profile.host, profile.port)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            return
+        for topic in self.topics:
+            client.subscribe(topic, 2)
+        self.connected.set()
+
+    def _on_message(self, client, userdata, message):
+        latency = time.perf_counter() - _STRUCT_TIMESTAMP.unpack_from(message.payload)[0]
+        with self.results.lock:
+            self.results.received += 1
+            self.results.latencies[message.qos].append(latency)
+
+
+class _WorkerResults(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connected = 0
+        self.published = 0
+        self.received = 0
+        self.latencies = [array.array('d') for qos in range(3)]
+
+
+def device_worker(profile, first_device, device_count):
+    """Run the devices first_device .. first_device+device_count-1 of profile in this process. Returns a
+    dictionary of the connected, published and received counts, the publish seconds and the latencies in
+    seconds per QoS as bytes of array('d')."""
+    rng = random.Random(first_device)
+    results = _WorkerResults()
+    devices = []
+    connect_interval = profile.processes / profile.connect_rate if profile.connect_rate > 0 else 0
+
+    for index in range(first_device, first_device + device_count):
+        device = _Device(profile, index, results)
+        try:
+            device.connect(profile)
+            devices.append(device)
+        except (OSError, ValueError):
+            pass
+        time.sleep(connect_interval)
+
+    for device in devices:
+        if device.connected.wait(DRAIN_TIMEOUT):
+            results.connected += 1
+
+    # The devices publish at fixed intervals from random offsets, the earliest due device goes first
+    interval = 1.0 / profile.publish_rate
+    start = time.perf_counter()
+    end = start + profile.duration
+    due = [(start + rng.random() * interval, i) for i, device in enumerate(devices) if device.connected.is_set()]
+    heapq.heapify(due)
+    padding = bytes(max(max(profile.payload_sizes) - _STRUCT_TIMESTAMP.size, 0))
+    while due:
+        publish_time, i = heapq.heappop(due)
+        if publish_time >= end:
+            break
+        now = time.perf_counter()
+        if publish_time > now:
+            time.sleep(publish_time - now)
+
+        device = devices[i]
+        qos = rng.choices((0, 1, 2), profile.qos_mix)[0]
+        payload = bytearray(_STRUCT_TIMESTAMP.pack(time.perf_counter()))
+        payload += padding[:profile.payload_size(rng) - _STRUCT_TIMESTAMP.size]
+        rc, mid = device.client.publish(rng.choice(device.topics), payload, qos)
+        if rc == MQTT_ERR_SUCCESS:
+            results.published += 1
+        heapq.heappush(due, (publish_time + interval, i))
+    elapsed = time.perf_counter() - start
+
+    deadline = time.time() + DRAIN_TIMEOUT
+    while results.received < results.published and time.time() < deadline:
+        time.sleep(0.01)
+
+    for device in devices:
+        device.client.disconnect()
+        device.client.loop_stop()
+
+    return {"connected": results.connected, "published": results.published, "received": results.received,
+            "seconds": elapsed, "latencies": [latencies.tobytes() for latencies in results.latencies]}
+
+
+def run(profile):
+    """Run the devices of profile across a pool of profile.processes processes. Returns the summed
+    results of the workers, see device_worker(), with the latencies as sorted lists per QoS."""
+    processes = max(1, min(profile.processes, profile.devices))
+    profile.processes = processes
+    slices = []
+    first_device = 0
+    for i in range(processes):
+        device_count = profile.devices // processes + (1 if i < profile.devices % processes else 0)
+        slices.append((profile, first_device, device_count))
+        first_device += device_count
+
+    with multiprocessing.Pool(processes) as pool:
+        worker_results = pool.starmap(device_worker, slices)
+
+    results = {"connected": 0, "published": 0, "received": 0, "seconds": 0.0, "latencies": [[], [], []]}
+    for worker_result in worker_results:
+        for key in ("connected", "published", "received"):
+            results[key] += worker_result[key]
+        results["seconds"] = max(results["seconds"], worker_result["seconds"])
+        for qos in range(3):
+            latencies = array.array('d')
+            latencies.frombytes(worker_result["latencies"][qos])
+            results["latencies"][qos].extend(latencies)
+    for latencies in results["latencies"]:
+        latencies.sort()
+    return results
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def report(profile, results):
+    seconds = results["seconds"] or 1.0
+    print("devices %d/%d connected, %d published (%.0f msg/s), %d received (%.0f msg/s) in %.1f s" %
+          (results["connected"], profile.devices, results["published"], results["published"] / seconds,
+           results["received"], results["received"] / seconds, seconds))
+    print("%-6s %10s %10s %10s %10s" % ("qos", "messages", "p50 ms", "p99 ms", "p999 ms"))
+    rows = [(str(qos), latencies) for qos, latencies in enumerate(results["latencies"]) if latencies]
+    rows.append(("all", sorted(sum(results["latencies"], []))))
+    for name, latencies in rows:
+        print("%-6s %10d %10.3f %10.3f %10.3f" % (name, len(latencies), percentile(latencies, 0.5) * 1e3,
+                                                 percentile(latencies, 0.99) * 1e3,
+                                                 percentile(latencies, 0.999) * 1e3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MQTT load generator built on the vendored paho client.")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--connect-rate", type=float, default=100.0, help="connections per second")
+    parser.add_argument("--publish-rate", type=float, default=10.0, help="messages per second per device")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of publishing")
+    parser.add_argument("--qos-mix", type=qos_mix_parse, default=(1, 0, 0), help="e.g. 0:70,1:25,2:5")
+    parser.add_argument("--payload-size", type=payload_sizes_parse, default=(64, 64),
+                        help="N, MIN-MAX or N,N,...")
+    parser.add_argument("--subscriptions", type=int, default=1, help="topics per device")
+    parser.add_argument("--broker", help="HOST:PORT of the broker, a MultiClientMockBroker by default")
+    args = parser.parse_args()
+
+    profile = LoadProfile(args.devices, args.processes, args.connect_rate, args.publish_rate, args.duration,
+                          args.qos_mix, args.payload_size, args.subscriptions)
+
+    broker = None
+    if args.broker:
+        profile.host, port = args.broker.rsplit(":", 1)
+        profile.port = int(port)
+    else:
+        broker = MultiClientMockBroker()
+        broker.log_level_set(MQTT_LOG_ERR)
+        broker.routing_set(True)
+        broker.auto_ack_set(True)
+        broker.loop_start()
+        profile.host, profile.port = broker.bind_address
+
+    try:
+        report(profile, run(profile))
+    finally:
+        if broker is not None:
+            broker.loop_stop()
@@ -0,0 +1,86 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_async_broker import AsyncMockBroker
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import encode_packet, encode_str16, encode_connect
+from tools.xi_mock_broker.mqtt_messages import *
+import asyncio
+import struct
+import unittest
+
+
+async def connect_client(broker, client_id):
+    reader, writer = await asyncio.open_connection(*broker.bind_address)
+    writer.write(encode_connect(client_id))
+    connack = await reader.readexactly(4)
+    return reader, writer, connack
+
+
+class TestAsyncBroker(unittest.TestCase):
+
+    def xi_dev_test_connect_manyBrokersInOneLoop_allClientsConnected(self):
+        async def scenario():
+            brokers = [AsyncMockBroker() for i in range(5)]
+            for broker in brokers:
+                await broker.start()
+
+            clients = [await connect_client(broker, b"client") for broker in brokers for i in range(10)]
+
+            self.assertEqual([b"\x20\x02\x00\x00"] * 50, [connack for reader, writer, connack in clients])
+            self.assertEqual([10] * 5, [len(broker.connections()) for broker in brokers])
+
+            for broker in brokers:
+                await broker.stop()
+
+        asyncio.run(scenario())
+
+    def xi_dev_test_publish_qos1_publishAsyncCompletesOnPuback(self):
+        async def scenario():
+            messages = []
+            async with AsyncMockBroker() as broker:
+                broker.on_message = lambda connection, userdata, message: messages.append(message.payload)
+                reader, writer, connack = await connect_client(broker, b"client")
+                connection = broker.connections()[0]
+
+                publish = asyncio.ensure_future(connection.publish_async("topic", "payload", 1))
+                packet = await reader.readexactly(2 + 2 + 5 + 2 + 7)
+                self.assertEqual(PUBLISH | 2, packet[0])
+                self.assertFalse(publish.done())
+
+                mid = struct.unpack("!H", packet[9:11])[0]
+                writer.write(encode_packet(PUBACK, struct.pack("!H", mid)) +
+                             encode_packet(PUBLISH, encode_str16(b"topic") + b"from client"))
+                self.assertEqual((MQTT_ERR_SUCCESS, mid), await asyncio.wait_for(publish, 5))
+
+                writer.write(encode_packet(PINGREQ, b""))
+                self.assertEqual(b"\xd0\x00", await reader.readexactly(2))
+                self.assertEqual([b"from client"], messages)
+
+        asyncio.run(scenario())
+
+    def xi_dev_test_disconnect_coroutineCallback_scheduledOnLoop(self):
+        async def scenario():
+            disconnected = asyncio.Event()
+
+            async def on_client_disconnect(connection, userdata, rc):
+                disconnected.set()
+
+            async with AsyncMockBroker() as broker:
+                broker.on_client_disconnect = on_client_disconnect
+                reader, writer, connack = await connect_client(broker, b"client")
+
+                writer.write(encode_packet(DISCONNECT, b""))
+                await asyncio.wait_for(disconnected.wait(), 5)
+                self.assertEqual(b"", await reader.read())
+                self.assertEqual([], broker.connections())
+
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,100 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_broker_metrics import BrokerMetrics, Histogram
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import encode_packet, encode_str16, \
+    ConnectedBrokerTestCase
+from tools.xi_mock_broker.mqtt_messages import *
+import unittest
+import urllib.error
+import urllib.request
+
+
+class TestBrokerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = BrokerMetrics()
+
+    def xi_dev_test_histogram_observe_cumulativeBuckets(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+
+        self.assertEqual({"buckets": [(1, 2), (10, 3), (float("inf"), 4)], "sum": 56.5, "count": 4},
+                         histogram.snapshot())
+
+    def xi_dev_test_packetsOut_batch_countedPerPacket(self):
+        self.metrics.packets_out([(PUBACK, 1, 4), (PUBREC, 2, 4), (PUBACK, 3, 4)])
+        self.metrics.packet_out(PUBLISH | 2, b"x" * 20)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual({"PUBACK": 2, "PUBREC": 1, "PUBLISH": 1}, snapshot["packets_out"])
+        self.assertEqual({"PUBACK": 8, "PUBREC": 4, "PUBLISH": 20}, snapshot["bytes_out"])
+
+    def xi_dev_test_prometheusText_countersGaugesHistograms(self):
+        self.metrics.gauge_register("inflight_messages", lambda: 3)
+        self.metrics.gauge_register("inflight_messages", lambda: 4)
+        self.metrics.packet_in(PUBLISH | 2, 12, 3e-6)
+        self.metrics.count("retries", 2)
+
+        text = self.metrics.prometheus_text()
+
+        self.assertIn('xi_mock_broker_packets_in_total{command="PUBLISH"} 1\n', text)
+        self.assertIn('xi_mock_broker_bytes_in_total{command="PUBLISH"} 12\n', text)
+        self.assertIn("xi_mock_broker_retries_total 2\n", text)
+        self.assertIn('xi_mock_broker_decode_seconds_bucket{le="2.5e-06"} 0\n', text)
+        self.assertIn('xi_mock_broker_decode_seconds_bucket{le="5e-06"} 1\n', text)
+        self.assertIn('xi_mock_broker_decode_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn("# TYPE xi_mock_broker_inflight_messages gauge\nxi_mock_broker_inflight_messages 7\n", text)
+
+    def xi_dev_test_httpServer_get_metricsServed(self):
+        self.metrics.count("select_wakeups")
+        host, port = self.metrics.http_server_start()
+        try:
+            response = urllib.request.urlopen("http://%s:%d/metrics" % (host, port))
+            self.assertIn("xi_mock_broker_select_wakeups_total 1\n", response.read().decode('utf-8'))
+            self.assertRaises(urllib.error.HTTPError, urllib.request.urlopen, "http://%s:%d/other" % (host, port))
+        finally:
+            self.metrics.http_server_stop()
+
+
+class TestMockBrokerMetrics(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestMockBrokerMetrics, self).setUp()
+        self._connect()
+
+    def _broker_setup(self):
+        self.metrics = BrokerMetrics()
+        self.broker.metrics_set(self.metrics)
+
+    def xi_dev_test_snapshot_trafficOfAClient_packetsBytesAndTimingsCounted(self):
+        publish = encode_packet(PUBLISH | 2, encode_str16(b"t") + b"\x00\x01payload")
+        self.client.sendall(publish + encode_packet(PINGREQ, b""))
+        self.assertEqual(b"\xd0\x00", self.client.recv(2))
+        self.broker.publish("out", b"x", 1)
+        self.assertEqual(8, len(self.client.recv(8)))
+
+        snapshot = self.metrics.snapshot()
+
+        self.assertEqual({"CONNECT": 1, "PUBLISH": 1, "PINGREQ": 1}, snapshot["packets_in"])
+        self.assertEqual(len(publish), snapshot["bytes_in"]["PUBLISH"])
+        self.assertEqual({"CONNACK": 1, "PINGRESP": 1, "PUBLISH": 1}, snapshot["packets_out"])
+        self.assertEqual(3, snapshot["decode_seconds"]["count"])
+        self.assertEqual(1, snapshot["encode_seconds"]["count"])
+        self.assertEqual(1, snapshot["inflight_messages"])
+        self.assertGreater(snapshot["select_wakeups"], 0)
+        self.assertGreater(snapshot["socketpair_wakeups"], 0)
+
+        self.metrics.reset()
+        self.assertEqual({}, self.metrics.snapshot()["packets_in"])
+        self.client.sendall(encode_packet(PUBACK, b"\x00\x01"))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,51 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_control_channel_framing import frame, XiControlChannelDeframer
+import unittest
+
+
+class TestControlChannelDeframer(unittest.TestCase):
+
+    def setUp(self):
+        self.deframer = XiControlChannelDeframer()
+
+    def _feed(self, data):
+        self.deframer.feed(data)
+        return list(self.deframer.messages())
+
+    def xi_dev_test_frame_messageOver127Bytes_twoByteVarintPrefix(self):
+        message = bytes(range(200))
+
+        self.assertEqual(b"\xc8\x01" + message, frame(message))
+        self.assertEqual([message], self._feed(frame(message)))
+
+    def xi_dev_test_messages_severalMessagesInOneChunk_allReturnedInOrder(self):
+        # the second one is empty, its frame is the zero length alone
+        messages = [b"first", b"", b"third"]
+
+        self.assertEqual(messages, self._feed(b"".join(frame(message) for message in messages)))
+        self.assertEqual(0, self.deframer.pending())
+
+    def xi_dev_test_messages_varintSplitAcrossFeeds_messageReturnedWhenComplete(self):
+        data = frame(b"m" * 300)
+
+        self.assertEqual([], self._feed(data[:1]))
+        self.assertEqual([], self._feed(data[1:2]))
+        self.assertEqual([], self._feed(data[2:-1]))
+        self.assertEqual(len(data) - 1, self.deframer.pending())
+        self.assertEqual([b"m" * 300], self._feed(data[-1:]))
+
+    def xi_dev_test_messages_prefixLongerThan10Bytes_valueError(self):
+        self.deframer.feed(b"\xff" * 10 + b"\x01")
+
+        self.assertRaises(ValueError, list, self.deframer.messages())
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,86 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_control_channel_transp_socket import XiControlChannel_transp_socket
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import recv_exactly_from
+import logging
+import socket
+import threading
+import time
+import unittest
+
+
+class _MessageSink(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def handle_message(self, data):
+        self.chunks.append(data)
+
+    def wait_for(self, length):
+        deadline = time.time() + 5
+        while sum(len(chunk) for chunk in self.chunks) < length and time.time() < deadline:
+            time.sleep(0.01)
+        return b"".join(self.chunks)
+
+
+class TestControlChannelSocketTransport(unittest.TestCase):
+
+    def setUp(self):
+        # The transport is the runner side, the driver is a plain socket
+        self.sink = _MessageSink()
+        self.transport = XiControlChannel_transp_socket(self.sink, logging.WARNING)
+        self.transport.create_listensocket()
+        self.driver = socket.create_connection((self.transport.hostaddr, self.transport.port))
+
+    def tearDown(self):
+        self.transport.stop()
+        self.assertTrue(self.transport.join(5))
+        self.driver.close()
+
+    def xi_dev_test_handleMessage_largeCallbackAlreadyArrived_deliveredInOneRead(self):
+        callback = bytes(bytearray(range(256))) * 200
+        self.driver.sendall(callback)
+        self.transport.wait_for_connection()
+
+        self.assertEqual(callback, self.sink.wait_for(len(callback)))
+        self.assertEqual(1, len(self.sink.chunks))
+
+    def xi_dev_test_send_fromAnotherThread_writtenWithoutPolling(self):
+        self.transport.wait_for_connection()
+        latencies = []
+
+        for i in range(5):
+            # Let the socket thread block in select()
+            time.sleep(0.2)
+            sender = threading.Thread(target=self.transport.send, args=(b"api call",))
+            start = time.time()
+            sender.start()
+            self.assertEqual(b"api call", recv_exactly_from(self.driver, 8))
+            latencies.append(time.time() - start)
+            sender.join()
+
+        # The median stays well under the 100 ms the socket thread used to poll at
+        self.assertLess(sorted(latencies)[len(latencies) // 2], 0.05)
+
+    def xi_dev_test_stop_dataQueued_flushedBeforeClose(self):
+        self.transport.wait_for_connection()
+        data = b"x" * 1000000
+
+        self.assertTrue(self.transport.send(data))
+        self.transport.stop()
+
+        self.assertEqual(data, recv_exactly_from(self.driver, len(data)))
+        self.assertEqual(b"", self.driver.recv(1))
+        self.assertTrue(self.transport.join(5))
+        self.assertFalse(self.transport.send(b"late"))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
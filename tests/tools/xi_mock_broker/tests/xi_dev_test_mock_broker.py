@@ -4,13 +4,22 @@ tests_path = realpath(__file__)
 sys.path.append(tests_path)
 sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
 
-from tools.xi_mock_broker.xi_mock_broker import MockBroker
+from tools.xi_mock_broker.xi_mock_broker import MockBroker, OutQueuePolicy
 from tools.xi_mock_broker.xi_basic_broker import BasicBroker
+from tools.xi_mock_broker.xi_retained_store import RetainedMessageStore
+from tools.xi_mock_broker.xi_session_store import SessionStore
 import tools.xi_mock_broker.tests.paho_mqtt_client as paho_client
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import encode_packet, encode_str16, recv_exactly_from, \
+    ConnectedBrokerTestCase
+from tools.xi_mock_broker.mqtt_messages import *
 import tools.xi_utils as xi_utils
+import socket
+import struct
+import threading
 import unittest
 import time
 
+
 class TestBrokerFunctions(unittest.TestCase):
 
     def setUp(self):
@@ -75,6 +84,348 @@ class TestPureBrokerTests(unittest.TestCase):
         self.broker.loop_start()
         self.broker.loop_stop()
 
+class TestBrokerReadPath(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestBrokerReadPath, self).setUp()
+        self._connect()
+
+    def _broker_setup(self):
+        self.messages = []
+        self.broker.on_message = lambda broker, userdata, message: self.messages.append(message.payload)
+
+    def _publish_burst_and_ping(self, count):
+        burst = b"".join(encode_packet(PUBLISH, encode_str16(b"burst") + str(i).encode()) for i in range(count))
+        self.client.sendall(burst + encode_packet(PINGREQ, b""))
+        self.assertEqual(b"\xd0\x00", self.client.recv(2))
+
+    def xi_dev_test_loopRead_burst_manyPacketsPerReadableEvent(self):
+        self._publish_burst_and_ping(200)
+
+        self.assertEqual([str(i).encode() for i in range(200)], self.messages)
+        self.assertGreater(max(self.broker.packets_per_read().keys()), 1)
+
+    def xi_dev_test_loopRead_readBudget_packetsPerReadableEventLimited(self):
+        self.broker.read_budget_set(10)
+        self.broker.packets_per_read_reset()
+
+        self._publish_burst_and_ping(200)
+
+        self.assertEqual(200, len(self.messages))
+        self.assertEqual(10, max(self.broker.packets_per_read().keys()))
+
+
+class TestBrokerWritePath(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestBrokerWritePath, self).setUp()
+        self._connect()
+
+    def _broker_setup(self):
+        self.published_mids = []
+        self.broker.on_publish = lambda broker, userdata, mid: self.published_mids.append(mid)
+
+    def xi_dev_test_loopWrite_partialWrites_allPacketsSentInOrder(self):
+        payloads = [bytearray([i]) * 50000 for i in range(40)]
+        mids = [self.broker.publish("big", payload)[1] for payload in payloads]
+
+        expected = b"".join(encode_packet(PUBLISH, encode_str16(b"big") + bytes(payload)) for payload in payloads)
+        self.assertEqual(expected, self._recv_exactly(len(expected)))
+
+        self.client.sendall(encode_packet(PINGREQ, b""))
+        self.assertEqual(b"\xd0\x00", self._recv_exactly(2))
+        self.assertEqual(mids, self.published_mids)
+
+    def xi_dev_test_inflight_maxInflightReached_queuedMessagesSentOnAck(self):
+        self.broker.max_inflight_messages_set(2)
+        mids = [self.broker.publish("q", bytearray(b"%d" % i), 1)[1] for i in range(4)]
+
+        def expected_publish(i):
+            return encode_packet(PUBLISH | 2, encode_str16(b"q") + struct.pack("!H", mids[i]) + b"%d" % i)
+
+        self.assertEqual(expected_publish(0) + expected_publish(1),
+                         self._recv_exactly(len(expected_publish(0) + expected_publish(1))))
+
+        self.client.sendall(encode_packet(PUBACK, struct.pack("!H", mids[1])))
+        self.assertEqual(expected_publish(2), self._recv_exactly(len(expected_publish(2))))
+
+        self.client.sendall(encode_packet(PUBACK, struct.pack("!H", mids[0])))
+        self.assertEqual(expected_publish(3), self._recv_exactly(len(expected_publish(3))))
+        self.assertEqual([mids[1], mids[0]], self.published_mids)
+
+    def xi_dev_test_publish_midWrapsToUnackedMessage_midSkipped(self):
+        first_mid = self.broker.publish("q", bytearray(b"0"), 1)[1]
+        self.broker._last_mid = 65535
+
+        rc, mid = self.broker.publish("q", bytearray(b"1"), 1)
+
+        self.assertEqual((MQTT_ERR_SUCCESS, first_mid + 1), (rc, mid))
+        self.assertEqual([b"0", b"1"], [bytes(m.payload) for m in self.broker._out_messages.values()])
+
+    def xi_dev_test_publish_allMidsInUse_queueSizeError(self):
+        self.broker.publish("q", bytearray(b"0"), 1)
+        with self.broker._out_message_mutex:
+            for mid in range(1, 65536):
+                self.broker._out_messages.setdefault(mid, None)
+
+        self.assertEqual((MQTT_ERR_QUEUE_SIZE, 0), self.broker.publish("q", bytearray(b"1"), 1))
+        self.assertEqual([(MQTT_ERR_QUEUE_SIZE, 0)], self.broker.publish_many([("q", bytearray(b"2"), 1)]))
+
+    def xi_dev_test_packetQueue_publishManyFromCallback_singleWakeup(self):
+        wakeups = []
+        wake_loop = self.broker._wake_loop
+        self.broker._wake_loop = lambda: wakeups.append(1) or wake_loop()
+        self.broker.on_message = lambda broker, userdata, message: \
+            [broker.publish("reply", bytearray(b"%d" % i)) for i in range(1000)]
+
+        self.client.sendall(encode_packet(PUBLISH, encode_str16(b"trigger")))
+
+        expected = b"".join(encode_packet(PUBLISH, encode_str16(b"reply") + b"%d" % i) for i in range(1000))
+        self.assertEqual(expected, self._recv_exactly(len(expected)))
+        self.assertEqual(1, len(wakeups))
+
+    def xi_dev_test_publishMany_coalesced_singleBufferQueuedInOrder(self):
+        queued = []
+        out_packet_append = self.broker._out_packet_append
+        self.broker._out_packet_append = lambda out_packet: queued.append(out_packet) or out_packet_append(out_packet)
+        self.broker.max_inflight_messages_set(1)
+
+        results = self.broker.publish_many([("a", bytearray(b"0")), ("b", bytearray(b"1"), 1),
+                                            ("c", bytearray(b"2"), 1, False)])
+        mids = [mid for rc, mid in results]
+
+        expected = encode_packet(PUBLISH, encode_str16(b"a") + b"0") + \
+            encode_packet(PUBLISH | 2, encode_str16(b"b") + struct.pack("!H", mids[1]) + b"1")
+        self.assertEqual(expected, self._recv_exactly(len(expected)))
+        self.assertEqual([MQTT_ERR_SUCCESS] * 3, [rc for rc, mid in results])
+        self.assertEqual([[(PUBLISH, mids[0], 6), (PUBLISH | 2, mids[1], 8)]], [packet.batch for packet in queued])
+
+        # The message over the in-flight limit follows on its own
+        self.client.sendall(encode_packet(PUBACK, struct.pack("!H", mids[1])))
+        expected = encode_packet(PUBLISH | 2, encode_str16(b"c") + struct.pack("!H", mids[2]) + b"2")
+        self.assertEqual(expected, self._recv_exactly(len(expected)))
+        self.assertEqual(mids[:2], self.published_mids)
+
+    def xi_dev_test_publishMany_batchNotQueued_inflightSlotsReleased(self):
+        self.broker.max_inflight_messages_set(2)
+        self.broker._packets_queue = lambda packet, batch, qos: MQTT_ERR_NO_CONN
+
+        results = self.broker.publish_many([("a", bytearray(b"0"), 1), ("b", bytearray(b"1"), 2)])
+
+        self.assertEqual([MQTT_ERR_NO_CONN] * 2, [rc for rc, mid in results])
+        self.assertEqual(0, self.broker._inflight_messages)
+        self.assertEqual([mqtt_ms_publish] * 2, [self.broker._out_messages[mid].state for rc, mid in results])
+
+    def xi_dev_test_autoAck_qos1AndQos2Publish_acknowledgedOnArrival(self):
+        self.broker.auto_ack_set(True)
+        messages = []
+        self.broker.on_message = lambda broker, userdata, message: messages.append(message.mid)
+
+        self.client.sendall(encode_packet(PUBLISH | 2, encode_str16(b"a") + b"\x00\x05one") +
+                            encode_packet(PUBLISH | 4, encode_str16(b"a") + b"\x00\x06two"))
+        self.assertEqual(encode_packet(PUBACK, b"\x00\x05") + encode_packet(PUBREC, b"\x00\x06"),
+                         self._recv_exactly(8))
+
+        self.client.sendall(encode_packet(PUBREL | 2, b"\x00\x06"))
+        self.assertEqual(encode_packet(PUBCOMP, b"\x00\x06"), self._recv_exactly(4))
+        self.assertEqual([5, 6], messages)
+
+
+class TestBrokerOutQueueLimits(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestBrokerOutQueueLimits, self).setUp()
+        # A slow client: it does not read while the broker floods it
+        self._connect(rcvbuf=4096)
+
+    @staticmethod
+    def _payload(i):
+        return b"%05d" % i + b"x" * 995
+
+    def _recv_until_pingresp(self):
+        self.client.sendall(encode_packet(PINGREQ, b""))
+        data = bytearray()
+        while not data.endswith(b"\xd0\x00"):
+            chunk = self.client.recv(65536)
+            self.assertTrue(chunk)
+            data.extend(chunk)
+        return bytes(data[:-2])
+
+    def xi_dev_test_publish_floodDropOldest_queueBoundedNewestDelivered(self):
+        self.broker.out_queue_limits_set(100, policy=OutQueuePolicy.DROP_OLDEST_QOS0)
+
+        for i in range(20000):
+            self.broker.publish("flood", self._payload(i))
+            self.assertLessEqual(len(self.broker._out_packet), 100)
+
+        received = self._recv_until_pingresp()
+        publish_length = len(encode_packet(PUBLISH, encode_str16(b"flood") + self._payload(0)))
+        received_ids = [int(received[offset + 10:offset + 15]) for offset in range(0, len(received), publish_length)]
+        self.assertEqual(sorted(set(received_ids)), received_ids)
+        self.assertGreater(received_ids[-1], 19900)
+        stats = self.broker.out_queue_stats()
+        self.assertGreater(stats["dropped_oldest"], 0)
+        self.assertEqual(20000 - stats["dropped_oldest"] - stats["dropped_newest"], len(received_ids))
+
+    def xi_dev_test_publish_floodBlock_publisherWaitsNothingDropped(self):
+        self.broker.out_queue_limits_set(max_bytes=20000, policy=OutQueuePolicy.BLOCK)
+        queue_bytes = []
+
+        def flood():
+            for i in range(5000):
+                self.broker.publish("flood", self._payload(i))
+                queue_bytes.append(self.broker._out_packet_bytes)
+
+        publisher = threading.Thread(target=flood)
+        publisher.start()
+        expected = b"".join(encode_packet(PUBLISH, encode_str16(b"flood") + self._payload(i)) for i in range(5000))
+        time.sleep(0.2)
+        self.assertEqual(expected, recv_exactly_from(self.client, len(expected)))
+        publisher.join()
+
+        self.assertLessEqual(max(queue_bytes), 20000)
+        self.assertGreater(self.broker.out_queue_stats()["blocked"], 0)
+
+    def xi_dev_test_publish_floodDisconnect_slowClientDisconnected(self):
+        disconnects = []
+        self.broker.on_client_disconnect = lambda broker, userdata, rc: disconnects.append(rc)
+        self.broker.out_queue_limits_set(max_bytes=65536, policy=OutQueuePolicy.DISCONNECT)
+
+        results = [self.broker.publish("flood", self._payload(i))[0] for i in range(20000)]
+
+        self.assertIn(MQTT_ERR_QUEUE_SIZE, results)
+        self.assertEqual([MQTT_ERR_QUEUE_SIZE], disconnects)
+        self.assertEqual(1, self.broker.out_queue_stats()["disconnected"])
+        self.assertIsNone(self.broker.socket())
+
+
+class TestBrokerRetainedMessages(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestBrokerRetainedMessages, self).setUp()
+        self._connect()
+
+    def _broker_setup(self):
+        self.broker.retained_store_set(RetainedMessageStore())
+
+    def xi_dev_test_subscribe_wildcard_matchingRetainedMessagesSentAfterSuback(self):
+        self.broker.publish("dev/1/status", "on", 0, True)
+        self.client.sendall(encode_packet(PUBLISH | 2 | 1, encode_str16(b"dev/2/status") + b"\x00\x01off"))
+        self.client.sendall(encode_packet(PUBLISH | 1, encode_str16(b"dev/2/name") + b"two"))
+        expected = encode_packet(PUBLISH | 1, encode_str16(b"dev/1/status") + b"on")
+        self.assertEqual(expected, self._recv_exactly(len(expected)))
+
+        self.client.sendall(encode_packet(SUBSCRIBE | 2, b"\x00\x07" + encode_str16(b"dev/+/status") + b"\x01"))
+
+        suback = encode_packet(SUBACK, b"\x00\x07\x01")
+        retained_1 = encode_packet(PUBLISH | 1, encode_str16(b"dev/1/status") + b"on")
+        retained_2 = encode_packet(PUBLISH | 2 | 1, encode_str16(b"dev/2/status") + b"\x00\x01off")
+        received = self._recv_exactly(len(suback + retained_1 + retained_2))
+        self.assertEqual(suback + retained_1, received[:len(suback + retained_1)])
+        # The message id of the QoS 1 retained message is the broker's
+        self.assertEqual(retained_2[:-5], received[len(suback + retained_1):-5])
+        self.assertEqual(b"off", received[-3:])
+        self.client.sendall(encode_packet(PUBACK, received[-5:-3]))
+
+    def xi_dev_test_subscribe_grantedQosLower_replayNotStoredAgain(self):
+        store = self.broker._retained_store
+        mid = self.broker.publish("dev/1/status", "on", 2, True)[1]
+        publish = encode_packet(PUBLISH | 4 | 1, encode_str16(b"dev/1/status") + struct.pack("!H", mid) + b"on")
+        self.assertEqual(publish, self._recv_exactly(len(publish)))
+
+        self.client.sendall(encode_packet(SUBSCRIBE | 2, b"\x00\x07" + encode_str16(b"dev/1/status") + b"\x00"))
+
+        expected = encode_packet(SUBACK, b"\x00\x07\x00") + \
+            encode_packet(PUBLISH | 1, encode_str16(b"dev/1/status") + b"on")
+        self.assertEqual(expected, self._recv_exactly(len(expected)))
+        self.assertEqual(2, store.get("dev/1/status").qos)
+
+
+class TestBrokerSessions(ConnectedBrokerTestCase):
+
+    _client_id = b"persistent"
+
+    def _broker_setup(self):
+        self.broker.session_store_set(SessionStore())
+
+    def _disconnect(self):
+        self.client.sendall(encode_packet(DISCONNECT, b""))
+        self.client.settimeout(5)
+        self.assertEqual(b"", self.client.recv(1))
+        self.client.close()
+
+    def xi_dev_test_reconnect_persistentSession_unackedMessagesResentWithDup(self):
+        self._connect(0, b"\x20\x02\x00\x00")
+        mid = self.broker.publish("s", bytearray(b"x"), 1)[1]
+        publish = encode_packet(PUBLISH | 2, encode_str16(b"s") + struct.pack("!H", mid) + b"x")
+        self.assertEqual(publish, self._recv_exactly(len(publish)))
+        self._disconnect()
+
+        self._connect(0, b"\x20\x02\x01\x00")
+        publish_dup = encode_packet(PUBLISH | 8 | 2, encode_str16(b"s") + struct.pack("!H", mid) + b"x")
+        self.assertEqual(publish_dup, self._recv_exactly(len(publish_dup)))
+        self.client.sendall(encode_packet(PUBACK, struct.pack("!H", mid)))
+        self._disconnect()
+
+        # The acknowledged message is not sent again, a clean session discards the stored one
+        self._connect(0, b"\x20\x02\x01\x00")
+        self._disconnect()
+        self._connect(CLEAN_SESSION_FLAG, b"\x20\x02\x00\x00")
+        self.client.settimeout(0.2)
+        self.assertRaises(socket.timeout, self.client.recv, 1)
+
+
+class TestBasicBrokerTimers(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestBasicBrokerTimers, self).setUp()
+        self._connect()
+
+    def _broker_new(self):
+        return BasicBroker()
+
+    def _broker_setup(self):
+        self.broker.timer_resolution_set(0.05)
+        self.broker.message_retry_set(0.2)
+
+    def xi_dev_test_retry_noPuback_publishResentWithDupUntilAcked(self):
+        start = time.time()
+        mid = self.broker.publish("r", bytearray(b"x"), 1)[1]
+
+        def expected_publish(dup):
+            return encode_packet(PUBLISH | 2 | (dup << 3), encode_str16(b"r") + struct.pack("!H", mid) + b"x")
+
+        self.assertEqual(expected_publish(0), self._recv_exactly(len(expected_publish(0))))
+        self.assertEqual(expected_publish(1), self._recv_exactly(len(expected_publish(1))))
+        self.assertLess(time.time() - start, 1.0)
+
+        self.client.sendall(encode_packet(PUBACK, struct.pack("!H", mid)))
+        self.client.settimeout(0.5)
+        self.assertRaises(socket.timeout, self.client.recv, 1)
+
+    def xi_dev_test_retry_qos2PublishNoPubrel_pubrecResentUntilReleased(self):
+        self.client.sendall(encode_packet(PUBLISH | 4, encode_str16(b"r") + b"\x00\x05x"))
+
+        pubrec = encode_packet(PUBREC, b"\x00\x05")
+        self.assertEqual(pubrec + pubrec, self._recv_exactly(2 * len(pubrec)))
+
+        self.client.sendall(encode_packet(PUBREL | 2, b"\x00\x05"))
+        self.assertEqual(encode_packet(PUBCOMP, b"\x00\x05"), self._recv_exactly(4))
+        self.client.settimeout(0.5)
+        self.assertRaises(socket.timeout, self.client.recv, 1)
+
+    def xi_dev_test_retry_publishManyNoPuback_publishResentWithDup(self):
+        start = time.time()
+        mid = self.broker.publish_many([("r", bytearray(b"x"), 1)])[0][1]
+
+        def expected_publish(dup):
+            return encode_packet(PUBLISH | 2 | (dup << 3), encode_str16(b"r") + struct.pack("!H", mid) + b"x")
+
+        self.assertEqual(expected_publish(0), self._recv_exactly(len(expected_publish(0))))
+        self.assertEqual(expected_publish(1), self._recv_exactly(len(expected_publish(1))))
+        self.assertLess(time.time() - start, 1.0)
+
+
 if __name__ == "__main__":
     # unittest.main()
     loader = unittest.TestLoader()
@@ -0,0 +1,137 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec
+from tools.xi_mock_broker.mqtt_messages import *
+import socket
+import unittest
+
+
+class TestBufferedDecoding(unittest.TestCase):
+
+    def setUp(self):
+        self.sock_sut, self.sock_peer = socket.socketpair()
+        self.sock_sut.setblocking(0)
+        self.decoded_packets = []
+        self.codec = MQTTCodec(self.sock_sut, None, 64)
+        self.codec.on_packet_decoded = self._on_packet_decoded
+
+    def tearDown(self):
+        self.sock_sut.close()
+        self.sock_peer.close()
+
+    def _on_packet_decoded(self, packet):
+        self.decoded_packets.append((packet.command, packet.remaining_length, bytes(packet.packet)))
+        return MQTT_ERR_SUCCESS
+
+    def xi_dev_test_decode_gluedPackets_allDecodedAtOnce(self):
+        self.sock_peer.sendall(b"\xc0\x00" + b"\x40\x02\x00\x01" + b"\x30\x05\x00\x01ab!")
+
+        self.assertEqual(MQTT_ERR_AGAIN, self.codec.decode_packet())
+        self.assertEqual([(PINGREQ, 0, b""), (PUBACK, 2, b"\x00\x01"), (PUBLISH, 5, b"\x00\x01ab!")],
+                         self.decoded_packets)
+
+    def xi_dev_test_decode_splitPacket_decodedWhenComplete(self):
+        self.sock_peer.sendall(b"\x30\x05\x00")
+        self.assertEqual(MQTT_ERR_AGAIN, self.codec.decode_packet())
+        self.assertEqual([], self.decoded_packets)
+
+        self.sock_peer.sendall(b"\x01ab!\xc0")
+        self.assertEqual(MQTT_ERR_AGAIN, self.codec.decode_packet())
+        self.assertEqual([(PUBLISH, 5, b"\x00\x01ab!")], self.decoded_packets)
+
+        self.sock_peer.sendall(b"\x00")
+        self.assertEqual(MQTT_ERR_AGAIN, self.codec.decode_packet())
+        self.assertEqual((PINGREQ, 0, b""), self.decoded_packets[-1])
+
+    def xi_dev_test_decode_packetLargerThanBuffer_decoded(self):
+        payload = bytes(range(256)) * 4
+        remaining_length = 2 + 1 + len(payload)
+        packet = b"\x30" + bytes([(remaining_length & 127) | 128, remaining_length >> 7]) + b"\x00\x01t" + payload
+        self.sock_peer.sendall(packet + b"\xc0\x00")
+
+        while len(self.decoded_packets) < 2:
+            self.assertEqual(MQTT_ERR_AGAIN, self.codec.decode_packet())
+
+        self.assertEqual((PUBLISH, remaining_length, b"\x00\x01t" + payload), self.decoded_packets[0])
+        self.assertEqual((PINGREQ, 0, b""), self.decoded_packets[1])
+
+    def xi_dev_test_decode_acksEncodedByHandler_sentTogetherInOrder(self):
+        encoded_packets = []
+        batches = []
+        self.codec.on_packet_encoded = lambda command, packet, mid, qos: \
+            encoded_packets.append(bytes(packet)) or MQTT_ERR_SUCCESS
+        self.codec.on_packets_encoded = lambda packet, batch, qos: \
+            encoded_packets.append(bytes(packet)) or batches.append(batch) or MQTT_ERR_SUCCESS
+        self.codec.on_packet_decoded = lambda packet: \
+            self.codec.encode_pingresp() if packet.command == PINGREQ else self.codec.encode_puback(packet.packet[3])
+        self.sock_peer.sendall(b"\x32\x04\x00\x00\x00\x01" + b"\x32\x04\x00\x00\x00\x02" + b"\xc0\x00" +
+                               b"\x32\x04\x00\x00\x00\x03")
+
+        self.assertEqual(MQTT_ERR_AGAIN, self.codec.decode_packet())
+        self.assertEqual([b"\x40\x02\x00\x01\x40\x02\x00\x02", b"\xd0\x00", b"\x40\x02\x00\x03"], encoded_packets)
+        self.assertEqual([[(PUBACK, 1, 4), (PUBACK, 2, 4)], [(PUBACK, 3, 4)]], batches)
+
+        self.codec.encode_puback(4)
+        self.assertEqual(b"\x40\x02\x00\x04", encoded_packets[-1])
+
+    def xi_dev_test_decode_tooLongRemainingLength_protocolError(self):
+        self.sock_peer.sendall(b"\x30\xff\xff\xff\xff\x01")
+        self.assertEqual(MQTT_ERR_PROTOCOL, self.codec.decode_packet())
+
+    def xi_dev_test_decode_peerClosed_connectionLost(self):
+        self.sock_peer.close()
+        self.assertEqual(1, self.codec.decode_packet())
+
+
+class TestPublishDecoding(unittest.TestCase):
+
+    def xi_dev_test_decodePublish_qos1_payloadIsViewOfPacket(self):
+        packet = bytearray(b"\x00\x03a/b\x12\x34" + bytes(range(256)))
+
+        topic, mid, payload = MQTTCodec.decode_publish_packet(packet, 1)
+
+        self.assertEqual((b"a/b", 0x1234, bytes(range(256))), (topic, mid, payload.tobytes()))
+        packet[7] = 0xff
+        self.assertEqual(0xff, payload[0])
+
+    def xi_dev_test_decodePublish_qos0_noPacketId(self):
+        topic, mid, payload = MQTTCodec.decode_publish_packet(b"\x00\x01t\x12\x34", 0)
+
+        self.assertEqual((b"t", 0, b"\x12\x34"), (topic, mid, payload.tobytes()))
+
+    def xi_dev_test_decodePublish_truncatedHeader_noTopic(self):
+        self.assertEqual((None, 0, None), MQTTCodec.decode_publish_packet(b"\x00\x05a/b", 0))
+        self.assertEqual((None, 0, None), MQTTCodec.decode_publish_packet(b"\x00\x01t\x00", 1))
+
+
+class TestLogLevel(unittest.TestCase):
+
+    def setUp(self):
+        self.log_messages = []
+        self.codec = MQTTCodec(None, None)
+        self.codec.on_log = lambda codec, userdata, level, message: self.log_messages.append((level, message))
+        self.codec.on_packet_encoded = lambda command, packet, mid, qos: MQTT_ERR_SUCCESS
+
+    def xi_dev_test_logLevel_default_debugMessagesFormatted(self):
+        self.codec.encode_publish(5, "a/b", "payload", 1)
+
+        self.assertEqual([(MQTT_LOG_DEBUG, "Sending PUBLISH (dFalse, q1, r0, m5, 'a/b', ... (7 bytes)")], self.log_messages)
+
+    def xi_dev_test_logLevel_info_debugMessagesDropped(self):
+        self.codec.log_level_set(MQTT_LOG_INFO)
+        self.codec.encode_publish(5, "a/b", "payload", 1)
+
+        self.assertEqual([], self.log_messages)
+
+    def xi_dev_test_logLevel_invalidLevel_valueError(self):
+        self.assertRaises(ValueError, self.codec.log_level_set, 0x20)
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,160 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_multi_client_broker import MultiClientMockBroker
+from tools.xi_mock_broker.xi_session_store import SessionStore
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import encode_packet, encode_str16, encode_connect
+from tools.xi_mock_broker.mqtt_messages import *
+import tools.xi_utils as xi_utils
+import socket
+import unittest
+import time
+
+
+class _MultiClientBrokerTestCase(unittest.TestCase):
+    """A multi-client broker running its network thread and the raw socket clients connected by _connect_clients().
+    Subclasses set the broker up before its loop starts in _broker_setup()."""
+
+    def setUp(self):
+        self.broker = MultiClientMockBroker()
+        self.broker.on_log = xi_utils.basic_console_log
+        self.broker.log_level_set(MQTT_LOG_INFO)
+        self._broker_setup()
+        self.broker.loop_start()
+        self.clients = []
+
+    def _broker_setup(self):
+        pass
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.broker.loop_stop()
+
+    def _connect_clients(self, count):
+        for i in range(count):
+            client = socket.create_connection(self.broker.bind_address)
+            client.sendall(encode_connect(("client %d" % i).encode()))
+            self.assertEqual(b"\x20\x02\x00\x00", client.recv(4))
+            self.clients.append(client)
+
+
+class TestMultiClientBroker(_MultiClientBrokerTestCase):
+
+    def xi_dev_test_connect_manyClients_allServedByOneThread(self):
+        self._connect_clients(50)
+
+        self.assertEqual(50, len(self.broker.connections()))
+
+    def xi_dev_test_publish_perConnection_callbackGetsConnectionHandle(self):
+        received = {}
+        self.broker.on_message = lambda connection, userdata, message: \
+            received.setdefault(connection.client_address, []).append(message.payload)
+        self._connect_clients(3)
+
+        for i, client in enumerate(self.clients):
+            client.sendall(encode_packet(PUBLISH, encode_str16(b"topic") + str(i).encode()) + encode_packet(PINGREQ, b""))
+            self.assertEqual(b"\xd0\x00", client.recv(2))
+
+        expected = dict((client.getsockname(), [str(i).encode()]) for i, client in enumerate(self.clients))
+        self.assertEqual(expected, received)
+
+    def xi_dev_test_publish_fromBroker_deliveredToThatClientOnly(self):
+        self._connect_clients(2)
+        connection = [c for c in self.broker.connections() if c.client_address == self.clients[1].getsockname()][0]
+
+        connection.publish("topic", "payload")
+
+        self.assertEqual(encode_packet(PUBLISH, encode_str16(b"topic") + b"payload"), self.clients[1].recv(100))
+        self.clients[0].setblocking(0)
+        self.assertRaises(socket.error, self.clients[0].recv, 100)
+
+    def xi_dev_test_disconnect_clientCloses_connectionRemoved(self):
+        disconnected = []
+        self.broker.on_client_disconnect = lambda connection, userdata, rc: disconnected.append(rc)
+        self._connect_clients(2)
+
+        self.clients[0].sendall(encode_packet(DISCONNECT, b""))
+        self.clients[1].close()
+        self.clients = [self.clients[0]]
+
+        deadline = time.time() + 5
+        while len(self.broker.connections()) > 0 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(0, len(self.broker.connections()))
+        self.assertEqual([MQTT_ERR_SUCCESS, 1], sorted(disconnected))
+
+
+class TestMultiClientBrokerRouting(_MultiClientBrokerTestCase):
+
+    def setUp(self):
+        super(TestMultiClientBrokerRouting, self).setUp()
+        self._connect_clients(3)
+
+    def _broker_setup(self):
+        self.broker.routing_set()
+
+    def _subscribe(self, client, sub, qos):
+        client.sendall(encode_packet(SUBSCRIBE | 2, b"\x00\x01" + encode_str16(sub) + bytes([qos])))
+        self.assertEqual(encode_packet(SUBACK, b"\x00\x01" + bytes([qos])), client.recv(5))
+
+    def xi_dev_test_publish_matchingSubscribers_fannedOutAtGrantedQos(self):
+        self._subscribe(self.clients[0], b"dev/+/status", 0)
+        self._subscribe(self.clients[1], b"dev/#", 1)
+        self._subscribe(self.clients[2], b"other", 0)
+
+        self.clients[2].sendall(encode_packet(PUBLISH | 2, encode_str16(b"dev/7/status") + b"\x00\x09on"))
+
+        self.assertEqual(encode_packet(PUBLISH, encode_str16(b"dev/7/status") + b"on"), self.clients[0].recv(100))
+        qos1_publish = self.clients[1].recv(100)
+        self.assertEqual(encode_packet(PUBLISH | 2, encode_str16(b"dev/7/status") + b"\x00\x00on")[:16],
+                         qos1_publish[:16])
+        self.assertEqual(b"on", qos1_publish[18:])
+        self.clients[1].sendall(encode_packet(PUBACK, qos1_publish[16:18]))
+        self.clients[2].setblocking(0)
+        self.assertRaises(socket.error, self.clients[2].recv, 100)
+
+    def xi_dev_test_publish_afterUnsubscribe_notDelivered(self):
+        self._subscribe(self.clients[0], b"t", 0)
+        self._subscribe(self.clients[1], b"t", 0)
+        self.clients[1].sendall(encode_packet(UNSUBSCRIBE | 2, b"\x00\x02" + encode_str16(b"t")))
+        self.assertEqual(encode_packet(UNSUBACK, b"\x00\x02"), self.clients[1].recv(4))
+
+        self.clients[2].sendall(encode_packet(PUBLISH, encode_str16(b"t") + b"x"))
+
+        self.assertEqual(encode_packet(PUBLISH, encode_str16(b"t") + b"x"), self.clients[0].recv(100))
+        self.clients[1].setblocking(0)
+        self.assertRaises(socket.error, self.clients[1].recv, 100)
+
+    def xi_dev_test_publish_subscriberOffline_queuedInSessionAndSentOnReconnect(self):
+        self.broker.session_store_set(SessionStore())
+        client = socket.create_connection(self.broker.bind_address)
+        client.sendall(encode_connect(b"offline", 0))
+        self.assertEqual(b"\x20\x02\x00\x00", client.recv(4))
+        self._subscribe(client, b"t/#", 1)
+        client.sendall(encode_packet(DISCONNECT, b""))
+        self.assertEqual(b"", client.recv(1))
+        client.close()
+
+        self.clients[0].sendall(encode_packet(PUBLISH | 2, encode_str16(b"t/1") + b"\x00\x01queued"))
+        self.clients[0].sendall(encode_packet(PUBLISH, encode_str16(b"t/2") + b"dropped"))
+        self.clients[0].sendall(encode_packet(PINGREQ, b""))
+        self.assertEqual(b"\xd0\x00", self.clients[0].recv(2))
+
+        client = socket.create_connection(self.broker.bind_address)
+        self.clients.append(client)
+        client.sendall(encode_connect(b"offline", 0))
+        self.assertEqual(b"\x20\x02\x01\x00", client.recv(4))
+        publish = encode_packet(PUBLISH | 2, encode_str16(b"t/1") + b"\x00\x01queued")
+        self.assertEqual(publish, client.recv(len(publish)))
+        client.sendall(encode_packet(PUBACK, b"\x00\x01"))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,83 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_packet_trace import PacketTracer, TRACE_QUEUED, TRACE_WRITTEN, TRACE_DECODED, \
+    TRACE_HANDLED
+from tools.xi_mock_broker.tests.xi_broker_test_helpers import encode_packet, encode_str16, recv_exactly_from, \
+    ConnectedBrokerTestCase
+from tools.xi_mock_broker.mqtt_messages import *
+import json
+import time
+import unittest
+
+
+class TestPacketTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = PacketTracer()
+
+    def xi_dev_test_event_bufferFull_oldestOverwritten(self):
+        self.tracer = PacketTracer(capacity=4)
+        for mid in range(1, 7):
+            self.tracer.event(TRACE_QUEUED, "client", PUBLISH | 2, mid)
+
+        self.assertEqual([3, 4, 5, 6], [event[5] for event in self.tracer.events()])
+
+    def xi_dev_test_chromeTrace_messageOfAnAckBatch_oneSlicePerMessage(self):
+        self.tracer.packet_out(TRACE_QUEUED, "client", PUBLISH | 2, 1)
+        self.tracer.packet_in(TRACE_DECODED, "client", PUBLISH | 2, encode_str16(b"t") + b"\x00\x01")
+        self.tracer.packets_out(TRACE_QUEUED, "client", [(PUBACK, 1, 4), (PUBACK, 2, 4)])
+        self.tracer.mark("on_message_received", "control channel")
+
+        trace = json.loads(json.dumps(self.tracer.chrome_trace()))["traceEvents"]
+
+        self.assertEqual(["client", "control channel"],
+                         [event["args"]["name"] for event in trace if event["ph"] == "M"])
+        self.assertEqual(["PUBLISH queued", "PUBLISH decoded", "PUBACK queued", "PUBACK queued",
+                          "on_message_received"], [event["name"] for event in trace if event["ph"] == "i"])
+        self.assertEqual(["out mid 1", "in mid 1", "in mid 2"],
+                         [event["name"] for event in trace if event["ph"] == "b"])
+        self.assertEqual(["PUBLISH decoded", "PUBACK queued"],
+                         [event["args"]["event"] for event in trace if event["ph"] == "n" and
+                          event["name"] == "in mid 1"])
+
+
+class TestMockBrokerPacketTrace(ConnectedBrokerTestCase):
+
+    def setUp(self):
+        super(TestMockBrokerPacketTrace, self).setUp()
+        self._connect()
+        self.source = "%s:%s" % self.client.getsockname()[:2]
+
+    def _broker_setup(self):
+        self.tracer = PacketTracer()
+        self.broker.packet_tracer_set(self.tracer)
+        self.broker.on_message = lambda broker, userdata, message: broker.send_puback(message.mid)
+
+    def xi_dev_test_messageEvents_qos1RoundTrips_eventsInOrder(self):
+        self.broker.publish("out", b"x", 1)
+        self.assertEqual(b"\x32\x08\x00\x03out\x00\x01x", recv_exactly_from(self.client, 10))
+        self.client.sendall(encode_packet(PUBACK, b"\x00\x01") +
+                            encode_packet(PUBLISH | 2, encode_str16(b"in") + b"\x00\x07payload"))
+        self.assertEqual(b"\x40\x02\x00\x07", recv_exactly_from(self.client, 4))
+
+        # The PUBACK is written after it is received
+        deadline = time.time() + 5
+        while len(self.tracer.message_events(self.source, 7, "in")) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual([TRACE_QUEUED, TRACE_WRITTEN, TRACE_DECODED, TRACE_HANDLED],
+                         [event[2] for event in self.tracer.message_events(self.source, 1, "out")])
+        in_events = self.tracer.message_events(self.source, 7, "in")
+        self.assertEqual((TRACE_DECODED, PUBLISH), (in_events[0][2], in_events[0][4] & 0xF0))
+        self.assertEqual({TRACE_DECODED, TRACE_HANDLED, TRACE_QUEUED, TRACE_WRITTEN},
+                         set(event[2] for event in in_events))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
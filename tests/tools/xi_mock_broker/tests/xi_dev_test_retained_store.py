@@ -0,0 +1,65 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_retained_store import RetainedMessageStore
+import unittest
+
+
+class TestRetainedMessageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RetainedMessageStore()
+
+    def _matched_topics(self, sub):
+        return [message.topic for message in self.store.match(sub)]
+
+    def xi_dev_test_match_wildcardFilters_matchingTopicsReturned(self):
+        for topic in ("a", "a/b", "a/b/c", "a/x/c", "b/b", "$SYS/uptime"):
+            self.store.store(topic, b"retained " + topic.encode())
+
+        self.assertEqual(["a/b/c", "a/x/c"], self._matched_topics("a/+/c"))
+        self.assertEqual(["a", "a/b", "a/b/c", "a/x/c"], self._matched_topics("a/#"))
+        self.assertEqual(["a", "a/b", "a/b/c", "a/x/c", "b/b"], self._matched_topics("#"))
+        self.assertEqual(["$SYS/uptime"], self._matched_topics("$SYS/+"))
+        self.assertEqual(b"retained a/b", self.store.get("a/b").payload)
+
+    def xi_dev_test_store_emptyPayload_retainedMessageRemoved(self):
+        self.store.store("a/b", bytearray(b"on"), 1)
+        self.store.store("a/b", b"")
+
+        self.assertEqual([], self._matched_topics("a/#"))
+        self.assertEqual((0, 0), (len(self.store), self.store.size))
+
+    def xi_dev_test_store_memoryLimitExceeded_leastRecentlyUsedEvicted(self):
+        self.store = RetainedMessageStore(max_bytes=30)
+        for topic in ("d/1", "d/2", "d/3"):
+            self.store.store(topic, b"1234567")  # 10 bytes each
+        self.store.match("d/1")
+
+        self.store.store("d/4", b"1234567")
+
+        self.assertEqual(["d/1", "d/3", "d/4"], self._matched_topics("d/+"))
+        self.assertEqual((1, 30), (self.store.evicted, self.store.size))
+
+    def xi_dev_test_size_nonAsciiTopic_countedInUtf8Bytes(self):
+        self.store.store(u"d/\u00e9t\u00e9", b"1234")
+
+        self.assertEqual(11, self.store.size)
+        self.store.remove(u"d/\u00e9t\u00e9")
+        self.assertEqual(0, self.store.size)
+
+    def xi_dev_test_match_hundredThousandDevices_singleDeviceLookup(self):
+        for i in range(100000):
+            self.store.store("xi/blue/v1/d/device%d/status" % i, b"online", 1)
+
+        self.assertEqual(["xi/blue/v1/d/device4321/status"], self._matched_topics("xi/blue/v1/d/device4321/+"))
+        self.assertEqual(100000, len(self.store.match("xi/blue/v1/d/+/status")))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,113 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_session_store import MQTTSession, SessionStore, SqliteSessionStore
+from tools.xi_mock_broker.mqtt_messages import *
+import os
+import tempfile
+import unittest
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = self._store_create()
+
+    def _store_create(self):
+        return SessionStore()
+
+    def _session(self):
+        session = MQTTSession("client")
+        session.subscriptions["a/+"] = 1
+        session.subscriptions["b/#"] = 2
+        session.message_queue("a/1", b"one", 1)
+        session.message_queue("b/2", b"two", 2).state = mqtt_ms_wait_for_pubcomp
+        incoming = MQTTMessage()
+        incoming.mid = 7
+        incoming.topic = "in"
+        incoming.payload = b"in"
+        incoming.qos = 2
+        incoming.state = mqtt_ms_wait_for_pubrel
+        session.in_messages[7] = incoming
+        return session
+
+    def xi_dev_test_load_savedSession_stateRestored(self):
+        self.store.save(self._session())
+
+        session = self.store.load("client")
+
+        self.assertEqual([("a/+", 1), ("b/#", 2)], list(session.subscriptions.items()))
+        self.assertEqual([(1, "a/1", b"one", 1, mqtt_ms_publish), (2, "b/2", b"two", 2, mqtt_ms_wait_for_pubcomp)],
+                         [(m.mid, m.topic, m.payload, m.qos, m.state) for m in session.out_messages.values()])
+        self.assertEqual([(7, b"in", mqtt_ms_wait_for_pubrel)],
+                         [(m.mid, m.payload, m.state) for m in session.in_messages.values()])
+        self.assertEqual(2, session.last_mid)
+        self.assertIsNone(self.store.load("other"))
+
+    def xi_dev_test_messageQueue_offlineClient_appendedWithNextMid(self):
+        self.assertEqual(0, self.store.message_queue("client", "a/1", b"lost", 1))
+        self.store.save(self._session())
+
+        self.assertEqual(3, self.store.message_queue("client", "a/1", b"three", 1))
+
+        session = self.store.load("client")
+        self.assertEqual([1, 2, 3], list(session.out_messages.keys()))
+        self.assertEqual(b"three", session.out_messages[3].payload)
+        self.store.remove("client")
+        self.assertNotIn("client", self.store)
+
+    def xi_dev_test_messageQueue_midWrapsToUnackedMessage_midSkipped(self):
+        session = self._session()
+        session.last_mid = 65535
+        self.store.save(session)
+
+        self.assertEqual(3, self.store.message_queue("client", "a/1", b"three", 1))
+
+        session = self.store.load("client")
+        self.assertEqual([(1, b"one"), (2, b"two"), (3, b"three")],
+                         [(m.mid, m.payload) for m in session.out_messages.values()])
+
+    def xi_dev_test_messageQueue_allMidsInUse_notQueued(self):
+        session = MQTTSession("client")
+        for i in range(65535):
+            session.message_queue("a/1", b"x", 1)
+        self.store.save(session)
+
+        self.assertEqual(0, self.store.message_queue("client", "a/1", b"lost", 1))
+        self.assertEqual(65535, len(self.store.load("client").out_messages))
+
+
+class TestSqliteSessionStore(TestSessionStore):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        super(TestSqliteSessionStore, self).setUp()
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self._path())
+        os.rmdir(self.directory)
+
+    def _path(self):
+        return os.path.join(self.directory, "sessions.db")
+
+    def _store_create(self):
+        return SqliteSessionStore(self._path())
+
+    def xi_dev_test_load_storeReopened_sessionSurvives(self):
+        self.store.save(self._session())
+        self.store.close()
+
+        self.store = self._store_create()
+
+        self.assertEqual(1, len(self.store))
+        self.assertEqual(b"two", self.store.load("client").out_messages[2].payload)
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
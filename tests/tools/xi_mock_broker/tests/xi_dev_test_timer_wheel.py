@@ -0,0 +1,62 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_timer_wheel import TimerWheel
+import unittest
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(0.5, 8, now=100.0)
+
+    def xi_dev_test_expire_deadlinesPassed_onlyExpiredKeysReturned(self):
+        self.wheel.schedule("a", 100.7)
+        self.wheel.schedule("b", 101.2)
+        self.wheel.schedule("c", 101.3)
+
+        self.assertEqual([], self.wheel.expire(100.6))
+        self.assertEqual(["a", "b"], sorted(self.wheel.expire(101.25)))
+        self.assertEqual([], self.wheel.expire(101.25))
+        self.assertEqual(["c"], self.wheel.expire(101.3))
+        self.assertEqual(0, len(self.wheel))
+
+    def xi_dev_test_expire_deadlineSeveralRoundsAhead_expiredInItsRound(self):
+        # 8 slots of 0.5s are 4 seconds per round
+        self.wheel.schedule("late", 109.0)
+
+        for now in (101.0, 105.0, 108.9):
+            self.assertEqual([], self.wheel.expire(now))
+        self.assertEqual(["late"], self.wheel.expire(109.0))
+
+    def xi_dev_test_schedule_replacedAndCancelled_onlyLatestDeadlineCounts(self):
+        self.wheel.schedule("a", 100.5)
+        self.wheel.schedule("a", 102.0)
+        self.wheel.schedule("b", 100.5)
+        self.wheel.cancel("b")
+
+        self.assertEqual([], self.wheel.expire(101.0))
+        self.assertEqual(["a"], self.wheel.expire(102.0))
+
+    def xi_dev_test_schedule_deadlineInThePast_expiredNextTime(self):
+        self.wheel.expire(103.0)
+        self.wheel.schedule("a", 90.0)
+
+        self.assertEqual(["a"], self.wheel.expire(103.0))
+
+    def xi_dev_test_resolutionSet_pendingDeadlinesKept(self):
+        self.wheel.schedule("a", 100.2)
+        self.wheel.schedule("b", 103.0)
+        self.wheel.resolution_set(0.1)
+
+        self.assertEqual(["a"], self.wheel.expire(100.25))
+        self.assertEqual(["b"], self.wheel.expire(103.0))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
@@ -0,0 +1,68 @@
+import sys
+from os.path import realpath, dirname
+tests_path = realpath(__file__)
+sys.path.append(tests_path)
+sys.path.append(dirname(tests_path) + "/../../..")  # to access 'tools' package
+
+from tools.xi_mock_broker.xi_basic_broker import BasicBroker
+from tools.xi_mock_broker.xi_topic_tree import TopicTree
+import unittest
+
+
+FILTERS = ["#", "+", "+/+", "a", "a/#", "a/+", "a/b", "a/b/c", "a/+/c", "+/b/#", "a/b/#", "/+", "/#", "$SYS/#",
+           "$SYS/+", "+/broker"]
+TOPICS = ["a", "a/b", "a/b/c", "a/x/c", "a/b/c/d", "b", "b/b", "/a", "", "$SYS", "$SYS/broker", "$SYS/a/b",
+          "x/broker"]
+
+
+class TestTopicTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = TopicTree()
+
+    def xi_dev_test_match_wildcardsAndDollarTopics_sameAsTopicMatchesSub(self):
+        for sub in FILTERS:
+            self.tree.add(sub, sub)
+
+        for topic in TOPICS:
+            expected = [sub for sub in FILTERS if BasicBroker.topic_matches_sub(sub, topic)]
+            self.assertEqual(expected, self.tree.match(topic), "topic '%s'" % topic)
+
+    def xi_dev_test_match_emptyLastLevel_matchedByMultiLevelWildcard(self):
+        for sub in FILTERS:
+            self.tree.add(sub, sub)
+
+        self.assertEqual(["#", "+/+", "a/#", "a/+"], self.tree.match("a/"))
+        self.assertEqual(["#", "+/+", "/+", "/#"], self.tree.match("/"))
+
+    def xi_dev_test_add_existingFilter_valueReplacedPositionKept(self):
+        self.tree.add("a/+", 1)
+        self.tree.add("a/b", 2)
+        self.tree.add("a/+", 3)
+
+        self.assertEqual([3, 2], self.tree.match("a/b"))
+        self.assertEqual([("a/+", 3), ("a/b", 2)], list(self.tree))
+
+    def xi_dev_test_remove_lastFilterOfBranch_branchPruned(self):
+        self.tree.add("a/b/c", 1)
+        self.tree.add("a", 2)
+
+        self.assertEqual(1, self.tree.remove("a/b/c"))
+        self.assertIsNone(self.tree.remove("a/b/c"))
+        self.assertEqual([], self.tree.match("a/b/c"))
+        self.assertEqual(["a"], list(self.tree._root.children))
+        self.assertEqual({}, self.tree._root.children["a"].children)
+
+    def xi_dev_test_match_thousandsOfDeviceFilters_onlyMatchingBranchVisited(self):
+        for i in range(10000):
+            self.tree.add("xi/blue/v1/device%d/cmd" % i, i)
+        self.tree.add("xi/blue/v1/+/cmd", "any")
+
+        self.assertEqual([1234, "any"], self.tree.match("xi/blue/v1/device1234/cmd"))
+        self.assertEqual(10001, len(self.tree))
+
+
+if __name__ == "__main__":
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = "xi_dev_test_"
+    unittest.TextTestRunner(verbosity=2).run(loader.loadTestsFromName(__name__))
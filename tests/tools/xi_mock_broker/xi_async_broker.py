@@ -0,0 +1,384 @@
+"""
+This is an MQTT v3.1.1 mock broker running on an asyncio event loop. Many brokers and clients can share one
+event loop, there is no network thread and no wakeup socket.
+"""
+
+import asyncio
+import time
+
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec, MQTT_DECODER_CHUNK_SIZE
+from tools.xi_mock_broker.mqtt_messages import MQTT_ERR_CONN_LOST, MQTT_ERR_NO_CONN, MQTT_ERR_SUCCESS, MQTT_LOG_DEBUG, \
+    MQTT_LOG_INFO, PUBLISH, log_level_mask
+from tools.xi_mock_broker.xi_mock_broker import MockBroker, OutQueuePolicy, HAVE_SSL, cert_reqs, tls_version
+from tools.xi_mock_broker.xi_multi_client_broker import _ServerCallback
+from tools.xi_mock_broker.xi_packet_trace import TRACE_QUEUED, TRACE_WRITTEN
+from tools.xi_mock_broker.xi_subscription_router import SubscriptionRouter
+
+if HAVE_SSL:
+    import ssl
+
+
+class _AsyncServerCallback(_ServerCallback):
+    """Forwards a callback of a connection to the AsyncMockBroker. Callbacks may be coroutine functions, the
+    coroutines they return are scheduled on the event loop."""
+
+    @staticmethod
+    def _invoke(callback, connection, userdata, *args):
+        result = callback(connection, userdata, *args)
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(result)
+        return result
+
+
+class AsyncMockBrokerConnection(MockBroker, asyncio.Protocol):
+    """A single client connection of an AsyncMockBroker.
+
+    It is an asyncio protocol that keeps the per connection state of a MockBroker and offers the same API to
+    respond to the client, e.g. send_connack(), send_suback(), publish() and disconnect(). These calls write
+    to the transport immediately. Awaitable counterparts: drain() waits until the transport accepts more data
+    and publish_async() waits until the message flow of a publish is complete."""
+
+    on_client_connect = _AsyncServerCallback("on_client_connect", False)
+    on_client_disconnect = _AsyncServerCallback("on_client_disconnect", True)
+    on_message = _AsyncServerCallback("on_message", True)
+    on_client_subscribe = _AsyncServerCallback("on_client_subscribe", False)
+    on_client_unsubscribe = _AsyncServerCallback("on_client_unsubscribe", False)
+    on_log = _AsyncServerCallback("on_log", True)
+
+    def __init__(self, server):
+        MockBroker.__init__(self, False)
+        self._server = server
+        self._userdata = server._userdata
+        self._transport = None
+        self._loop = None
+        self.client_address = None
+        self._write_paused = False
+        self._drain_waiters = []
+        self._publish_waiters = {}
+        self._retained_store = server._retained_store
+        self._router = server._router
+        self._auto_ack = server._auto_ack
+        self._session_store = server._session_store
+        self._out_queue_max_messages = server._out_queue_max_messages
+        self._out_queue_max_bytes = server._out_queue_max_bytes
+        self._out_queue_policy = server._out_queue_policy
+        self._out_queue_stats = server._out_queue_stats
+        self._metrics = server._metrics
+        self._tracer = server._tracer
+
+        self._mqtt_codec = MQTTCodec(None, None, MQTT_DECODER_CHUNK_SIZE)
+        self._mqtt_codec.on_packet_decoded = self._packet_handle
+        self._mqtt_codec.on_packet_encoded = self._packet_queue
+        self._mqtt_codec.on_packets_encoded = self._packets_queue
+        self._mqtt_codec.metrics = self._metrics
+        self.log_level_set(server._log_level)
+
+    def __repr__(self):
+        return "AsyncMockBrokerConnection(%s:%s)" % self.client_address[:2]
+
+    @property
+    def on_publish(self):
+        if not self._publish_waiters and self._server.on_publish is None:
+            return None
+        return self._on_publish
+
+    @on_publish.setter
+    def on_publish(self, value):
+        if value is not None:
+            raise AttributeError("Callbacks of a connection must be set on the broker.")
+
+    async def drain(self):
+        """Wait until the transport of the connection is ready to accept more data."""
+        if not self._write_paused:
+            return
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    async def publish_async(self, topic, payload=None, qos=0, retain=False):
+        """Awaitable publish(). Returns the same (result, mid) tuple as publish(), once the message has left the
+        broker (QoS 0) or its handshake is completed (QoS 1 and 2)."""
+        rc, mid = self.publish(topic, payload, qos, retain)
+        if rc != MQTT_ERR_SUCCESS:
+            return rc, mid
+
+        if qos > 0:
+            waiter = self._loop.create_future()
+            self._publish_waiters[mid] = waiter
+            await waiter
+
+        await self.drain()
+        return rc, mid
+
+    # ============================================================
+    # asyncio.Protocol interface
+    # ============================================================
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._loop = asyncio.get_running_loop()
+        self._sock = transport.get_extra_info('socket')
+        self.client_address = transport.get_extra_info('peername')
+        self._trace_source = "%s:%s" % self.client_address[:2]
+        self._server._connections.add(self)
+        self._easy_log(MQTT_LOG_INFO, "connection from " + str(self.client_address))
+
+    def data_received(self, data):
+        self._last_msg_in = time.time()
+        rc = self._mqtt_codec.decode_data(data)
+        if rc:
+            self._loop_rc_handle(rc)
+
+    def eof_received(self):
+        # Close the transport, connection_lost() reports the disconnection
+        return False
+
+    def connection_lost(self, exc):
+        if self._sock is not None:
+            # The client closed the connection without DISCONNECT
+            self._loop_rc_handle(MQTT_ERR_CONN_LOST)
+        self._server._connections.discard(self)
+        self._release_waiters(exc)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._release_waiters(None)
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _on_publish(self, broker, userdata, mid):
+        waiter = self._publish_waiters.pop(mid, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(mid)
+        if self._server.on_publish is not None:
+            _AsyncServerCallback._invoke(self._server.on_publish, self, userdata, mid)
+
+    def _release_waiters(self, exc):
+        # Wakes up the drain() waiters. If the connection is closing, publish_async() waiters are woken up too.
+        waiters = self._drain_waiters
+        self._drain_waiters = []
+        if self._transport.is_closing():
+            waiters.extend(self._publish_waiters.values())
+            self._publish_waiters = {}
+            if exc is None:
+                exc = ConnectionResetError("Connection lost")
+
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    def _packet_queue(self, command, packet, mid, qos):
+        if self._transport is None or self._transport.is_closing():
+            return MQTT_ERR_NO_CONN
+
+        if self._metrics is not None:
+            self._metrics.packet_out(command, packet)
+        if self._tracer is not None:
+            self._tracer.packet_out(TRACE_QUEUED, self._trace_source, command, mid)
+        self._transport.write(packet)
+        if self._tracer is not None:
+            self._tracer.packet_out(TRACE_WRITTEN, self._trace_source, command, mid)
+        self._last_msg_out = time.time()
+
+        if (command & 0xF0) == PUBLISH and qos == 0 and self.on_publish:
+            self.on_publish(self, self._userdata, mid)
+
+        return MQTT_ERR_SUCCESS
+
+    def _out_packet_append(self, out_packet):
+        # The batches of MockBroker._packets_queue(), _packet_queue() writes the other packets itself
+        if self._transport is None or self._transport.is_closing():
+            return MQTT_ERR_NO_CONN
+
+        self._transport.write(out_packet.packet)
+        self._last_msg_out = time.time()
+        self._batch_written(out_packet)
+        return MQTT_ERR_SUCCESS
+
+    def _out_queue_size(self):
+        queued_bytes = self._transport.get_write_buffer_size() if self._transport is not None else 0
+        with self._out_message_mutex:
+            return len(self._out_messages_queued), queued_bytes
+
+    def _close_client_socket(self):
+        self._sock = None
+        if self._transport is not None:
+            self._transport.close()
+        self._session_end()
+
+
+class AsyncMockBroker(object):
+    """MQTT version 3.1/3.1.1 mock server built on asyncio.
+
+    The callbacks are those of MultiClientMockBroker: they are set on the broker and their first argument is
+    the connection handle (an AsyncMockBrokerConnection) of the client. Callbacks may also be coroutine
+    functions.
+
+    Usage:
+
+        broker = AsyncMockBroker()
+        broker.on_client_connect = lambda connection, userdata, connect_options: \\
+            connection.send_connack(CONNACK_ACCEPTED)
+        await broker.start()
+        ... connect clients to broker.bind_address ...
+        await broker.stop()
+    """
+
+    def __init__(self):
+        self._userdata = "[ AsyncMockBroker ]"
+        self._host = "localhost"
+        self.bind_address = ""
+        self._server = None
+        self._connections = set()
+        self._ssl_context = None
+        self._retained_store = None
+        self._router = None
+        self._auto_ack = False
+        self._session_store = None
+        self._out_queue_max_messages = 0
+        self._out_queue_max_bytes = 0
+        self._out_queue_policy = OutQueuePolicy.BLOCK
+        # Shared by the connections
+        self._out_queue_stats = MockBroker._out_queue_stats_new()
+        self._metrics = None
+        self._tracer = None
+
+        self.on_client_connect = None
+        self.on_client_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+        self.on_client_subscribe = None
+        self.on_client_unsubscribe = None
+        self.on_log = None
+        self._log_level = MQTT_LOG_DEBUG
+        self._log_mask = log_level_mask(MQTT_LOG_DEBUG)
+
+    def setup_tls(self, certfile, keyfile=None, ca_certs=None, cert_reqs=cert_reqs, tls_version=tls_version, ciphers=None):
+        """Configure network encryption of the client connections. See MockBroker.setup_tls()."""
+        if HAVE_SSL is False:
+            raise ValueError('This platform has no SSL/TLS.')
+
+        if certfile is None:
+            raise ValueError('SSL cert file must not be None.')
+
+        context = ssl.SSLContext(tls_version)
+        context.load_cert_chain(certfile, keyfile)
+        if ca_certs is not None:
+            context.load_verify_locations(ca_certs)
+        context.verify_mode = cert_reqs
+        if ciphers is not None:
+            context.set_ciphers(ciphers)
+        self._ssl_context = context
+
+    def retained_store_set(self, store):
+        """Set the retained message store of new connections, the connections share it. See
+        MockBroker.retained_store_set()."""
+        self._retained_store = store
+
+    def routing_set(self, enabled=True):
+        """Turn the routing mode on or off. See MultiClientMockBroker.routing_set()."""
+        self._router = SubscriptionRouter() if enabled else None
+
+    def auto_ack_set(self, enabled=True):
+        """Acknowledge the QoS>0 messages of new connections as they arrive. See MockBroker.auto_ack_set()."""
+        self._auto_ack = enabled
+
+    def metrics_set(self, metrics):
+        """Update metrics, a BrokerMetrics, with the packets, bytes and timings
+        of all the connections. There is no network loop, so the wakeup
+        counters stay zero. The inflight_messages and queued_messages gauges
+        add up the connections, the connections gauge is their number. Set it
+        before the clients connect."""
+        self._metrics = metrics
+        if metrics is not None:
+            metrics.gauge_register("connections", lambda: len(self._connections))
+            metrics.gauge_register("inflight_messages", lambda: sum(
+                connection._inflight_messages for connection in list(self._connections)))
+            metrics.gauge_register("queued_messages", lambda: sum(
+                len(connection._out_messages_queued) for connection in list(self._connections)))
+
+    def packet_tracer_set(self, tracer):
+        """Record the packets of all the connections in tracer, a
+        PacketTracer. See MockBroker.packet_tracer_set(). A packet is written
+        when it is passed to the transport, so its TRACE_WRITTEN event follows
+        TRACE_QUEUED immediately. Set it before the clients connect."""
+        self._tracer = tracer
+
+    def out_queue_limits_set(self, max_messages=0, max_bytes=0, policy=OutQueuePolicy.BLOCK):
+        """Set the outbound queue limits of new connections. See
+        MockBroker.out_queue_limits_set(). The queued bytes are those of the
+        transport write buffer, so DROP_OLDEST_QOS0 finds no packet to drop and
+        drops the new message. BLOCK never waits on the event loop, use
+        publish_async() and drain() to wait for the client."""
+        if max_messages < 0 or max_bytes < 0:
+            raise ValueError('Invalid out queue limit.')
+
+        self._out_queue_max_messages = max_messages
+        self._out_queue_max_bytes = max_bytes
+        self._out_queue_policy = policy
+
+    def out_queue_stats(self):
+        """Return the out queue counters of all the connections. See MockBroker.out_queue_stats()."""
+        return self._out_queue_stats.snapshot()
+
+    def out_queue_stats_reset(self):
+        self._out_queue_stats.reset()
+
+    def session_store_set(self, store):
+        """Set the session store of new connections, the connections share it. See
+        MultiClientMockBroker.session_store_set()."""
+        self._session_store = store
+
+    def log_level_set(self, log_level):
+        """Set the least severe log level of the broker and of new connections. See MockBroker.log_level_set()."""
+        self._log_mask = log_level_mask(log_level)
+        self._log_level = log_level
+
+    def connections(self):
+        """Return the list of the currently connected clients."""
+        return list(self._connections)
+
+    async def start(self):
+        """Start listening on a free port of localhost. The address is available in bind_address."""
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: AsyncMockBrokerConnection(self), self._host, 0,
+                                                ssl=self._ssl_context)
+        self.bind_address = self._server.sockets[0].getsockname()[:2]
+        self._easy_log(MQTT_LOG_INFO, "starting up AsyncMockBroker on %s port %s" % self.bind_address)
+
+    async def stop(self):
+        """Stop listening and close all the client connections."""
+        if self._server is None:
+            return
+
+        self._server.close()
+        for connection in self.connections():
+            connection._close_client_socket()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _easy_log(self, log_level, message, *args):
+        if self.on_log and (log_level & self._log_mask):
+            if args:
+                message = message % args
+            self.on_log(self, self._userdata, log_level, message)
@@ -9,6 +9,13 @@ sys.path.append(dirname(tests_path) + "/../..")  # to access 'tools' package
 from tools.xi_mock_broker.mqtt_messages import MQTT_ERR_SUCCESS, MQTT_ERR_CONN_LOST, MQTT_LOG_WARNING
 from tools.xi_mock_broker.xi_mock_broker import MockBroker, MQTTConnectionState, mqtt_ms_wait_for_puback, \
     mqtt_ms_wait_for_pubcomp, mqtt_ms_wait_for_pubrec, mqtt_ms_wait_for_pubrel
+from tools.xi_mock_broker.xi_timer_wheel import TimerWheel
+from tools.xi_mock_broker.xi_topic_tree import TopicTree
+
+# Keys of the broker's timers. The retry timer of a message is keyed by the direction and the message id.
+_TIMER_KEEP_ALIVE = "keep-alive"
+_TIMER_OUT_MESSAGE = "out"
+_TIMER_IN_MESSAGE = "in"
 
 
 # The basic broker has the following abilities:
@@ -16,23 +23,27 @@ from tools.xi_mock_broker.xi_mock_broker import MockBroker, MQTTConnectionState,
 #   * it accepts all subscribe attempts
 #   * it responds to each ping request immediately
 #   * it disconnects the client, if its keep-alive timer expires
+#   * it resends the unacknowledged QoS>0 messages after the retry timeout
+#
+# The keep-alive and retry deadlines are kept in a timer wheel, a tick of the network loop only handles the
+# expired ones.
 class BasicBroker(MockBroker):
-    def __init__(self):
-        super(BasicBroker, self).__init__()
+    def __init__(self, use_websocket=False):
+        super(BasicBroker, self).__init__(use_websocket)
         self._userdata = "Basic Broker"
         self._message_retry = 20
-        self._last_retry_check = 0
-        self.on_message_filtered = []
+        self._timers = TimerWheel()
+        # Topic specific callbacks, see message_callback_add()
+        self.on_message_filtered = TopicTree()
 
     def _handle_on_message(self, message):
         self._callback_mutex.acquire()
         matched = False
-        for t in self.on_message_filtered:
-            if self.topic_matches_sub(t[0], message.topic):
-                self._in_callback = True
-                t[1](self, self._userdata, message)
-                self._in_callback = False
-                matched = True
+        for callback in self.on_message_filtered.match(message.topic):
+            self._in_callback = True
+            callback(self, self._userdata, message)
+            self._in_callback = False
+            matched = True
 
         if not matched and self.on_message:
             self._in_callback = True
@@ -49,6 +60,45 @@ class BasicBroker(MockBroker):
 
         self._message_retry = retry
 
+        # Move the timers of the messages already waiting
+        self._message_timers_restart()
+
+    def timer_resolution_set(self, resolution=1.0):
+        """Set the granularity of the keep-alive and retry timers in seconds. The
+        network loop wakes up at least this often. 1 second by default, use a
+        shorter one with sub-second retry timeouts."""
+        self._timers.resolution_set(resolution)
+
+    def loop(self, timeout=1.0, max_packets=1):
+        """See MockBroker.loop(). The timeout is at most the timer resolution."""
+        return super(BasicBroker, self).loop(min(timeout, self._timers.resolution), max_packets)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """See MockBroker.publish(). Messages with QoS>0 are resent after the
+        retry timeout until they are acknowledged."""
+        return super(BasicBroker, self).publish(topic, payload, qos, retain)
+
+    def _publish(self, topic, local_payload, qos, retain):
+        rc, mid = super(BasicBroker, self)._publish(topic, local_payload, qos, retain)
+        if qos > 0:
+            with self._out_message_mutex:
+                message = self._out_messages.get(mid)
+                if message is not None:
+                    self._message_timer_start(_TIMER_OUT_MESSAGE, message, time.time())
+        return rc, mid
+
+    def publish_many(self, messages, coalesce=True):
+        """See MockBroker.publish_many(). Messages with QoS>0 are resent after
+        the retry timeout until they are acknowledged."""
+        results = super(BasicBroker, self).publish_many(messages, coalesce)
+        now = time.time()
+        with self._out_message_mutex:
+            for rc, mid in results:
+                message = self._out_messages.get(mid)
+                if message is not None and message.qos > 0:
+                    self._message_timer_start(_TIMER_OUT_MESSAGE, message, now)
+        return results
+
     def loop_misc(self):
         """Process miscellaneous network events. Use in place of calling loop() if you
         wish to call select() or equivalent on.
@@ -59,14 +109,12 @@ class BasicBroker(MockBroker):
             return ret
 
         now = time.time()
-
-        if not self._check_keep_alive():
-            return MQTT_ERR_CONN_LOST
-
-        if self._last_retry_check + 1 < now:
-            # Only check once a second at most
-            self._message_retry_check()
-            self._last_retry_check = now
+        for key in self._timers.expire(now):
+            if key == _TIMER_KEEP_ALIVE:
+                if not self._check_keep_alive():
+                    return MQTT_ERR_CONN_LOST
+            else:
+                self._message_retry_check(key, now)
 
         return MQTT_ERR_SUCCESS
 
@@ -85,14 +133,7 @@ class BasicBroker(MockBroker):
             raise ValueError("sub and callback must both be defined.")
 
         self._callback_mutex.acquire()
-
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered[i] = (sub, callback)
-                self._callback_mutex.release()
-                return
-
-        self.on_message_filtered.append((sub, callback))
+        self.on_message_filtered.add(sub, callback)
         self._callback_mutex.release()
 
     def message_callback_remove(self, sub):
@@ -102,11 +143,7 @@ class BasicBroker(MockBroker):
             raise ValueError("sub must defined.")
 
         self._callback_mutex.acquire()
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered.pop(i)
-                self._callback_mutex.release()
-                return
+        self.on_message_filtered.remove(sub)
         self._callback_mutex.release()
 
     @staticmethod
@@ -178,13 +215,35 @@ class BasicBroker(MockBroker):
     # Private functions
     # ============================================================
 
+    def _handle_connect(self):
+        rc = super(BasicBroker, self)._handle_connect()
+        self._keep_alive_timer_start()
+        return rc
+
+    def _in_message_stored(self, message):
+        self._message_timer_start(_TIMER_IN_MESSAGE, message, time.time())
+
+    def _keep_alive_timer_start(self):
+        # A zero keep-alive turns the mechanism off
+        if self._keep_alive > 0:
+            with self._msgtime_mutex:
+                last_msg_in = self._last_msg_in
+            self._timers.schedule(_TIMER_KEEP_ALIVE, last_msg_in + self._keep_alive * 1.5)
+        else:
+            self._timers.cancel(_TIMER_KEEP_ALIVE)
+
     def _check_keep_alive(self):
         now = time.time()
         self._msgtime_mutex.acquire()
         last_msg_in = self._last_msg_in
         self._msgtime_mutex.release()
-        if (self._sock is not None or self._ssl is not None) and (now - last_msg_in >= self._keep_alive * 1.5):
+        if self._sock is None and self._ssl is None:
+            return True
+
+        if now - last_msg_in >= self._keep_alive * 1.5:
             self._easy_log(MQTT_LOG_WARNING, "Client disconnected due to keep-alive timeout!")
+            if self._metrics is not None:
+                self._metrics.count("keep_alive_disconnects")
             self._close_client_socket()
             if self._state == MQTTConnectionState.DISCONNECTING:
                 rc = MQTT_ERR_SUCCESS
@@ -199,32 +258,66 @@ class BasicBroker(MockBroker):
 
             return False
 
-        # Client is still alive
+        # Client is still alive, the timer is restarted from its last message
+        self._keep_alive_timer_start()
         return True
 
-    def _message_retry_check_actual(self, messages, mutex):
-        mutex.acquire()
-        now = time.time()
-        for m in messages:
-            if m.timestamp + self._message_retry < now:
-                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                elif m.state == mqtt_ms_wait_for_pubrel:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrec(m.mid)
-                elif m.state == mqtt_ms_wait_for_pubcomp:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrel(m.mid, True)
-        mutex.release()
+    def _messages_resend(self):
+        super(BasicBroker, self)._messages_resend()
+        # The messages of the resumed session are retried as well
+        self._message_timers_restart()
 
-    def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
-        self._message_retry_check_actual(self._in_messages, self._in_message_mutex)
+    def _message_timers_restart(self):
+        now = time.time()
+        for direction, messages, mutex in self._message_stores():
+            with mutex:
+                for m in messages.values():
+                    self._message_timer_start(direction, m, now)
+
+    def _message_stores(self):
+        return ((_TIMER_OUT_MESSAGE, self._out_messages, self._out_message_mutex),
+                (_TIMER_IN_MESSAGE, self._in_messages, self._in_message_mutex))
+
+    def _message_timer_start(self, direction, message, now):
+        # Messages that are not waiting for an answer (e.g. queued ones) are checked again a retry period later
+        deadline = message.timestamp + self._message_retry
+        if deadline <= now:
+            deadline = now + self._message_retry
+        self._timers.schedule((direction, message.mid), deadline)
+
+    def _message_retry_check(self, key, now):
+        direction, mid = key
+        if direction == _TIMER_OUT_MESSAGE:
+            messages, mutex = self._out_messages, self._out_message_mutex
+        else:
+            messages, mutex = self._in_messages, self._in_message_mutex
 
+        mutex.acquire()
+        m = messages.get(mid)
+        if m is None:
+            # The message flow is complete
+            mutex.release()
+            return
+
+        if m.timestamp + self._message_retry <= now:
+            if self._metrics is not None and m.state in (mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec,
+                                                         mqtt_ms_wait_for_pubrel, mqtt_ms_wait_for_pubcomp):
+                self._metrics.count("retries")
+            if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+                m.timestamp = now
+                m.dup = True
+                self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+            elif m.state == mqtt_ms_wait_for_pubrel:
+                m.timestamp = now
+                m.dup = True
+                self._send_pubrec(m.mid)
+            elif m.state == mqtt_ms_wait_for_pubcomp:
+                m.timestamp = now
+                m.dup = True
+                self._send_pubrel(m.mid, True)
+
+        self._message_timer_start(direction, m, now)
+        mutex.release()
 
 if __name__ == "__main__":
     import tools.xi_utils as xi_utils
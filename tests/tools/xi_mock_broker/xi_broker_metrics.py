@@ -0,0 +1,220 @@
+"""
+Runtime metrics of the mock brokers and their Prometheus text export.
+"""
+
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tools.xi_mock_broker.mqtt_messages import COMMAND_NAMES
+
+# Upper bounds of the duration histogram buckets in seconds, from 1 microsecond to 1 second
+DURATION_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 0.1, 1.0)
+
+_COUNTERS = (
+    ("select_wakeups", "Returns of select() in the network loops."),
+    ("socketpair_wakeups", "Wakeups of the network loops through their socket pair."),
+    ("retries", "QoS>0 messages and PUBRECs/PUBRELs resent after the retry timeout."),
+    ("keep_alive_disconnects", "Clients disconnected because their keep-alive timer expired."))
+
+_PACKET_COUNTERS = (
+    ("packets_in", "Packets received from the clients."),
+    ("bytes_in", "Bytes of the packets received from the clients."),
+    ("packets_out", "Packets queued to the clients."),
+    ("bytes_out", "Bytes of the packets queued to the clients."))
+
+_HISTOGRAMS = (
+    ("decode_seconds", "Time to decode and handle a received packet, callbacks included."),
+    ("encode_seconds", "Time to encode a PUBLISH packet."))
+
+
+class Histogram(object):
+    """Counts observed values in the buckets of a Prometheus histogram. bounds are the upper bounds of the
+    buckets in increasing order, values above the last one only go to the implicit +Inf bucket."""
+
+    def __init__(self, bounds=DURATION_BUCKETS):
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    def snapshot(self):
+        """Return a dictionary with the cumulative "buckets" as a list of (upper bound, count) pairs, the last
+        bound being float("inf"), the "sum" and the "count" of the observed values."""
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + (float("inf"),), self._counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"buckets": buckets, "sum": self._sum, "count": cumulative}
+
+    def reset(self):
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+
+
+class BrokerMetrics(object):
+    """Counters, gauges and histograms of one or more brokers.
+
+    The brokers update the metrics set with their metrics_set() method:
+
+    packets_in, bytes_in, packets_out, bytes_out: counters per command name (e.g. "PUBLISH"). The packets
+      queued together as one buffer (see packets_out()) are counted one by one.
+    decode_seconds, encode_seconds: duration histograms, see DURATION_BUCKETS.
+    select_wakeups, socketpair_wakeups, retries, keep_alive_disconnects: counters.
+    Gauges registered with gauge_register(), e.g. inflight_messages and queued_messages of MockBroker. They are
+      read when a snapshot is taken, the values of the functions registered with the same name are added up.
+
+    snapshot() returns all of them as a dictionary, reset() sets the counters and histograms to zero and
+    prometheus_text() formats them for Prometheus, which http_server_start() serves at /metrics. The metrics are
+    thread safe.
+    """
+
+    def __init__(self, prefix="xi_mock_broker"):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._gauges = {}
+        self._http_server = None
+        self._http_thread = None
+        self.reset()
+
+    def reset(self):
+        """Set the counters and the histograms to zero. Gauges are not affected."""
+        with self._lock:
+            self._counters = dict((name, 0) for name, _ in _COUNTERS)
+            self._packet_counters = dict((name, {}) for name, _ in _PACKET_COUNTERS)
+            self._histograms = dict((name, Histogram()) for name, _ in _HISTOGRAMS)
+
+    def gauge_register(self, name, function):
+        """Register a function without arguments that returns the current value of the gauge name."""
+        with self._lock:
+            self._gauges.setdefault(name, []).append(function)
+
+    def packet_in(self, command, length, seconds):
+        """Count a received packet of length bytes, handled in seconds."""
+        name = COMMAND_NAMES.get(command & 0xF0, "UNKNOWN")
+        with self._lock:
+            packets = self._packet_counters["packets_in"]
+            packets[name] = packets.get(name, 0) + 1
+            counted_bytes = self._packet_counters["bytes_in"]
+            counted_bytes[name] = counted_bytes.get(name, 0) + length
+            self._histograms["decode_seconds"].observe(seconds)
+
+    def packet_out(self, command, packet):
+        """Count a packet queued to a client."""
+        name = COMMAND_NAMES.get(command & 0xF0, "UNKNOWN")
+        with self._lock:
+            packets = self._packet_counters["packets_out"]
+            packets[name] = packets.get(name, 0) + 1
+            counted_bytes = self._packet_counters["bytes_out"]
+            counted_bytes[name] = counted_bytes.get(name, 0) + len(packet)
+
+    def packets_out(self, batch):
+        """Count the packets queued to a client together, batch being their (command, mid, length) list."""
+        with self._lock:
+            packets = self._packet_counters["packets_out"]
+            counted_bytes = self._packet_counters["bytes_out"]
+            for command, mid, length in batch:
+                name = COMMAND_NAMES.get(command & 0xF0, "UNKNOWN")
+                packets[name] = packets.get(name, 0) + 1
+                counted_bytes[name] = counted_bytes.get(name, 0) + length
+
+    def encode_time(self, seconds):
+        with self._lock:
+            self._histograms["encode_seconds"].observe(seconds)
+
+    def count(self, name, value=1):
+        """Add value to the counter name, one of select_wakeups, socketpair_wakeups, retries and
+        keep_alive_disconnects."""
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self):
+        """Return the current values of all the metrics as a dictionary of metric name -> value. Packet
+        counters are dictionaries of command name -> value, histograms are Histogram.snapshot() dictionaries."""
+        with self._lock:
+            snapshot = dict(self._counters)
+            for name, values in self._packet_counters.items():
+                snapshot[name] = dict(values)
+            for name, histogram in self._histograms.items():
+                snapshot[name] = histogram.snapshot()
+            gauges = dict((name, list(functions)) for name, functions in self._gauges.items())
+
+        # The gauge functions take the locks of the brokers, they are called without holding the metrics lock
+        for name, functions in gauges.items():
+            snapshot[name] = sum(function() for function in functions)
+        return snapshot
+
+    def prometheus_text(self):
+        """Return the snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric_header(name, help_text, metric_type):
+            lines.append("# HELP %s_%s %s" % (self._prefix, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (self._prefix, name, metric_type))
+
+        for name, help_text in _PACKET_COUNTERS:
+            metric_header(name + "_total", help_text, "counter")
+            for command, value in sorted(snapshot[name].items()):
+                lines.append('%s_%s_total{command="%s"} %d' % (self._prefix, name, command, value))
+
+        for name, help_text in _COUNTERS:
+            metric_header(name + "_total", help_text, "counter")
+            lines.append("%s_%s_total %d" % (self._prefix, name, snapshot[name]))
+
+        for name, help_text in _HISTOGRAMS:
+            metric_header(name, help_text, "histogram")
+            histogram = snapshot[name]
+            for bound, count in histogram["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_%s_bucket{le="%s"} %d' % (self._prefix, name, le, count))
+            lines.append("%s_%s_sum %r" % (self._prefix, name, histogram["sum"]))
+            lines.append("%s_%s_count %d" % (self._prefix, name, histogram["count"]))
+
+        for name in sorted(self._gauges):
+            metric_header(name, "Gauge %s of the brokers." % name, "gauge")
+            lines.append("%s_%s %d" % (self._prefix, name, snapshot[name]))
+
+        return "\n".join(lines) + "\n"
+
+    def http_server_start(self, port=0, host="localhost"):
+        """Serve prometheus_text() at http://host:port/metrics from a background thread. Port 0 picks a free
+        port. Returns the (host, port) address of the server."""
+        if self._http_server is not None:
+            raise ValueError('The metrics HTTP server is already running.')
+
+        metrics = self
+
+        class _MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._http_server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._http_thread = threading.Thread(target=self._http_server.serve_forever, name="BrokerMetrics HTTP")
+        self._http_thread.daemon = True
+        self._http_thread.start()
+        return self._http_server.server_address[:2]
+
+    def http_server_stop(self):
+        if self._http_server is None:
+            return
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        self._http_thread.join()
+        self._http_server = None
+        self._http_thread = None
@@ -18,15 +18,19 @@ This is an MQTT v3.1.1 fake (mock) broker module, developed from Roger Light's M
 testing purposes.
 """
 
+import collections
 import errno
+import itertools
 import platform
 import select
 import socket
 import traceback
 
 from enum import Enum
-from tools.xi_mock_broker.mqtt_codec import MQTTCodec
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec, MQTTInPacket, MQTT_DECODER_CHUNK_SIZE
 from tools.xi_mock_broker.mqtt_messages import *  # FIXME - don't import everything
+from tools.xi_mock_broker.xi_packet_trace import TRACE_QUEUED, TRACE_WRITTEN, TRACE_DECODED, TRACE_HANDLED
+from tools.xi_mock_broker.xi_session_store import MQTTSession, _mid_next
 from tools.xi_websocketproxy import XiWebSocketProxyServer
 
 HAVE_SSL = True
@@ -53,6 +57,13 @@ if platform.system() == 'Windows':
 else:
     EAGAIN = errno.EAGAIN
 
+# Scatter/gather output is not available on every platform (e.g. Windows)
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Limits of the packets coalesced into a single write
+MQTT_WRITE_MAX_PACKETS = 256
+MQTT_WRITE_MAX_TLS_BYTES = 65536
+
 VERSION_MAJOR = 1
 VERSION_MINOR = 0
 VERSION_REVISION = 0
@@ -67,12 +78,62 @@ class MQTTConnectionState(Enum):
     CONNECT_ASYNC = 3
 
 
+# What publish() does when the outbound queue of the client is full, see out_queue_limits_set()
+class OutQueuePolicy(Enum):
+    BLOCK = 0
+    DROP_OLDEST_QOS0 = 1
+    DROP_NEWEST = 2
+    DISCONNECT = 3
+
+
+class _OutQueueStats(object):
+    """The counters of out_queue_stats(), shared by the connections of a server. The threads calling publish()
+    and the network threads update them, every access takes the lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {"blocked": 0, "dropped_oldest": 0, "dropped_newest": 0, "disconnected": 0}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            for key in self._counters:
+                self._counters[key] = 0
+
+
 if sys.version_info[0] < 3:
     sockpair_data = "0"
 else:
     sockpair_data = b"0"
 
 
+class _OutPacket(object):
+    """An encoded packet in the outbound queue of the broker. 'pos' is the offset of the first unsent byte.
+    Several packets queued together, an acknowledgement batch of MQTTCodec or the coalesced PUBLISH packets of
+    publish_many(), are a single entry: 'batch' lists the (command, mid, length) of its packets."""
+    __slots__ = ('command', 'mid', 'qos', 'pos', 'to_process', 'packet', 'batch')
+
+    def __init__(self, command, mid, qos, packet, batch=None):
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.pos = 0
+        self.to_process = len(packet)
+        self.packet = packet
+        self.batch = batch
+
+    def __repr__(self):
+        return "_OutPacket(command=%s, mid=%s, qos=%s, pos=%s, to_process=%s)" % \
+            (self.command, self.mid, self.qos, self.pos, self.to_process)
+
+
 def _socketpair_compat():
     """TCP/IP socketpair including Windows support"""
     listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_IP)
@@ -179,23 +240,21 @@ class MockBroker(object):
         self._keep_alive = 0
         self._userdata = "[ MockBroker ]"
 
-        self._decoded_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
-        self._out_packet = []
-        self._current_out_packet = None
+        self._decoded_packet = MQTTInPacket()
+        # The first packet of the queue is the one being written. The queue is guarded by _out_packet_mutex.
+        self._out_packet = collections.deque()
+        self._out_packet_bytes = 0
+        # Number of packets at the head of _out_packet taken by the writer, they are not dropped
+        self._out_packets_writing = 0
         self._last_msg_in = time.time()
         self._last_msg_out = time.time()
         self._last_mid = 0
         self._state = MQTTConnectionState.NEW
-        self._out_messages = []
-        self._in_messages = []
+        # In-flight messages keyed by packet id, in publishing order. Outgoing messages waiting for a free
+        # in-flight slot are also kept in _out_messages_queued, in the order they are going to be sent.
+        self._out_messages = collections.OrderedDict()
+        self._out_messages_queued = collections.deque()
+        self._in_messages = collections.OrderedDict()
         self._max_inflight_messages = 20
         self._inflight_messages = 0
 
@@ -207,6 +266,8 @@ class MockBroker(object):
         self.on_client_subscribe = None
         self.on_client_unsubscribe = None
         self.on_log = None
+        self._log_level = MQTT_LOG_DEBUG
+        self._log_mask = log_level_mask(MQTT_LOG_DEBUG)
 
         self._host = "localhost"
         self._port = 0
@@ -216,13 +277,35 @@ class MockBroker(object):
         self._callback_mutex = threading.RLock()
         self._state_mutex = threading.Lock()
         self._out_packet_mutex = threading.Lock()
-        self._current_out_packet_mutex = threading.Lock()
         self._msgtime_mutex = threading.Lock()
         self._out_message_mutex = threading.Lock()
         self._in_message_mutex = threading.Lock()
+        self._out_queue_space = threading.Condition(self._out_packet_mutex)
+        self._out_queue_waiters = 0
+        # Incremented under _out_packet_mutex whenever room is made in the outbound queue
+        self._out_queue_frees = 0
+        self._out_queue_max_messages = 0
+        self._out_queue_max_bytes = 0
+        self._out_queue_policy = OutQueuePolicy.BLOCK
+        self._out_queue_stats = self._out_queue_stats_new()
         self._thread = None
         self._thread_terminate = False
         self._mqtt_codec = None
+        self._read_chunk_size = 0
+        self._read_budget = 1000
+        self._packets_decoded = 0
+        self._packets_per_read = {}
+        self._retained_store = None
+        self._router = None
+        self._auto_ack = False
+        self._session_store = None
+        self._metrics = None
+        self._tracer = None
+        # Source of the trace events, the address of the client
+        self._trace_source = None
+        # The persistent session of the connected client, None with clean_session=True
+        self._session = None
+        self._session_present = False
 
         self._ssl = None
         self._tls_certfile = None
@@ -364,23 +447,24 @@ class MockBroker(object):
         if timeout < 0.0:
             raise ValueError('Invalid timeout.')
 
-        self._current_out_packet_mutex.acquire()
-        self._out_packet_mutex.acquire()
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
-
-        if self._current_out_packet:
+        if self._out_packet:
             wlist = [self.socket()]
         else:
             wlist = []
-        self._out_packet_mutex.release()
-        self._current_out_packet_mutex.release()
+
+        # Data already decrypted by the SSL object does not make the socket
+        # readable, so don't wait for it in select().
+        ssl_pending = self._ssl is not None and self._ssl.pending() > 0
+        if ssl_pending:
+            timeout = 0.0
 
         # sockpairR is used to break out of select() before the timeout, on a
         # call to publish() etc.
         rlist = [self.socket(), self._sockpairR]
         try:
             socklist = select.select(rlist, wlist, [], timeout)
+            if self._metrics is not None:
+                self._metrics.count("select_wakeups")
         except TypeError:
             # Socket isn't correct type, in likelihood connection is lost
             return MQTT_ERR_CONN_LOST
@@ -391,7 +475,7 @@ class MockBroker(object):
         except:
             return MQTT_ERR_UNKNOWN
 
-        if self.socket() in socklist[0]:
+        if ssl_pending or self.socket() in socklist[0]:
             rc = self.loop_read(max_packets)
             if rc or (self._ssl is None and self._sock is None):
                 return rc
@@ -400,6 +484,8 @@ class MockBroker(object):
             # Stimulate output write even though we didn't ask for it, because
             # at that point the publish or other command wasn't present.
             socklist[1].insert(0, self.socket())
+            if self._metrics is not None:
+                self._metrics.count("socketpair_wakeups")
             # Clear sockpairR - only ever a single byte written.
             try:
                 self._sockpairR.recv(1)
@@ -428,60 +514,48 @@ class MockBroker(object):
         payload you require.
         qos: The quality of service level to use.
         retain: If set to true, the message will be set as the "last known
-        good"/retained message for the topic.
+        good"/retained message for the topic. It is kept in the retained
+        store, if there is one (see retained_store_set()).
 
         Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS to
         indicate success or MQTT_ERR_NO_CONN if the client is not currently
         connected.  mid is the message ID for the publish request. The mid
         value can be used to track the publish request by checking against the
-        mid argument in the on_publish() callback if it is defined.
+        mid argument in the on_publish() callback if it is defined. If the
+        outbound queue of the client is full and the message is not queued
+        (see out_queue_limits_set()) or all the 65535 message IDs are used by
+        messages waiting for their acknowledgement, the result is
+        MQTT_ERR_QUEUE_SIZE and mid is 0.
 
         A ValueError will be raised if topic is None, has zero length or is
         invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
         the length of the payload is greater than 268435455 bytes."""
-        if topic is None or len(topic) == 0:
-            raise ValueError('Invalid topic.')
-        if qos<0 or qos>2:
-            raise ValueError('Invalid QoS level.')
-        if isinstance(payload, str) or isinstance(payload, bytearray):
-            local_payload = payload
-        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
-            local_payload = payload
-        elif isinstance(payload, int) or isinstance(payload, float):
-            local_payload = str(payload)
-        elif payload is None:
-            local_payload = None
-        else:
-            raise TypeError('payload must be a string, bytearray, int, float or None.')
+        local_payload = self._publish_arguments_check(topic, payload, qos)
 
-        if local_payload is not None and len(local_payload) > 268435455:
-            raise ValueError('Payload too large.')
+        if retain and self._retained_store is not None:
+            self._retained_store.store(topic, local_payload, qos)
 
-        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-            raise ValueError('Publish topic cannot contain wildcards.')
+        return self._publish(topic, local_payload, qos, retain)
+
+    def _publish(self, topic, local_payload, qos, retain):
+        # Sends a checked message without keeping it in the retained store, e.g. a retained message replayed to
+        # a new subscriber
+        rc = self._out_queue_admit(self._publish_length(topic, local_payload))
+        if rc != MQTT_ERR_SUCCESS:
+            return (rc, 0)
 
         local_mid = self._generate_msg_id()
+        if local_mid == 0:
+            return (MQTT_ERR_QUEUE_SIZE, 0)
 
         if qos == 0:
             rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False)
             return (rc, local_mid)
         else:
-            message = MQTTMessage()
-            message.timestamp = time.time()
-
-            message.mid = local_mid
-            message.topic = topic
-            if local_payload is None or len(local_payload) == 0:
-                message.payload = None
-            else:
-                message.payload = local_payload
-
-            message.qos = qos
-            message.retain = retain
-            message.dup = False
+            message = self._out_message_new(local_mid, topic, local_payload, qos, retain)
 
             self._out_message_mutex.acquire()
-            self._out_messages.append(message)
+            self._out_messages[message.mid] = message
             if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                 self._inflight_messages += 1
                 if qos == 1:
@@ -501,9 +575,130 @@ class MockBroker(object):
                 return (rc, local_mid)
             else:
                 message.state = mqtt_ms_queued
+                self._out_messages_queued.append(message)
                 self._out_message_mutex.release()
                 return (MQTT_ERR_SUCCESS, local_mid)
 
+    def publish_many(self, messages, coalesce=True):
+        """Publish a batch of messages.
+
+        messages: A sequence of (topic, payload, qos, retain) tuples with the
+        arguments of publish(), qos and retain may be left out.
+        coalesce: If set to true, the PUBLISH packets of the batch are encoded
+        into one contiguous buffer, which is queued at once and written with a
+        single send, so the client receives the packets back to back. If set to
+        false, publish() is called for every message.
+
+        Returns the list of the (result, mid) tuples of the messages, see
+        publish(). QoS>0 messages over the in-flight limit are queued and sent
+        one by one as the in-flight messages are acknowledged. The outbound
+        queue limits (see out_queue_limits_set()) count the buffer as a single
+        packet: the batch is admitted or refused as a whole, and
+        OutQueuePolicy.DROP_OLDEST_QOS0 drops it only if all its messages are
+        QoS 0.
+
+        A ValueError or TypeError is raised as by publish(), before anything
+        is queued."""
+        messages = [tuple(message) + (0, False)[len(message) - 2:] for message in messages]
+        if not coalesce or (self._sock is None and self._ssl is None):
+            return [self.publish(*message) for message in messages]
+
+        messages = [(topic, self._publish_arguments_check(topic, payload, qos), qos, retain)
+                    for topic, payload, qos, retain in messages]
+
+        rc = self._out_queue_admit(sum(self._publish_length(topic, payload)
+                                       for topic, payload, qos, retain in messages))
+        if rc != MQTT_ERR_SUCCESS:
+            return [(rc, 0)] * len(messages)
+
+        results = []
+        packets = []
+        inflight = []
+        batch_qos = 0
+        for topic, payload, qos, retain in messages:
+            if retain and self._retained_store is not None:
+                self._retained_store.store(topic, payload, qos)
+
+            mid = self._generate_msg_id()
+            if mid == 0:
+                results.append((MQTT_ERR_QUEUE_SIZE, 0))
+                continue
+            results.append((MQTT_ERR_SUCCESS, mid))
+
+            if qos > 0:
+                message = self._out_message_new(mid, topic, payload, qos, retain)
+                with self._out_message_mutex:
+                    self._out_messages[mid] = message
+                    if self._max_inflight_messages != 0 and self._inflight_messages >= self._max_inflight_messages:
+                        message.state = mqtt_ms_queued
+                        self._out_messages_queued.append(message)
+                        continue
+                    self._inflight_messages += 1
+                    message.state = mqtt_ms_wait_for_puback if qos == 1 else mqtt_ms_wait_for_pubrec
+                inflight.append(message)
+                batch_qos = max(batch_qos, qos)
+
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d0, q%s, r%s, m%s, '%s', ... (%s bytes)",
+                           qos, int(retain), mid, topic, len(payload) if payload is not None else 0)
+            packets.append((PUBLISH, mid, MQTTCodec.pack_publish(mid, topic, payload, qos, retain)))
+
+        if packets:
+            rc = self._mqtt_codec.acks_flush()
+            if rc == MQTT_ERR_SUCCESS:
+                rc = self._packets_queue(b"".join(packet for command, mid, packet in packets),
+                                         [(packet[0], mid, len(packet)) for command, mid, packet in packets],
+                                         batch_qos)
+            if rc != MQTT_ERR_SUCCESS:
+                # As in _publish(), the messages of the batch are sent again after a connection is made
+                with self._out_message_mutex:
+                    for message in inflight:
+                        self._inflight_messages -= 1
+                        message.state = mqtt_ms_publish
+                results = [(rc, mid) for result, mid in results]
+        return results
+
+    def _publish_arguments_check(self, topic, payload, qos):
+        # Returns the payload to send
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+        if qos<0 or qos>2:
+            raise ValueError('Invalid QoS level.')
+        if isinstance(payload, str) or isinstance(payload, bytearray) or isinstance(payload, bytes):
+            local_payload = payload
+        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
+            local_payload = payload
+        elif isinstance(payload, int) or isinstance(payload, float):
+            local_payload = str(payload)
+        elif payload is None:
+            local_payload = None
+        else:
+            raise TypeError('payload must be a string, bytes, bytearray, int, float or None.')
+
+        if local_payload is not None and len(local_payload) > 268435455:
+            raise ValueError('Payload too large.')
+
+        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        return local_payload
+
+    @staticmethod
+    def _out_message_new(mid, topic, payload, qos, retain):
+        message = MQTTMessage()
+        message.timestamp = time.time()
+
+        message.mid = mid
+        message.topic = topic
+        if payload is None or len(payload) == 0:
+            message.payload = None
+        else:
+            message.payload = payload
+
+        message.qos = qos
+        message.retain = retain
+        message.dup = False
+        return message
+
     def disconnect(self):
         """Disconnect the connected client from the broker."""
         self._easy_log(MQTT_LOG_DEBUG, "DISCONNECT the client")
@@ -528,6 +723,11 @@ class MockBroker(object):
         """Process read network events. Use in place of calling loop() if you
         wish to handle your client reads as part of your own application.
 
+        Packets are decoded until no more data is available on the socket or
+        the read budget set by read_budget_set() is used up. In buffered mode
+        the budget is checked between reads, not between the packets of a
+        read. max_packets is not currently used.
+
         Use socket() to obtain the client socket to call select() or equivalent
         on.
 
@@ -535,16 +735,23 @@ class MockBroker(object):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_messages) + len(self._in_messages)
-        if max_packets < 1:
-            max_packets = 1
-
-        for i in range(0, max_packets):
+        self._packets_decoded = 0
+        rc = MQTT_ERR_SUCCESS
+        while self._read_budget == 0 or self._packets_decoded < self._read_budget:
             rc = self._packet_read()
             if rc > 0:
-                return self._loop_rc_handle(rc)
+                break
             elif rc == MQTT_ERR_AGAIN:
-                return MQTT_ERR_SUCCESS
+                rc = MQTT_ERR_SUCCESS
+                break
+            if self._sock is None and self._ssl is None:
+                # The client has been disconnected by one of the packet handlers
+                break
+
+        self._packets_per_read[self._packets_decoded] = self._packets_per_read.get(self._packets_decoded, 0) + 1
+
+        if rc > 0:
+            return self._loop_rc_handle(rc)
         return MQTT_ERR_SUCCESS
 
     def loop_write(self, max_packets=1):
@@ -556,7 +763,9 @@ class MockBroker(object):
 
         Use want_write() to determine if there is data waiting to be written.
 
-        Do not use if you are using the threaded interface loop_start()."""
+        Do not use if you are using the threaded interface loop_start(). The
+        packets are written by a single thread at a time, don't call it from
+        several threads or together with publish() from another thread."""
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
@@ -576,7 +785,7 @@ class MockBroker(object):
         """Call to determine if there is network data waiting to be written.
         Useful if you are calling select() yourself rather than using loop().
         """
-        if self._current_out_packet or len(self._out_packet) > 0:
+        if self._out_packet:
             return True
         else:
             return False
@@ -597,6 +806,142 @@ class MockBroker(object):
             raise ValueError('Invalid inflight.')
         self._max_inflight_messages = inflight
 
+    def log_level_set(self, log_level):
+        """Set the least severe log level passed to on_log, one of MQTT_LOG_ERR,
+        MQTT_LOG_WARNING, MQTT_LOG_NOTICE, MQTT_LOG_INFO and MQTT_LOG_DEBUG.
+        Messages below the threshold are not even formatted. Defaults to
+        MQTT_LOG_DEBUG, every message is logged."""
+        self._log_mask = log_level_mask(log_level)
+        self._log_level = log_level
+        if self._mqtt_codec is not None:
+            self._mqtt_codec.log_level_set(log_level)
+
+    def read_chunk_size_set(self, chunk_size=MQTT_DECODER_CHUNK_SIZE):
+        """Switch the packet decoder of the next client connections to buffered mode.
+
+        In buffered mode the incoming data is read in chunks of chunk_size bytes
+        and all the complete packets of a chunk are processed at once, instead
+        of reading every packet with a few small recv() calls. The read budget
+        of read_budget_set() then counts the packets of whole chunks. Passing 0
+        turns the buffered mode off. It is off by default."""
+        if chunk_size < 0:
+            raise ValueError('Invalid chunk size.')
+        self._read_chunk_size = chunk_size
+
+    def retained_store_set(self, store):
+        """Keep the retained messages in store, a RetainedMessageStore.
+
+        The messages published with the retain flag, by the broker or by the
+        client, are stored and the matching ones are sent to the client after
+        the SUBACK of every subscription, at the lower of their QoS and the
+        granted QoS. None turns the retained messages off, which is the
+        default."""
+        self._retained_store = store
+
+    def auto_ack_set(self, enabled=True):
+        """Acknowledge the QoS>0 messages of the client as they arrive: PUBACK
+        for QoS 1, PUBREC for QoS 2. The PUBCOMP answers the PUBREL in both
+        modes. It is off by default, the tests acknowledge the messages from
+        on_message with send_puback(), so that they decide when and whether
+        the client gets its acknowledgement."""
+        self._auto_ack = enabled
+
+    def metrics_set(self, metrics):
+        """Update metrics, a BrokerMetrics, with the packets, bytes, timings and
+        wakeups of the broker and register its inflight_messages,
+        queued_messages and out_packets gauges. A metrics object may be shared
+        by several brokers. None turns the metrics off, which is the default.
+        Set it before the client connects."""
+        self._metrics = metrics
+        if self._mqtt_codec is not None:
+            self._mqtt_codec.metrics = metrics
+        if metrics is not None:
+            metrics.gauge_register("inflight_messages", lambda: self._inflight_messages)
+            metrics.gauge_register("queued_messages", lambda: len(self._out_messages_queued))
+            metrics.gauge_register("out_packets", lambda: len(self._out_packet))
+
+    def packet_tracer_set(self, tracer):
+        """Record the packets of the client in tracer, a PacketTracer: when
+        they are queued, written, decoded and handled. The events of the
+        client have its "host:port" address as source. A tracer may be shared
+        by several brokers. None turns the tracing off, which is the default.
+        Set it before the client connects."""
+        self._tracer = tracer
+
+    def out_queue_limits_set(self, max_messages=0, max_bytes=0, policy=OutQueuePolicy.BLOCK):
+        """Bound the outbound queue of the client.
+
+        max_messages limits the packets waiting to be written plus the QoS>0
+        messages waiting for a free in-flight slot, max_bytes limits the
+        length of the packets waiting to be written. 0 means no limit, which
+        is the default. When publish() finds the queue full, policy decides
+        what happens to the new message:
+
+        OutQueuePolicy.BLOCK: publish() waits until the client has read
+          enough. The network thread itself does not wait, from the callbacks
+          the message is queued over the limit.
+        OutQueuePolicy.DROP_OLDEST_QOS0: the oldest queued QoS 0 PUBLISH
+          packets are dropped to make room. If that is not enough, the new
+          message is dropped.
+        OutQueuePolicy.DROP_NEWEST: the new message is dropped.
+        OutQueuePolicy.DISCONNECT: the slow client is disconnected,
+          on_client_disconnect gets MQTT_ERR_QUEUE_SIZE.
+
+        Acknowledgements and other control packets are always queued. See
+        out_queue_stats() for how often the policy was applied."""
+        if max_messages < 0 or max_bytes < 0:
+            raise ValueError('Invalid out queue limit.')
+
+        self._out_queue_max_messages = max_messages
+        self._out_queue_max_bytes = max_bytes
+        self._out_queue_policy = policy
+
+    def out_queue_stats(self):
+        """Return a dictionary of how many times the full outbound queue made
+        publish() wait ("blocked"), dropped a queued QoS 0 packet
+        ("dropped_oldest"), dropped the new message ("dropped_newest") and
+        disconnected the client ("disconnected")."""
+        return self._out_queue_stats.snapshot()
+
+    def out_queue_stats_reset(self):
+        self._out_queue_stats.reset()
+
+    def session_store_set(self, store):
+        """Keep the sessions of the clients connecting with clean_session=False
+        in store, a SessionStore or SqliteSessionStore.
+
+        The subscriptions, the QoS 1 and 2 messages in flight or queued and
+        the message ids of the session are saved when the connection is
+        closed. When the client reconnects with clean_session=False, the
+        session is resumed: CONNACK has the session present flag set and the
+        unacknowledged messages are sent again after it. A client connecting
+        with clean_session=True discards its stored session. None turns the
+        sessions off, which is the default."""
+        self._session_store = store
+
+    def read_budget_set(self, max_packets):
+        """Set the maximum number of packets decoded on a single readable event
+        before the broker turns to its pending writes. 0 means no limit, the
+        broker decodes until no more data is available. Defaults to 1000.
+
+        In buffered mode (see read_chunk_size_set()) the budget is per read:
+        once it is used up no more chunk is read, but every complete packet of
+        the last chunk is still decoded, as the socket would not become
+        readable again for the packets left in the buffer. A readable event
+        may then decode up to the budget plus the packets of one chunk."""
+        if max_packets < 0:
+            raise ValueError('Invalid read budget.')
+        self._read_budget = max_packets
+
+    def packets_per_read(self):
+        """Return a dictionary that maps the number of packets decoded on a
+        single readable event to the number of such events."""
+        return dict(self._packets_per_read)
+
+    def packets_per_read_reset(self):
+        """Clear the statistics returned by packets_per_read()."""
+        self._packets_per_read = {}
+
     def socket(self):
         """Return the socket or ssl object for this client."""
         if self._ssl:
@@ -651,9 +996,17 @@ class MockBroker(object):
                         self._easy_log(MQTT_LOG_ERR, "Failed to wrap socket into SSL: " + str(ssl_err))
                         continue
 
-                self._mqtt_codec = MQTTCodec(self._sock, self._ssl)
+                # Reads are drained until EAGAIN, so the socket must not block. The
+                # TLS handshake above is done while it is still blocking.
+                self.socket().setblocking(0)
+
+                self._mqtt_codec = MQTTCodec(self._sock, self._ssl, self._read_chunk_size)
+                self._mqtt_codec.log_level_set(self._log_level)
                 self._mqtt_codec.on_packet_decoded = self._packet_handle
                 self._mqtt_codec.on_packet_encoded = self._packet_queue
+                self._mqtt_codec.on_packets_encoded = self._packets_queue
+                self._mqtt_codec.metrics = self._metrics
+                self._trace_source = "%s:%s" % client_address[:2]
 
                 self._easy_log(MQTT_LOG_INFO, "connection from " + str(client_address))
 
@@ -663,10 +1016,8 @@ class MockBroker(object):
                     # We don't need to worry about locking here, because we've
                     # either called loop_forever() when in single threaded mode, or
                     # in multi threaded mode when loop_stop() has been called and
-                    # so no other threads can access _current_out_packet,
-                    # _out_packet or _messages.
+                    # so no other threads can access _out_packet or _messages.
                     if (self._thread_terminate is True
-                        and self._current_out_packet is None
                         and len(self._out_packet) == 0
                         and len(self._out_messages) == 0):
 
@@ -838,21 +1189,51 @@ class MockBroker(object):
         return rc
 
     def _packet_write(self):
-        self._current_out_packet_mutex.acquire()
+        # Nothing serialises the writers: with a network thread only that thread writes, without one the
+        # thread calling publish(), loop_write() etc. does and the broker must not be used by several threads.
+        try:
+            return self._packet_write_queue()
+        finally:
+            # Only the packets of a write in progress are protected from the out queue policy, a partially
+            # written packet is recognised by its pos
+            self._out_packet_mutex.acquire()
+            self._out_packets_writing = 0
+            self._out_packet_mutex.release()
+
+    def _packet_write_queue(self):
+        # Writes the queued packets: a single sendmsg() call gathers all of them, with TLS they are
+        # joined into one buffer. Partial writes are tracked by the 'pos' offset of the packets, the
+        # unsent part is passed as a memoryview.
+        while True:
+            self._out_packet_mutex.acquire()
+            packets = list(itertools.islice(self._out_packet, MQTT_WRITE_MAX_PACKETS))
+            self._out_packets_writing = len(packets)
+            self._out_packet_mutex.release()
+            if not packets:
+                break
 
-        while self._current_out_packet:
-            packet = self._current_out_packet
+            buffers = [memoryview(packet.packet)[packet.pos:] for packet in packets]
 
             try:
                 if self._ssl:
-                    write_length = self._ssl.write(packet['packet'][packet['pos']:])
+                    if len(buffers) > 1:
+                        tls_buffers = [buffers[0]]
+                        tls_length = len(buffers[0])
+                        for buffer in buffers[1:]:
+                            tls_length += len(buffer)
+                            if tls_length > MQTT_WRITE_MAX_TLS_BYTES:
+                                break
+                            tls_buffers.append(buffer)
+                        write_length = self._ssl.write(b"".join(tls_buffers))
+                    else:
+                        write_length = self._ssl.write(buffers[0])
+                elif HAVE_SENDMSG:
+                    write_length = self._sock.sendmsg(buffers)
                 else:
-                    write_length = self._sock.send(packet['packet'][packet['pos']:])
+                    write_length = self._sock.send(buffers[0])
             except AttributeError:
-                self._current_out_packet_mutex.release()
                 return MQTT_ERR_SUCCESS
             except socket.error as err:
-                self._current_out_packet_mutex.release()
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
                 if err.errno == EAGAIN:
@@ -860,38 +1241,22 @@ class MockBroker(object):
                 self._easy_log(MQTT_LOG_ERR, "Failed to write packet! Error: " + str(err))
                 return 1
 
-            if write_length > 0:
-                packet['to_process'] = packet['to_process'] - write_length
-                packet['pos'] = packet['pos'] + write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        self._callback_mutex.acquire()
-                        if self.on_publish:
-                            self._in_callback = True
-                            self.on_publish(self, self._userdata, packet['mid'])
-                            self._in_callback = False
-                    #if (packet['command'] & 0xF0) == CONNACK:
-                    #    self._callback_mutex.acquire()
-                    #    if self.on_connack:
-                    #        self._in_callback = True
-                    #        self.on_connack(self)
-                    #        self._in_callback = False
-
-                        self._callback_mutex.release()
-
-                    self._out_packet_mutex.acquire()
-                    if len(self._out_packet) > 0:
-                        self._current_out_packet = self._out_packet.pop(0)
-                    else:
-                        self._current_out_packet = None
-                        if self._shutdown_after_last_packet_sent is True:
-                            self.trigger_shutdown(False)
-                    self._out_packet_mutex.release()
-            else:
-                pass  # FIXME
+            if write_length <= 0:
+                break  # FIXME
+
+            for packet in packets:
+                if write_length < packet.to_process:
+                    packet.to_process -= write_length
+                    packet.pos += write_length
+                    break
+
+                write_length -= packet.to_process
+                packet.pos += packet.to_process
+                packet.to_process = 0
+                self._packet_written(packet)
 
-        self._current_out_packet_mutex.release()
+                if write_length == 0:
+                    break
 
         self._msgtime_mutex.acquire()
         self._last_msg_out = time.time()
@@ -899,26 +1264,34 @@ class MockBroker(object):
 
         return MQTT_ERR_SUCCESS
 
-    def _easy_log(self, log_level, message):
-        if self.on_log:
+    def _easy_log(self, log_level, message, *args):
+        # The message is formatted with args only if it is going to be logged
+        if self.on_log and (log_level & self._log_mask):
+            if args:
+                message = message % args
             self.on_log(self, self._userdata, log_level, message)
 
+    def _log_enabled(self, log_level):
+        return self.on_log is not None and (log_level & self._log_mask) != 0
+
     def _generate_msg_id(self):
-        self._last_mid += 1
-        if self._last_mid == 65536:
-            self._last_mid = 1
-        return self._last_mid
+        # Skips the mids of the messages waiting for their acknowledgement, 0 if all of them are in use
+        with self._out_message_mutex:
+            mid = _mid_next(self._last_mid, self._out_messages)
+            if mid != 0:
+                self._last_mid = mid
+            return mid
 
     def send_pingresp(self):
         self._easy_log(MQTT_LOG_DEBUG, "Sending PINGRESP")
         return self._mqtt_codec.encode_pingresp()
 
     def send_puback(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: %s)", mid)
         return self._mqtt_codec.encode_puback(mid)
 
     def _send_pubcomp(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: %s)", mid)
         return self._mqtt_codec.encode_pubcomp(mid)
 
     def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
@@ -928,28 +1301,46 @@ class MockBroker(object):
         return self._mqtt_codec.encode_publish(mid, topic, payload, qos, retain, dup)
 
     def _send_pubrec(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %s)", mid)
         return self._mqtt_codec.encode_pubrec(mid)
 
     def _send_pubrel(self, mid, dup=False):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: %s)", mid)
         return self._mqtt_codec.encode_pubrel(mid, dup)
 
     def send_connack(self, connack_result_code):
-        return self._mqtt_codec.encode_connack(connack_result_code)
+        session_present = self._session_present and connack_result_code == CONNACK_ACCEPTED
+        rc = self._mqtt_codec.encode_connack(connack_result_code, session_present)
+        if session_present:
+            self._messages_resend()
+        return rc
 
     def send_suback(self, mid, topics_and_qos):
         self._mqtt_codec.encode_suback(mid, topics_and_qos)
+        if self._session is not None:
+            for sub, qos in topics_and_qos:
+                if qos <= 2:
+                    self._session.subscriptions[self._topic_str(sub)] = qos
+        if self._router is not None:
+            self._router.subscribe(self, topics_and_qos)
+        if self._retained_store is not None:
+            self._retained_messages_send(topics_and_qos)
         return MQTT_ERR_SUCCESS
 
     def send_unsuback(self, mid, topics):
         self._mqtt_codec.encode_unsuback(mid, topics)
+        if self._session is not None:
+            for sub in topics:
+                self._session.subscriptions.pop(self._topic_str(sub), None)
+        if self._router is not None:
+            self._router.unsubscribe(self, topics)
         return MQTT_ERR_SUCCESS
 
     def _messages_reconnect_reset_out(self):
         self._out_message_mutex.acquire()
         self._inflight_messages = 0
-        for m in self._out_messages:
+        self._out_messages_queued.clear()
+        for m in self._out_messages.values():
             m.timestamp = 0
             if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                 if m.qos == 0:
@@ -970,14 +1361,15 @@ class MockBroker(object):
                         m.state = mqtt_ms_publish
             else:
                 m.state = mqtt_ms_queued
+                self._out_messages_queued.append(m)
         self._out_message_mutex.release()
 
     def _messages_reconnect_reset_in(self):
         self._in_message_mutex.acquire()
-        for m in self._in_messages:
+        for mid, m in list(self._in_messages.items()):
             m.timestamp = 0
             if m.qos != 2:
-                self._in_messages.pop(self._in_messages.index(m))
+                del self._in_messages[mid]
             else:
                 # Preserve current state
                 pass
@@ -987,23 +1379,110 @@ class MockBroker(object):
         self._messages_reconnect_reset_out()
         self._messages_reconnect_reset_in()
 
+    def _messages_resend(self):
+        # Sends the messages of a resumed session after the CONNACK, the ones above the in-flight limit are
+        # queued. PUBRELs are always sent again, their messages were in flight already.
+        self._out_message_mutex.acquire()
+        now = time.time()
+        for m in self._out_messages.values():
+            if m.state == mqtt_ms_resend_pubrel:
+                m.timestamp = now
+                m.state = mqtt_ms_wait_for_pubcomp
+                self._inflight_messages += 1
+                self._send_pubrel(m.mid, True)
+            elif m.state == mqtt_ms_publish:
+                if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+                    m.timestamp = now
+                    m.state = mqtt_ms_wait_for_puback if m.qos == 1 else mqtt_ms_wait_for_pubrec
+                    self._inflight_messages += 1
+                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                else:
+                    m.state = mqtt_ms_queued
+                    self._out_messages_queued.append(m)
+        self._out_message_mutex.release()
+
+    def _packet_written(self, packet):
+        # The first packet of the queue is sent, QoS 0 PUBLISH is complete.
+        self._out_packet_mutex.acquire()
+        if self._out_packet and self._out_packet[0] is packet:
+            self._out_packet.popleft()
+            self._out_packet_bytes -= len(packet.packet)
+            if self._out_packets_writing > 0:
+                self._out_packets_writing -= 1
+            self._out_queue_frees += 1
+            if self._out_queue_waiters:
+                self._out_queue_space.notify_all()
+        queue_empty = not self._out_packet
+        self._out_packet_mutex.release()
+
+        if packet.batch is not None:
+            self._batch_written(packet)
+        else:
+            if self._tracer is not None:
+                self._tracer.packet_out(TRACE_WRITTEN, self._trace_source, packet.command, packet.mid)
+
+            if (packet.command & 0xF0) == PUBLISH and packet.qos == 0:
+                self._callback_mutex.acquire()
+                if self.on_publish:
+                    self._in_callback = True
+                    self.on_publish(self, self._userdata, packet.mid)
+                    self._in_callback = False
+                self._callback_mutex.release()
+
+        if queue_empty and self._shutdown_after_last_packet_sent is True:
+            self.trigger_shutdown(False)
+
+    def _batch_written(self, packet):
+        # A batch is sent, its QoS 0 PUBLISH packets are complete.
+        if self._tracer is not None:
+            self._tracer.packets_out(TRACE_WRITTEN, self._trace_source, packet.batch)
+
+        published_mids = [mid for command, mid, length in packet.batch
+                          if (command & 0xF0) == PUBLISH and command & 0x06 == 0]
+        if not published_mids:
+            return
+        self._callback_mutex.acquire()
+        if self.on_publish:
+            self._in_callback = True
+            for mid in published_mids:
+                self.on_publish(self, self._userdata, mid)
+            self._in_callback = False
+        self._callback_mutex.release()
+
+    def _packets_queue(self, packet, batch, qos):
+        # Queues several packets as one buffer, see _OutPacket. qos is the highest QoS among them.
+        if self._metrics is not None:
+            self._metrics.packets_out(batch)
+        if self._tracer is not None:
+            self._tracer.packets_out(TRACE_QUEUED, self._trace_source, batch)
+        command, mid, length = batch[0]
+        return self._out_packet_append(_OutPacket(command, mid, qos, packet, batch))
+
     def _packet_queue(self, command, packet, mid, qos):
-        mpkt = dict(
-            command = command,
-            mid = mid,
-            qos = qos,
-            pos = 0,
-            to_process = len(packet),
-            packet = packet)
+        if self._metrics is not None:
+            self._metrics.packet_out(command, packet)
+        if self._tracer is not None:
+            self._tracer.packet_out(TRACE_QUEUED, self._trace_source, command, mid)
+        return self._out_packet_append(_OutPacket(command, mid, qos, packet))
 
+    def _out_packet_append(self, out_packet):
         self._out_packet_mutex.acquire()
-        self._out_packet.append(mpkt)
-        if self._current_out_packet_mutex.acquire(False):
-            if self._current_out_packet is None and len(self._out_packet) > 0:
-                self._current_out_packet = self._out_packet.pop(0)
-            self._current_out_packet_mutex.release()
+        queue_was_empty = not self._out_packet
+        self._out_packet.append(out_packet)
+        self._out_packet_bytes += len(out_packet.packet)
         self._out_packet_mutex.release()
 
+        # The network loop waits for the socket to become writable while the queue is not empty, so it
+        # only has to be woken up when the first packet is queued.
+        if queue_was_empty:
+            self._wake_loop()
+
+        if not self._in_callback and self._thread is None:
+            return self.loop_write()
+        else:
+            return MQTT_ERR_SUCCESS
+
+    def _wake_loop(self):
         # Write a single byte to sockpairW (connected to sockpairR) to break
         # out of select() if in threaded mode.
         try:
@@ -1012,29 +1491,162 @@ class MockBroker(object):
             if err.errno != EAGAIN:
                 raise
 
-        if not self._in_callback and self._thread is None:
-            return self.loop_write()
-        else:
-            return MQTT_ERR_SUCCESS
-
     def show_queue(self):
         self._out_packet_mutex.acquire()
-        self._easy_log(MQTT_LOG_DEBUG, str(self._current_out_packet))
+        self._easy_log(MQTT_LOG_DEBUG, "%s", self._out_packet[0] if self._out_packet else None)
         self._out_packet_mutex.release()
 
     def empty_out_queues(self):
-        self._current_out_packet_mutex.acquire()
-        self._current_out_packet = None
-        self._current_out_packet_mutex.release()
+        self._out_packet_mutex.acquire()
+        self._out_packet.clear()
+        self._out_packet_bytes = 0
+        self._out_packets_writing = 0
+        self._out_queue_frees += 1
+        if self._out_queue_waiters:
+            self._out_queue_space.notify_all()
+        self._out_packet_mutex.release()
+
+    @staticmethod
+    def _out_queue_stats_new():
+        return _OutQueueStats()
+
+    @staticmethod
+    def _publish_length(topic, payload):
+        # Approximate length of a PUBLISH packet, counted against the byte limit of out_queue_limits_set()
+        return len(topic.encode('utf-8')) + len(MQTTCodec._publish_payload(payload)) + 7
+
+    def _out_queue_size(self):
+        # (messages, bytes) counted against the limits of out_queue_limits_set(). Takes _out_message_mutex and
+        # then _out_packet_mutex, the order of sending under _out_message_mutex, so neither may be held.
+        with self._out_message_mutex:
+            queued_messages = len(self._out_messages_queued)
+        with self._out_packet_mutex:
+            return len(self._out_packet) + queued_messages, self._out_packet_bytes
+
+    def _out_queue_excess(self, length):
+        # (messages, bytes) to free before a new message of length bytes fits, None if it fits. A message
+        # fits an empty queue whatever its length.
+        messages, queued_bytes = self._out_queue_size()
+        excess_messages = 0
+        excess_bytes = 0
+        if self._out_queue_max_messages > 0:
+            excess_messages = messages + 1 - self._out_queue_max_messages
+        if self._out_queue_max_bytes > 0 and messages > 0:
+            excess_bytes = queued_bytes + length - self._out_queue_max_bytes
+        if excess_messages <= 0 and excess_bytes <= 0:
+            return None
+        return excess_messages, excess_bytes
+
+    def _out_queue_admit(self, length):
+        # Applies the policy of the full outbound queue to a new PUBLISH of about length bytes. Returns
+        # MQTT_ERR_SUCCESS if the message may be queued.
+        if self._out_queue_max_messages == 0 and self._out_queue_max_bytes == 0:
+            return MQTT_ERR_SUCCESS
+        excess = self._out_queue_excess(length)
+        if excess is None:
+            return MQTT_ERR_SUCCESS
 
+        policy = self._out_queue_policy
+        if policy == OutQueuePolicy.BLOCK:
+            if self._thread is None or threading.current_thread() is self._thread:
+                # Nobody else is going to write the queue
+                return MQTT_ERR_SUCCESS
+            self._out_queue_stats.count("blocked")
+            with self._out_queue_space:
+                self._out_queue_waiters += 1
+            try:
+                while self._sock or self._ssl:
+                    with self._out_queue_space:
+                        frees = self._out_queue_frees
+                    if self._out_queue_excess(length) is None:
+                        break
+                    with self._out_queue_space:
+                        # The room made since the check is not waited for
+                        if frees == self._out_queue_frees:
+                            self._out_queue_space.wait(1.0)
+            finally:
+                with self._out_queue_space:
+                    self._out_queue_waiters -= 1
+            return MQTT_ERR_SUCCESS if self._sock or self._ssl else MQTT_ERR_NO_CONN
+
+        if policy == OutQueuePolicy.DROP_OLDEST_QOS0 and self._out_packet_drop_qos0(*excess):
+            return MQTT_ERR_SUCCESS
+
+        if policy == OutQueuePolicy.DISCONNECT:
+            self._slow_consumer_disconnect()
+            return MQTT_ERR_QUEUE_SIZE
+
+        self._out_queue_stats.count("dropped_newest")
+        return MQTT_ERR_QUEUE_SIZE
+
+    def _out_packet_drop_qos0(self, excess_messages, excess_bytes):
+        # Drops the oldest queued QoS 0 PUBLISH packets, if they free enough room. The packets taken by the
+        # writer and the partially written ones stay.
         self._out_packet_mutex.acquire()
-        self._out_packet = []
+        dropped = []
+        for index in range(self._out_packets_writing, len(self._out_packet)):
+            if excess_messages <= 0 and excess_bytes <= 0:
+                break
+            packet = self._out_packet[index]
+            if packet.pos == 0 and packet.qos == 0 and (packet.command & 0xF0) == PUBLISH:
+                dropped.append(index)
+                excess_messages -= 1
+                excess_bytes -= len(packet.packet)
+
+        if excess_messages > 0 or excess_bytes > 0:
+            self._out_packet_mutex.release()
+            return False
+
+        for index in reversed(dropped):
+            self._out_packet_bytes -= len(self._out_packet[index].packet)
+            del self._out_packet[index]
+        self._out_queue_frees += 1
+        self._out_queue_stats.count("dropped_oldest", len(dropped))
         self._out_packet_mutex.release()
+        return True
+
+    def _slow_consumer_disconnect(self):
+        messages, queued_bytes = self._out_queue_size()
+        self._easy_log(MQTT_LOG_WARNING, "Disconnecting slow client, %d messages and %d bytes queued",
+                       messages, queued_bytes)
+        self._out_queue_stats.count("disconnected")
+
+        self.empty_out_queues()
+        if self._sock is None and self._ssl is None:
+            return
+        self._close_client_socket()
+
+        self._callback_mutex.acquire()
+        if self.on_client_disconnect:
+            self._in_callback = True
+            self.on_client_disconnect(self, self._userdata, MQTT_ERR_QUEUE_SIZE)
+            self._in_callback = False
+        self._callback_mutex.release()
 
 
     def _packet_handle(self, decoded_packet):
+        if self._metrics is None and self._tracer is None:
+            return self._packet_dispatch(decoded_packet)
+
+        command = decoded_packet.command
+        remaining_length = decoded_packet.remaining_length
+        # The packet is only valid until this function returns
+        packet = decoded_packet.packet
+        if self._tracer is not None:
+            self._tracer.packet_in(TRACE_DECODED, self._trace_source, command, packet)
+        start = time.perf_counter()
+        rc = self._packet_dispatch(decoded_packet)
+        if self._metrics is not None:
+            self._metrics.packet_in(command, 1 + len(MQTTCodec._pack_remaining_length(remaining_length)) +
+                                    remaining_length, time.perf_counter() - start)
+        if self._tracer is not None:
+            self._tracer.packet_in(TRACE_HANDLED, self._trace_source, command, packet)
+        return rc
+
+    def _packet_dispatch(self, decoded_packet):
+        self._packets_decoded += 1
         self._decoded_packet = decoded_packet
-        cmd = self._decoded_packet['command']&0xF0
+        cmd = self._decoded_packet.command&0xF0
         if cmd == PINGREQ:
             return self._handle_pingreq()
         elif cmd == PUBACK:
@@ -1057,16 +1669,16 @@ class MockBroker(object):
             return self.disconnect()
         elif cmd == CONNACK  or cmd == SUBACK or \
              cmd == UNSUBACK or cmd == PINGRESP:
-            self._easy_log(MQTT_LOG_ERR, "Error: Broker received unexpected command " + str(cmd))
+            self._easy_log(MQTT_LOG_ERR, "Error: Broker received unexpected command %s", cmd)
             return MQTT_ERR_PROTOCOL
         else:
             # If we don't recognise the command, return an error straight away.
-            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command " + str(cmd))
+            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command %s", cmd)
             return MQTT_ERR_PROTOCOL
 
     def _handle_pingreq(self):
         if self._strict_protocol:
-            if self._decoded_packet['remaining_length'] != 0:
+            if self._decoded_packet.remaining_length != 0:
                 return MQTT_ERR_PROTOCOL
 
         self._easy_log(MQTT_LOG_DEBUG, "Received PINGREQ")
@@ -1075,9 +1687,10 @@ class MockBroker(object):
     def _handle_connect(self):
         self._easy_log(MQTT_LOG_DEBUG, "Received CONNECT")
 
-        connect_options = MQTTConnectOptions.from_mqtt_packet(self._decoded_packet['packet'])
+        connect_options = MQTTConnectOptions.from_mqtt_packet(self._decoded_packet.packet)
 
         self._keep_alive = connect_options.keep_alive
+        self._session_begin(connect_options)
 
         self._callback_mutex.acquire()
         if self.on_client_connect:
@@ -1092,11 +1705,11 @@ class MockBroker(object):
     def _handle_subscribe(self):
         self._easy_log(MQTT_LOG_DEBUG, "Received SUBSCRIBE")
 
-        header = self._decoded_packet['command']
+        header = self._decoded_packet.command
         dup = (header & 0x08)>>3
 
-        msg_id, topics_and_qos = MQTTCodec.decode_subscribe_packet(self._decoded_packet['packet'],
-                                                                   self._decoded_packet['remaining_length'])
+        msg_id, topics_and_qos = MQTTCodec.decode_subscribe_packet(self._decoded_packet.packet,
+                                                                   self._decoded_packet.remaining_length)
         self._callback_mutex.acquire()
         if self.on_client_subscribe:
             self._in_callback = True
@@ -1109,8 +1722,8 @@ class MockBroker(object):
 
     def _handle_unsubscribe(self):
         self._easy_log(MQTT_LOG_DEBUG, "Received SUBSCRIBE")
-        msg_id, topics = MQTTCodec.decode_unsubscribe_packet(self._decoded_packet['packet'],
-                                                             self._decoded_packet['remaining_length'])
+        msg_id, topics = MQTTCodec.decode_unsubscribe_packet(self._decoded_packet.packet,
+                                                             self._decoded_packet.remaining_length)
         self._callback_mutex.acquire()
         if self.on_client_unsubscribe:
             self._in_callback = True
@@ -1124,169 +1737,195 @@ class MockBroker(object):
     def _handle_publish(self):
         #self._easy_log(MQTT_LOG_DEBUG, "Received PUBLISH")
 
-        header = self._decoded_packet['command']
+        header = self._decoded_packet.command
         message = MQTTMessage()
         message.dup = (header & 0x08)>>3
         message.qos = (header & 0x06)>>1
         message.retain = (header & 0x01)
 
-        pack_format = "!H" + str(len(self._decoded_packet['packet'])-2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._decoded_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet)-slen) + 's'
-        (message.topic, packet) = struct.unpack(pack_format, packet)
+        (message.topic, message.mid, message.payload_view) = \
+            MQTTCodec.decode_publish_packet(self._decoded_packet.packet, message.qos)
 
-        if len(message.topic) == 0:
+        if not message.topic:
             return MQTT_ERR_PROTOCOL
 
         if sys.version_info[0] >= 3:
             message.topic = message.topic.decode('utf-8')
 
-        if message.qos > 0:
-            pack_format = "!H" + str(len(packet)-2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
-
-        message.payload = packet
-
-        self._easy_log(
-            MQTT_LOG_DEBUG,
-            "Received PUBLISH (d"+str(message.dup)+
-            ", q"+str(message.qos)+", r"+str(message.retain)+
-            ", m"+str(message.mid)+", '"+message.topic+
-            ", [ "+str(message.payload)+
-            " ] - "+str(len(message.payload))+" bytes")
+        if self._log_enabled(MQTT_LOG_DEBUG):
+            self._easy_log(
+                MQTT_LOG_DEBUG,
+                "Received PUBLISH (d"+str(message.dup)+
+                ", q"+str(message.qos)+", r"+str(message.retain)+
+                ", m"+str(message.mid)+", '"+message.topic+
+                ", [ "+str(message.payload)+
+                " ] - "+str(len(message.payload))+" bytes")
 
         message.timestamp = time.time()
+        if message.retain and self._retained_store is not None:
+            self._retained_store.store(message.topic, message.payload, message.qos)
+
         if message.qos == 0:
             self._handle_on_message(message)
+            self._message_route(message)
+            self._publish_payload_detach(message)
             return MQTT_ERR_SUCCESS
         elif message.qos == 1:
-            #rc = self.send_puback(message.mid)
-            rc = MQTT_ERR_SUCCESS
+            rc = self.send_puback(message.mid) if self._auto_ack else MQTT_ERR_SUCCESS
             self._handle_on_message(message)
+            self._message_route(message)
+            self._publish_payload_detach(message)
             return rc
         elif message.qos == 2:
-            #rc = self._send_pubrec(message.mid)
-            rc = MQTT_ERR_SUCCESS
+            rc = self._send_pubrec(message.mid) if self._auto_ack else MQTT_ERR_SUCCESS
+            self._publish_payload_detach(message)
             message.state = mqtt_ms_wait_for_pubrel
             self._in_message_mutex.acquire()
-            self._in_messages.append(message)
+            self._in_messages[message.mid] = message
+            self._in_message_stored(message)
             self._in_message_mutex.release()
             return rc
         else:
             return MQTT_ERR_PROTOCOL
 
+    def _in_message_stored(self, message):
+        # Called with _in_message_mutex held when a QoS 2 message is stored until its PUBREL
+        pass
+
     def _handle_pubrel(self):
         if self._strict_protocol:
-            if self._decoded_packet['remaining_length'] != 2:
+            if self._decoded_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        if len(self._decoded_packet['packet']) != 2:
+        if len(self._decoded_packet.packet) != 2:
             return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._decoded_packet['packet'])
+        mid = struct.unpack("!H", self._decoded_packet.packet)
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: %s)", mid)
 
         self._in_message_mutex.acquire()
-        for i in range(len(self._in_messages)):
-            if self._in_messages[i].mid == mid:
-
-                # Only pass the message on if we have removed it from the queue - this
-                # prevents multiple callbacks for the same message.
-                self._handle_on_message(self._in_messages[i])
-                self._in_messages.pop(i)
-                self._inflight_messages -= 1
-                if self._max_inflight_messages > 0:
-                    self._out_message_mutex.acquire()
-                    rc = self._update_inflight()
-                    self._out_message_mutex.release()
-                    if rc != MQTT_ERR_SUCCESS:
-                        self._in_message_mutex.release()
-                        return rc
+        message = self._in_messages.get(mid)
+        if message is not None:
+            # Only pass the message on if we have removed it from the queue - this
+            # prevents multiple callbacks for the same message.
+            self._handle_on_message(message)
+            self._message_route(message)
+            del self._in_messages[mid]
+            self._inflight_messages -= 1
+            if self._max_inflight_messages > 0:
+                self._out_message_mutex.acquire()
+                rc = self._update_inflight()
+                self._out_message_mutex.release()
+                if rc != MQTT_ERR_SUCCESS:
+                    self._in_message_mutex.release()
+                    return rc
 
-                self._in_message_mutex.release()
-                return self._send_pubcomp(mid)
+            self._in_message_mutex.release()
+            return self._send_pubcomp(mid)
 
         self._in_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _update_inflight(self):
         # Don't lock message_mutex here
-        for m in self._out_messages:
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages += 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    if rc != 0:
-                        return rc
-            else:
-                return MQTT_ERR_SUCCESS
+        while self._out_messages_queued and self._inflight_messages < self._max_inflight_messages:
+            m = self._out_messages_queued.popleft()
+            if m.qos > 0 and m.state == mqtt_ms_queued and self._out_messages.get(m.mid) is m:
+                self._inflight_messages += 1
+                if m.qos == 1:
+                    m.state = mqtt_ms_wait_for_puback
+                elif m.qos == 2:
+                    m.state = mqtt_ms_wait_for_pubrec
+                rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                if rc != 0:
+                    return rc
         return MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self):
         if self._strict_protocol:
-            if self._decoded_packet['remaining_length'] != 2:
+            if self._decoded_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._decoded_packet['packet'])
+        mid = struct.unpack("!H", self._decoded_packet.packet)
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: %s)", mid)
 
         self._out_message_mutex.acquire()
-        for m in self._out_messages:
-            if m.mid == mid:
-                m.state = mqtt_ms_wait_for_pubcomp
-                m.timestamp = time.time()
-                self._out_message_mutex.release()
-                return self._send_pubrel(mid, False)
+        m = self._out_messages.get(mid)
+        if m is not None:
+            m.state = mqtt_ms_wait_for_pubcomp
+            m.timestamp = time.time()
+            self._out_message_mutex.release()
+            return self._send_pubrel(mid, False)
 
         self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _handle_pubackcomp(self, cmd):
         if self._strict_protocol:
-            if self._decoded_packet['remaining_length'] != 2:
+            if self._decoded_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._decoded_packet['packet'])
+        mid = struct.unpack("!H", self._decoded_packet.packet)
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received "+cmd+" (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received %s (Mid: %s)", cmd, mid)
 
         self._out_message_mutex.acquire()
-        for i in range(len(self._out_messages)):
-            try:
-                if self._out_messages[i].mid == mid:
-                    # Only inform the client the message has been sent once.
-                    self._callback_mutex.acquire()
-                    if self.on_publish:
-                        self._out_message_mutex.release()
-                        self._in_callback = True
-                        self.on_publish(self, self._userdata, mid)
-                        self._in_callback = False
-                        self._out_message_mutex.acquire()
-
-                    self._callback_mutex.release()
-                    self._out_messages.pop(i)
-                    self._inflight_messages -= 1
-                    if self._max_inflight_messages > 0:
-                        rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            self._out_message_mutex.release()
-                            return rc
+        m = self._out_messages.pop(mid, None)
+        if m is not None:
+            # Only inform the client the message has been sent once.
+            self._callback_mutex.acquire()
+            if self.on_publish:
+                self._out_message_mutex.release()
+                self._in_callback = True
+                self.on_publish(self, self._userdata, mid)
+                self._in_callback = False
+                self._out_message_mutex.acquire()
+
+            self._callback_mutex.release()
+            self._inflight_messages -= 1
+            if self._max_inflight_messages > 0:
+                rc = self._update_inflight()
+                if rc != MQTT_ERR_SUCCESS:
                     self._out_message_mutex.release()
-                    return MQTT_ERR_SUCCESS
-            except IndexError:
-                # Have removed item so i>count.
-                # Not really an error.
-                pass
+                    return rc
 
         self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
+    def _retained_messages_send(self, topics_and_qos):
+        for sub, granted_qos in topics_and_qos:
+            if granted_qos > 2:
+                # Subscription refused
+                continue
+            for topic, payload, qos in self._retained_store.replay(self._topic_str(sub)):
+                self._publish(topic, payload, min(qos, granted_qos), True)
+
+    def _message_route(self, message):
+        if self._router is not None:
+            deliveries = self._router.route(message)
+            self._easy_log(MQTT_LOG_DEBUG, "Routed PUBLISH '%s' to %s subscribers", message.topic, deliveries)
+
+    def _publish_encoded(self, packet):
+        # Sends a QoS 0 PUBLISH packet of MQTTCodec.pack_publish(), which may be shared with other connections
+        if self._sock is None and self._ssl is None:
+            return MQTT_ERR_NO_CONN
+        rc = self._out_queue_admit(len(packet))
+        if rc != MQTT_ERR_SUCCESS:
+            return rc
+        mid = self._generate_msg_id()
+        if mid == 0:
+            return MQTT_ERR_QUEUE_SIZE
+        return self._mqtt_codec.send_encoded(PUBLISH, packet, mid, 0)
+
+    def _publish_payload_detach(self, message):
+        # The buffered decoder hands over packets as views into its read buffer, which is reused for the next
+        # packets. A message that outlives the packet handling must own its payload, the legacy decoder's
+        # packets are immutable bytes objects so their views can be kept.
+        if isinstance(self._decoded_packet.packet, memoryview):
+            message.payload_detach()
+
     def _handle_on_message(self, message):
         if self.on_message is not None:
             self._callback_mutex.acquire()
@@ -1306,18 +1945,86 @@ class MockBroker(object):
         if self._sock:
             self._sock.close()
             self._sock = None
+        with self._out_queue_space:
+            self._out_queue_frees += 1
+            if self._out_queue_waiters:
+                self._out_queue_space.notify_all()
+        self._session_end()
+
+    def _session_begin(self, connect_options):
+        self._session_present = False
+        if self._session_store is None:
+            return
+
+        client_id = self._topic_str(connect_options.client_id)
+        if self._router is not None:
+            # The messages routed to the client are not queued in its stored session anymore
+            self._router.session_remove(client_id)
+
+        if connect_options.connect_flags & CLEAN_SESSION_FLAG:
+            self._session_store.remove(client_id)
+            self._session = None
+            self._messages_restore(MQTTSession(client_id))
+            return
+
+        session = self._session_store.load(client_id)
+        if session is None:
+            session = MQTTSession(client_id)
+        else:
+            self._easy_log(MQTT_LOG_INFO, "Resuming the session of %s with %d messages", client_id,
+                           len(session.out_messages) + len(session.in_messages))
+            self._session_present = True
+        self._session = session
+        self._messages_restore(session)
+
+    def _messages_restore(self, session):
+        self._out_message_mutex.acquire()
+        self._out_messages = collections.OrderedDict(session.out_messages)
+        self._out_messages_queued.clear()
+        self._out_message_mutex.release()
+        self._in_message_mutex.acquire()
+        self._in_messages = collections.OrderedDict(session.in_messages)
+        self._in_message_mutex.release()
+        self._last_mid = session.last_mid
+        self._messages_reconnect_reset()
+
+        if self._router is not None and session.subscriptions:
+            self._router.subscribe(self, list(session.subscriptions.items()))
+
+    def _session_end(self):
+        # Saves the persistent session of the client, or drops its subscriptions
+        session = self._session
+        self._session = None
+        if session is None:
+            if self._router is not None:
+                self._router.connection_remove(self)
+            return
+
+        session.last_mid = self._last_mid
+        self._out_message_mutex.acquire()
+        session.out_messages = collections.OrderedDict(self._out_messages)
+        self._out_message_mutex.release()
+        self._in_message_mutex.acquire()
+        session.in_messages = collections.OrderedDict(self._in_messages)
+        self._in_message_mutex.release()
+        self._session_store.save(session)
+
+        if self._router is not None:
+            self._router.session_detach(self, session.client_id, self._session_store)
 
     def _close_server_socket(self):
-        # Make sure that we don't get stuck in the accept() state of the server socket
-        if self._server_socket != None:
+        # Make sure that we don't get stuck in the accept() state of the server socket. Both the network
+        # thread and trigger_shutdown() may get here, only one of them closes the socket.
+        server_socket = self._server_socket
+        self._server_socket = None
+        if server_socket != None:
             try:
-                self._server_socket.shutdown(socket.SHUT_RDWR)
+                server_socket.shutdown(socket.SHUT_RDWR)
             except OSError:
                 # This exception is thrown for example when the socket is not even connected.
                 # Anyway, we would still like to continue the shutdown process.
                 pass
-            self._server_socket.close()
-            self._server_socket = None
+            server_socket.close()
             self._port = 0
 
     def _network_shutdown(self):
@@ -1331,6 +2038,13 @@ class MockBroker(object):
             self._sockpairW.close()
             self._sockpairW = None
 
+    @staticmethod
+    def _topic_str(topic):
+        # Topics, filters and client IDs decoded from the packets are bytes
+        if isinstance(topic, bytes):
+            return topic.decode('utf-8')
+        return topic
+
     @staticmethod
     def _topic_wildcard_len_check(topic):
         # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
@@ -0,0 +1,509 @@
+"""
+This is an MQTT v3.1.1 mock broker that serves many client connections from a single thread. It waits for
+network events with the selectors module (epoll on Linux, kqueue on OSX).
+"""
+
+import errno
+import selectors
+import socket
+import threading
+
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec
+from tools.xi_mock_broker.mqtt_messages import MQTT_ERR_INVAL, MQTT_ERR_SUCCESS, MQTT_LOG_DEBUG, MQTT_LOG_ERR, \
+    MQTT_LOG_INFO, log_level_mask
+from tools.xi_mock_broker.xi_mock_broker import MockBroker, OutQueuePolicy, _socketpair_compat, EAGAIN, HAVE_SSL, \
+    cert_reqs, tls_version
+from tools.xi_mock_broker.xi_subscription_router import SubscriptionRouter
+
+if HAVE_SSL:
+    import ssl
+
+
+class _ServerCallback(object):
+    """Descriptor that forwards a MockBroker callback of a connection to the corresponding callback of the
+    server owning the connection, passing the connection handle as the first argument.
+
+    It reads None if the server callback is not set, so the default behaviour of MockBroker (e.g. automatic
+    CONNACK) is kept for unset callbacks."""
+
+    def __init__(self, name, has_broker_arg):
+        self._name = name
+        self._has_broker_arg = has_broker_arg
+
+    def __get__(self, connection, owner):
+        if connection is None:
+            return self
+
+        callback = getattr(connection._server, self._name)
+        if callback is None:
+            return None
+
+        if self._has_broker_arg:
+            return lambda broker, userdata, *args: self._invoke(callback, connection, userdata, *args)
+        else:
+            return lambda userdata, *args: self._invoke(callback, connection, userdata, *args)
+
+    def __set__(self, connection, value):
+        if value is not None:
+            raise AttributeError("Callbacks of a connection must be set on the broker.")
+
+    @staticmethod
+    def _invoke(callback, connection, userdata, *args):
+        return callback(connection, userdata, *args)
+
+
+class MockBrokerConnection(MockBroker):
+    """A single client connection of a MultiClientMockBroker.
+
+    The connection handle has the per connection state of a MockBroker: its own codec, out packet queue and
+    QoS message flows. It offers the same API to respond to the client, e.g. send_connack(), send_suback(),
+    publish() and disconnect(). Network I/O is done by the thread of the MultiClientMockBroker."""
+
+    on_client_connect = _ServerCallback("on_client_connect", False)
+    on_client_disconnect = _ServerCallback("on_client_disconnect", True)
+    on_publish = _ServerCallback("on_publish", True)
+    on_message = _ServerCallback("on_message", True)
+    on_client_subscribe = _ServerCallback("on_client_subscribe", False)
+    on_client_unsubscribe = _ServerCallback("on_client_unsubscribe", False)
+    on_log = _ServerCallback("on_log", True)
+
+    def __init__(self, server, sock, ssl_sock, client_address):
+        super(MockBrokerConnection, self).__init__(False)
+        self._server = server
+        self._userdata = server._userdata
+        self._sock = sock
+        self._ssl = ssl_sock
+        self.client_address = client_address
+        self._read_budget = server._read_budget
+        self._retained_store = server._retained_store
+        self._router = server._router
+        self._auto_ack = server._auto_ack
+        self._session_store = server._session_store
+        self._out_queue_max_messages = server._out_queue_max_messages
+        self._out_queue_max_bytes = server._out_queue_max_bytes
+        self._out_queue_policy = server._out_queue_policy
+        self._out_queue_stats = server._out_queue_stats
+        self._metrics = server._metrics
+        self._tracer = server._tracer
+        self._trace_source = "%s:%s" % client_address[:2]
+
+        # Connections are created by the network thread of the server and all their I/O is done there.
+        self._thread = threading.current_thread()
+
+        self._mqtt_codec = MQTTCodec(self._sock, self._ssl, server._read_chunk_size)
+        self._mqtt_codec.on_packet_decoded = self._packet_handle
+        self._mqtt_codec.on_packet_encoded = self._packet_queue
+        self._mqtt_codec.on_packets_encoded = self._packets_queue
+        self._mqtt_codec.metrics = self._metrics
+        self.log_level_set(server._log_level)
+
+    def __repr__(self):
+        return "MockBrokerConnection(%s:%s)" % self.client_address[:2]
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _wake_loop(self):
+        self._server._wake_connection(self)
+
+    def _close_client_socket(self):
+        if self._sock is not None:
+            self._server._connection_remove(self)
+        super(MockBrokerConnection, self)._close_client_socket()
+
+
+class MultiClientMockBroker(object):
+    """MQTT version 3.1/3.1.1 mock server that accepts any number of client connections.
+
+    Every accepted client gets a MockBrokerConnection. The callbacks are the same as the callbacks of
+    MockBroker, but they are set on the MultiClientMockBroker and their first argument is always the
+    connection handle of the client, instead of the broker:
+
+    on_client_connect(connection, userdata, connect_options)
+    on_client_disconnect(connection, userdata, rc)
+    on_message(connection, userdata, message)
+    on_publish(connection, userdata, msg_id)
+    on_client_subscribe(connection, userdata, msg_id, topics_and_qos, dup)
+    on_client_unsubscribe(connection, userdata, msg_id, topics)
+    on_log(connection, userdata, log_level, message): connection is the broker itself for messages that do
+      not belong to a client connection.
+
+    Respond to the client through the connection handle, e.g. connection.send_connack(CONNACK_ACCEPTED).
+
+    Websocket is not supported. The TLS handshake of a new client is done in blocking mode, with
+    MockBroker.MAX_CONNECT_TIMEOUT as timeout.
+    """
+
+    def __init__(self):
+        self._userdata = "[ MultiClientMockBroker ]"
+        self._host = "localhost"
+        self.bind_address = ""
+        self._server_socket = None
+        self._sockpairR, self._sockpairW = (None, None)
+        self._selector = None
+        self._connections = {}
+        self._wake_mutex = threading.Lock()
+        self._woken_connections = set()
+        self._ssl_pending = set()
+        self._thread = None
+        self._thread_terminate = False
+        self._read_chunk_size = 0
+        self._read_budget = 1000
+        self._retained_store = None
+        self._router = None
+        self._auto_ack = False
+        self._session_store = None
+        self._out_queue_max_messages = 0
+        self._out_queue_max_bytes = 0
+        self._out_queue_policy = OutQueuePolicy.BLOCK
+        # Shared by the connections
+        self._out_queue_stats = MockBroker._out_queue_stats_new()
+        self._metrics = None
+        self._tracer = None
+
+        self._tls_certfile = None
+        self._tls_keyfile = None
+        self._tls_ca_certs = None
+        self._tls_cert_reqs = None
+        self._tls_ciphers = None
+        self._tls_version = tls_version
+
+        self.on_client_connect = None
+        self.on_client_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+        self.on_client_subscribe = None
+        self.on_client_unsubscribe = None
+        self.on_log = None
+        self._log_level = MQTT_LOG_DEBUG
+        self._log_mask = log_level_mask(MQTT_LOG_DEBUG)
+
+    def setup_tls(self, certfile, keyfile=None, ca_certs=None, cert_reqs=cert_reqs, tls_version=tls_version, ciphers=None):
+        """Configure network encryption of the client connections. See MockBroker.setup_tls()."""
+        if HAVE_SSL is False:
+            raise ValueError('This platform has no SSL/TLS.')
+
+        if certfile is None:
+            raise ValueError('SSL cert file must not be None.')
+
+        self._tls_ca_certs = ca_certs
+        self._tls_certfile = certfile
+        self._tls_keyfile = keyfile
+        self._tls_cert_reqs = cert_reqs
+        self._tls_version = tls_version
+        self._tls_ciphers = ciphers
+
+    def read_chunk_size_set(self, chunk_size):
+        """Set the read chunk size of the packet decoder of new connections. See MockBroker.read_chunk_size_set()."""
+        if chunk_size < 0:
+            raise ValueError('Invalid chunk size.')
+        self._read_chunk_size = chunk_size
+
+    def read_budget_set(self, max_packets):
+        """Set the read budget of new connections. See MockBroker.read_budget_set()."""
+        if max_packets < 0:
+            raise ValueError('Invalid read budget.')
+        self._read_budget = max_packets
+
+    def retained_store_set(self, store):
+        """Set the retained message store of new connections, the connections share it. See
+        MockBroker.retained_store_set()."""
+        self._retained_store = store
+
+    def routing_set(self, enabled=True):
+        """Turn the routing mode on or off. It is off by default.
+
+        In routing mode the broker records the subscriptions of every connection
+        when their SUBACK is sent and removes them on UNSUBACK and disconnection.
+        The messages published by the clients are delivered to all the matching
+        subscribers after on_message, at the lower of the message QoS and the
+        granted QoS. Set it before the clients connect."""
+        self._router = SubscriptionRouter() if enabled else None
+
+    def auto_ack_set(self, enabled=True):
+        """Acknowledge the QoS>0 messages of new connections as they arrive. See MockBroker.auto_ack_set()."""
+        self._auto_ack = enabled
+
+    def metrics_set(self, metrics):
+        """Update metrics, a BrokerMetrics, with the packets, bytes, timings and
+        wakeups of all the connections. The inflight_messages, queued_messages
+        and out_packets gauges add up the connections, the connections gauge
+        is their number. See MockBroker.metrics_set(). Set it before the
+        clients connect."""
+        self._metrics = metrics
+        if metrics is not None:
+            metrics.gauge_register("connections", lambda: len(self._connections))
+            for name, function in (("inflight_messages", lambda c: c._inflight_messages),
+                                   ("queued_messages", lambda c: len(c._out_messages_queued)),
+                                   ("out_packets", lambda c: len(c._out_packet))):
+                metrics.gauge_register(name, lambda function=function: sum(
+                    function(connection) for connection in list(self._connections.values())))
+
+    def packet_tracer_set(self, tracer):
+        """Record the packets of all the connections in tracer, a
+        PacketTracer. See MockBroker.packet_tracer_set(). Set it before the
+        clients connect."""
+        self._tracer = tracer
+
+    def out_queue_limits_set(self, max_messages=0, max_bytes=0, policy=OutQueuePolicy.BLOCK):
+        """Set the outbound queue limits of new connections. See
+        MockBroker.out_queue_limits_set()."""
+        if max_messages < 0 or max_bytes < 0:
+            raise ValueError('Invalid out queue limit.')
+
+        self._out_queue_max_messages = max_messages
+        self._out_queue_max_bytes = max_bytes
+        self._out_queue_policy = policy
+
+    def out_queue_stats(self):
+        """Return the out queue counters of all the connections. See MockBroker.out_queue_stats()."""
+        return self._out_queue_stats.snapshot()
+
+    def out_queue_stats_reset(self):
+        self._out_queue_stats.reset()
+
+    def session_store_set(self, store):
+        """Set the session store of new connections, the connections share it. See
+        MockBroker.session_store_set().
+
+        In routing mode the subscriptions of a client with a persistent session
+        are kept while it is offline, the QoS 1 and 2 messages routed to it are
+        queued in its stored session and sent when it reconnects."""
+        self._session_store = store
+
+    def log_level_set(self, log_level):
+        """Set the least severe log level of the broker and of new connections. See MockBroker.log_level_set()."""
+        self._log_mask = log_level_mask(log_level)
+        self._log_level = log_level
+
+    def connections(self):
+        """Return the list of the currently connected clients."""
+        return list(self._connections.values())
+
+    def loop_start(self):
+        """Start listening and start a new thread to process the network traffic of all the clients."""
+        if self._thread is not None:
+            return MQTT_ERR_INVAL
+
+        self._network_setup()
+
+        self._thread_terminate = False
+        self._thread = threading.Thread(target=self.loop_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, timeout=None):
+        """Stop the network thread started by loop_start() and disconnect all the clients."""
+        if self._thread is None:
+            return MQTT_ERR_INVAL
+
+        self._thread_terminate = True
+        self._wake()
+        self._thread.join(timeout)
+        self._thread = None
+        return MQTT_ERR_SUCCESS
+
+    def loop_forever(self, timeout=1.0):
+        """Process network events until loop_stop() is called."""
+        if self._selector is None:
+            self._network_setup()
+
+        try:
+            while not self._thread_terminate:
+                self.loop(timeout)
+        finally:
+            self._network_shutdown()
+
+    def loop(self, timeout=1.0):
+        """Wait for network events once and process them."""
+        self._update_woken_connections()
+
+        # Data already decrypted by an SSL object does not make its socket readable
+        if self._ssl_pending:
+            timeout = 0.0
+
+        events = self._selector.select(timeout)
+        if self._metrics is not None:
+            self._metrics.count("select_wakeups")
+
+        readable = set(self._ssl_pending)
+        self._ssl_pending.clear()
+        for key, mask in events:
+            if key.data is None:
+                self._accept_connections()
+            elif key.data is self:
+                if self._metrics is not None:
+                    self._metrics.count("socketpair_wakeups")
+                self._drain_wakeup_socket()
+            elif mask & selectors.EVENT_READ:
+                readable.add(key.data)
+            if mask & selectors.EVENT_WRITE and key.data is not None and key.data is not self:
+                self._connection_write(key.data)
+
+        for connection in readable:
+            self._connection_read(connection)
+
+        return MQTT_ERR_SUCCESS
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _easy_log(self, log_level, message, *args):
+        if self.on_log and (log_level & self._log_mask):
+            if args:
+                message = message % args
+            self.on_log(self, self._userdata, log_level, message)
+
+    def _network_setup(self):
+        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_socket.bind((self._host, 0))
+        self._server_socket.listen(socket.SOMAXCONN)
+        self._server_socket.setblocking(0)
+        self.bind_address = (self._host, self._server_socket.getsockname()[1])
+
+        self._sockpairR, self._sockpairW = _socketpair_compat()
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server_socket, selectors.EVENT_READ, None)
+        self._selector.register(self._sockpairR, selectors.EVENT_READ, self)
+
+        self._easy_log(MQTT_LOG_INFO, "starting up MultiClientMockBroker on %s port %s" % self.bind_address)
+
+    def _network_shutdown(self):
+        for connection in self.connections():
+            connection._close_client_socket()
+
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+
+        for sock in (self._server_socket, self._sockpairR, self._sockpairW):
+            if sock is not None:
+                sock.close()
+        self._server_socket = None
+        self._sockpairR, self._sockpairW = (None, None)
+
+    def _accept_connections(self):
+        while True:
+            try:
+                sock, client_address = self._server_socket.accept()
+            except socket.error as err:
+                if err.errno != EAGAIN and err.errno != errno.EWOULDBLOCK:
+                    self._easy_log(MQTT_LOG_ERR, "Failed to accept connection: " + str(err))
+                return
+
+            ssl_sock = None
+            if self._tls_certfile is not None:
+                try:
+                    sock.settimeout(MockBroker.MAX_CONNECT_TIMEOUT)
+                    ssl_sock = ssl.wrap_socket(
+                        sock,
+                        certfile=self._tls_certfile,
+                        server_side=True,
+                        keyfile=self._tls_keyfile,
+                        ca_certs=self._tls_ca_certs,
+                        cert_reqs=self._tls_cert_reqs,
+                        ssl_version=self._tls_version,
+                        suppress_ragged_eofs=False,
+                        ciphers=self._tls_ciphers)
+                except (ssl.SSLError, ssl.CertificateError, socket.error) as ssl_err:
+                    self._easy_log(MQTT_LOG_ERR, "Failed to wrap socket into SSL: " + str(ssl_err))
+                    sock.close()
+                    continue
+                sock = ssl_sock
+
+            sock.setblocking(0)
+
+            connection = MockBrokerConnection(self, sock, ssl_sock, client_address)
+            self._connections[sock.fileno()] = connection
+            self._selector.register(sock, selectors.EVENT_READ, connection)
+
+            self._easy_log(MQTT_LOG_INFO, "connection from " + str(client_address))
+
+    def _connection_read(self, connection):
+        if connection.socket() is None:
+            return
+
+        connection.loop_read()
+
+        if connection.socket() is None:
+            return
+
+        if connection._ssl is not None and connection._ssl.pending() > 0:
+            self._ssl_pending.add(connection)
+
+        self._connection_update_interest(connection)
+
+    def _connection_write(self, connection):
+        if connection.socket() is None:
+            return
+
+        connection.loop_write()
+
+        if connection.socket() is not None:
+            self._connection_update_interest(connection)
+
+    def _connection_update_interest(self, connection):
+        events = selectors.EVENT_READ
+        if connection.want_write():
+            events |= selectors.EVENT_WRITE
+
+        try:
+            key = self._selector.get_key(connection.socket())
+        except (KeyError, ValueError):
+            return
+
+        if key.events != events:
+            self._selector.modify(connection.socket(), events, connection)
+
+    def _connection_remove(self, connection):
+        sock = connection.socket()
+        self._connections.pop(sock.fileno(), None)
+        self._ssl_pending.discard(connection)
+        if self._selector is not None:
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def _wake_connection(self, connection):
+        # Called when the first packet is queued on a connection. The write interest of the connection is updated by
+        # the network thread.
+        if threading.current_thread() is self._thread:
+            if connection.socket() is not None:
+                self._connection_update_interest(connection)
+            return
+
+        with self._wake_mutex:
+            self._woken_connections.add(connection)
+        self._wake()
+
+    def _update_woken_connections(self):
+        with self._wake_mutex:
+            woken_connections = self._woken_connections
+            self._woken_connections = set()
+
+        for connection in woken_connections:
+            if connection.socket() is not None:
+                self._connection_update_interest(connection)
+
+    def _wake(self):
+        try:
+            self._sockpairW.send(b"0")
+        except AttributeError:
+            # Not started yet or already shut down
+            pass
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
+
+    def _drain_wakeup_socket(self):
+        try:
+            while self._sockpairR.recv(4096):
+                pass
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
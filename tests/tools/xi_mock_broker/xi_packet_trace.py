@@ -0,0 +1,171 @@
+"""
+Per-packet latency tracing of the mock brokers, exported as Chrome trace event JSON.
+"""
+
+import itertools
+import json
+import time
+
+from tools.xi_mock_broker.mqtt_messages import COMMAND_NAMES, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, \
+    SUBACK, UNSUBSCRIBE, UNSUBACK
+
+# Packets that carry a message id in the first two bytes of their variable header
+_MID_COMMANDS = (PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK)
+
+# Events of the packets, in the order they happen to an outgoing and to an incoming packet
+TRACE_QUEUED = "queued"
+TRACE_WRITTEN = "written"
+TRACE_DECODED = "decoded"
+TRACE_HANDLED = "handled"
+
+
+def _decoded_mid(command, packet):
+    cmd = command & 0xF0
+    if cmd == PUBLISH:
+        if command & 0x06 == 0 or len(packet) < 2:
+            return 0
+        mid_pos = 2 + ((packet[0] << 8) | packet[1])
+        if len(packet) < mid_pos + 2:
+            return 0
+        return (packet[mid_pos] << 8) | packet[mid_pos + 1]
+    if cmd in _MID_COMMANDS and len(packet) >= 2:
+        return (packet[0] << 8) | packet[1]
+    return 0
+
+
+def _message_flow(event, command):
+    # A message is sent by the broker ("out") or by the client ("in"). The broker queues the PUBLISH and
+    # PUBREL of its own messages and decodes the acknowledgements of the client, everything else with a
+    # message id belongs to the messages of the client.
+    if event in (TRACE_QUEUED, TRACE_WRITTEN):
+        return "out" if (command & 0xF0) in (PUBLISH, PUBREL) else "in"
+    return "out" if (command & 0xF0) in (PUBACK, PUBREC, PUBCOMP) else "in"
+
+
+class PacketTracer(object):
+    """Records timestamped packet events of one or more brokers in a ring buffer.
+
+    The brokers record an event when a packet is queued by on_packet_encoded
+    (TRACE_QUEUED), when it is completely written to the socket
+    (TRACE_WRITTEN), when a received packet is decoded by on_packet_decoded
+    (TRACE_DECODED) and when its _handle_* method returns (TRACE_HANDLED).
+    The packets queued together, e.g. the acknowledgement batches of
+    MQTTCodec, are recorded per packet with packets_out(). mark() records
+    events of the other parts of a test, e.g. the control channel callbacks
+    of the client or an assertion.
+
+    An acknowledgement encoded while the broker handles a buffered read is
+    only queued with its batch, at the end of the read or before the next
+    other packet. Its TRACE_QUEUED event has the time of the batch, later
+    than the encoding by the handling time of the rest of the read.
+
+    Every event is a (timestamp, sequence, name, source, command, mid) tuple,
+    timestamp being a time.perf_counter() value and source the client address
+    of the connection. Recording takes no lock: the slot of an event comes
+    from an itertools.count(), whose next() is atomic. When the buffer is
+    full the oldest events are overwritten.
+
+    chrome_trace() groups the events of a message by source, direction and
+    mid, and returns them as Chrome trace event JSON for chrome://tracing or
+    Perfetto.
+    """
+
+    def __init__(self, capacity=65536):
+        if capacity <= 0:
+            raise ValueError('Invalid trace capacity.')
+        self._capacity = capacity
+        self.clear()
+
+    def clear(self):
+        """Drop the recorded events. Not safe while a broker is recording."""
+        self._events = [None] * self._capacity
+        self._sequence = itertools.count()
+        self._start = time.perf_counter()
+
+    def event(self, name, source, command=0, mid=0):
+        sequence = next(self._sequence)
+        self._events[sequence % self._capacity] = (time.perf_counter(), sequence, name, source, command, mid)
+
+    def mark(self, name, source="test", mid=0):
+        """Record an event that is not a broker packet, e.g. "on_message_received" of the control channel."""
+        self.event(name, source, 0, mid)
+
+    def packet_out(self, name, source, command, mid):
+        """Record an event of a packet encoded by MQTTCodec."""
+        self.event(name, source, command, mid)
+
+    def packets_out(self, name, source, batch):
+        """Record an event of the packets queued together, batch being their (command, mid, length) list."""
+        for command, mid, length in batch:
+            self.event(name, source, command, mid)
+
+    def packet_in(self, name, source, command, packet):
+        """Record an event of a packet decoded by MQTTCodec, packet being its variable header and payload."""
+        self.event(name, source, command, _decoded_mid(command, packet))
+
+    def events(self):
+        """Return the recorded events still in the buffer, oldest first."""
+        return sorted((event for event in list(self._events) if event is not None), key=lambda event: event[1])
+
+    def message_events(self, source, mid, flow="out"):
+        """Return the events of the packets with mid of the messages sent by the broker (flow "out") or by the
+        client (flow "in") of the connection source, oldest first."""
+        return [event for event in self.events() if event[3] == source and event[5] == mid and
+                event[4] != 0 and _message_flow(event[2], event[4]) == flow]
+
+    def chrome_trace(self):
+        """Return the events as a Chrome trace event dictionary.
+
+        Every source is a thread of the trace with an instant event per
+        recorded event. The packets with a message id also make an async
+        slice per message, from its first to its last recorded event. A slice
+        starts again when a PUBLISH without the DUP flag reuses the mid."""
+        trace_events = []
+        sources = {}
+        messages = {}
+
+        for timestamp, sequence, name, source, command, mid in self.events():
+            ts = (timestamp - self._start) * 1e6
+            tid = sources.get(source)
+            if tid is None:
+                tid = sources[source] = len(sources) + 1
+                trace_events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid,
+                                     "args": {"name": str(source)}})
+
+            command_name = COMMAND_NAMES.get(command & 0xF0, "") if command else ""
+            label = "%s %s" % (command_name, name) if command_name else name
+            trace_events.append({"name": label, "cat": "packet", "ph": "i", "s": "t", "ts": ts, "pid": 1,
+                                 "tid": tid, "args": {"mid": mid}})
+
+            if mid == 0 or command == 0:
+                continue
+            flow = _message_flow(name, command)
+            key = (source, flow, mid)
+            starts = (command & 0xF0) == PUBLISH and not command & 0x08 and \
+                name == (TRACE_QUEUED if flow == "out" else TRACE_DECODED)
+            message = messages.get(key)
+            if message is None or starts:
+                if message is not None:
+                    trace_events.append(self._message_end(message))
+                message = messages[key] = {"id": "%s %s %d #%d" % (source, flow, mid, sequence),
+                                           "name": "%s mid %d" % (flow, mid), "tid": tid, "last": ts}
+                trace_events.append({"name": message["name"], "cat": "message", "ph": "b", "id": message["id"],
+                                     "ts": ts, "pid": 1, "tid": tid})
+            message["last"] = ts
+            trace_events.append({"name": message["name"], "cat": "message", "ph": "n", "id": message["id"],
+                                 "ts": ts, "pid": 1, "tid": tid, "args": {"event": label}})
+
+        for message in messages.values():
+            trace_events.append(self._message_end(message))
+
+        return {"traceEvents": trace_events, "displayTimeUnit": "ns"}
+
+    def chrome_trace_dump(self, path):
+        """Write chrome_trace() to the file path as JSON."""
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+    @staticmethod
+    def _message_end(message):
+        return {"name": message["name"], "cat": "message", "ph": "e", "id": message["id"], "ts": message["last"],
+                "pid": 1, "tid": message["tid"]}
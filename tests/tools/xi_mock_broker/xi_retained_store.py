@@ -0,0 +1,132 @@
+"""
+Retained message store of the mock brokers.
+"""
+
+import threading
+
+from collections import OrderedDict
+from tools.xi_mock_broker.mqtt_messages import MQTTMessage
+from tools.xi_mock_broker.xi_topic_tree import TopicTree
+
+
+class RetainedMessageStore(object):
+    """The last retained message of every topic, indexed by a topic tree.
+
+    match() returns the messages whose topic matches a subscription filter, so a SUBSCRIBE costs the
+    number of matching topics rather than the number of stored ones. A store may be shared by several
+    brokers (e.g. the connections of a MultiClientMockBroker). It is thread safe.
+
+    If max_bytes is greater than zero, the least recently used messages are evicted once the total
+    length of the stored topics (UTF-8 encoded) and payloads exceeds max_bytes. Storing a message and replaying it to a
+    subscriber count as a use.
+
+    store() updates the stored MQTTMessage of a topic in place. replay() reads the topic, payload and QoS
+    of the matching messages under the lock, so a concurrent store() cannot tear them.
+    """
+
+    def __init__(self, max_bytes=0):
+        if max_bytes < 0:
+            raise ValueError('Invalid memory limit.')
+
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._topics = TopicTree()
+        # Topic -> (MQTTMessage, UTF-8 length of the topic), least recently used first
+        self._lru = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._lru)
+
+    @property
+    def size(self):
+        """Total length of the stored topics and payloads in bytes."""
+        return self._size
+
+    def store(self, topic, payload, qos=0):
+        """Set the retained message of topic. An empty or None payload removes the retained message of
+        topic, as MQTT requires."""
+        if payload is None or len(payload) == 0:
+            self.remove(topic)
+            return
+
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        else:
+            # Take a copy of mutable payloads, bytes are kept as they are
+            payload = bytes(payload)
+
+        with self._lock:
+            entry = self._lru.get(topic)
+            if entry is not None:
+                message = entry[0]
+                self._lru.move_to_end(topic)
+                self._size -= len(message._payload)
+            else:
+                message = MQTTMessage()
+                message.topic = topic
+                message.retain = True
+                topic_length = len(topic.encode('utf-8'))
+                self._lru[topic] = (message, topic_length)
+                self._topics.add(topic, message)
+                self._size += topic_length
+
+            message.payload = payload
+            message.qos = qos
+            self._size += len(payload)
+            self._evict()
+
+    def remove(self, topic):
+        """Remove the retained message of topic."""
+        with self._lock:
+            entry = self._lru.pop(topic, None)
+            if entry is not None:
+                message, topic_length = entry
+                self._topics.remove(topic)
+                self._size -= topic_length + len(message._payload)
+
+    def get(self, topic):
+        """Return the retained message of topic as an MQTTMessage, or None."""
+        with self._lock:
+            entry = self._lru.get(topic)
+            return entry[0] if entry is not None else None
+
+    def match(self, sub):
+        """Return the retained messages matched by the subscription filter sub, in the order their topics
+        were first stored."""
+        with self._lock:
+            messages = self._topics.match_filter(sub)
+            if self._max_bytes > 0:
+                for message in messages:
+                    self._lru.move_to_end(message.topic)
+            return messages
+
+    def replay(self, sub):
+        """Return the (topic, payload, qos) tuples of the retained messages matched by the subscription
+        filter sub, for sending them to a new subscriber."""
+        with self._lock:
+            messages = self._topics.match_filter(sub)
+            if self._max_bytes > 0:
+                for message in messages:
+                    self._lru.move_to_end(message.topic)
+            return [(message.topic, message._payload, message.qos) for message in messages]
+
+    def clear(self):
+        with self._lock:
+            self._topics.clear()
+            self._lru.clear()
+            self._size = 0
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _evict(self):
+        if self._max_bytes == 0:
+            return
+        while self._size > self._max_bytes and self._lru:
+            topic, (message, topic_length) = self._lru.popitem(last=False)
+            self._topics.remove(topic)
+            self._size -= topic_length + len(message._payload)
+            self.evicted += 1
@@ -0,0 +1,250 @@
+"""
+Session stores of the mock brokers for the clients connecting with clean_session=False.
+"""
+
+import collections
+import sqlite3
+import threading
+
+from tools.xi_mock_broker.mqtt_messages import MQTTMessage, mqtt_ms_publish
+
+
+def _mid_next(last_mid, mids_in_use):
+    # The packet id following last_mid that is not in mids_in_use, 0 if all of them are in use
+    mid = last_mid
+    for _ in range(65535):
+        mid = mid % 65535 + 1
+        if mid not in mids_in_use:
+            return mid
+    return 0
+
+
+class MQTTSession(object):
+    """The state of a client session that outlives the network connection.
+
+    Members:
+
+    client_id : String. The client ID of the session.
+    subscriptions : OrderedDict of subscription filter -> granted QoS.
+    out_messages : OrderedDict of packet id -> MQTTMessage, the QoS 1 and 2 messages sent or to be sent to the
+                   client, in publishing order.
+    in_messages : OrderedDict of packet id -> MQTTMessage, the QoS 2 messages received from the client and
+                  waiting for PUBREL.
+    last_mid : Integer. The last packet id used by the broker in this session.
+    """
+    __slots__ = ("client_id", "subscriptions", "out_messages", "in_messages", "last_mid")
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscriptions = collections.OrderedDict()
+        self.out_messages = collections.OrderedDict()
+        self.in_messages = collections.OrderedDict()
+        self.last_mid = 0
+
+    def message_queue(self, topic, payload, qos, retain=False):
+        """Append a message to be sent to the client when it reconnects. Returns the message, None if all the
+        packet ids are used by out_messages. A packet id still in out_messages is not given to another message."""
+        mid = _mid_next(self.last_mid, self.out_messages)
+        if mid == 0:
+            return None
+        self.last_mid = mid
+
+        message = MQTTMessage()
+        message.mid = self.last_mid
+        message.topic = topic
+        message.payload = payload
+        message.qos = qos
+        message.retain = retain
+        message.state = mqtt_ms_publish
+        self.out_messages[message.mid] = message
+        return message
+
+
+class SessionStore(object):
+    """Keeps the sessions of the clients in memory, keyed by client ID.
+
+    A broker saves the session of a client connected with clean_session=False when the connection is closed and
+    loads it back when the client reconnects. A store may be shared by several brokers (e.g. the connections of
+    a MultiClientMockBroker) and it is thread safe. The sessions are lost when the store is destroyed, see
+    SqliteSessionStore for sessions that survive a broker restart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def __contains__(self, client_id):
+        with self._lock:
+            return client_id in self._sessions
+
+    def load(self, client_id):
+        """Return the MQTTSession of client_id, None if there is none. The session stays in the store."""
+        with self._lock:
+            return self._sessions.get(client_id)
+
+    def save(self, session):
+        """Store session, replacing the previous session of its client."""
+        with self._lock:
+            self._sessions[session.client_id] = session
+
+    def remove(self, client_id):
+        """Remove the session of client_id, e.g. when it connects with clean_session=True."""
+        with self._lock:
+            self._sessions.pop(client_id, None)
+
+    def message_queue(self, client_id, topic, payload, qos, retain=False):
+        """Queue a message for the offline client client_id. Returns the packet id of the message, 0 if the
+        client has no session or all its packet ids are in use."""
+        with self._lock:
+            session = self._sessions.get(client_id)
+            if session is None:
+                return 0
+            message = session.message_queue(topic, payload, qos, retain)
+            return message.mid if message is not None else 0
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+class SqliteSessionStore(SessionStore):
+    """Keeps the sessions of the clients in an SQLite database, so they survive a broker restart.
+
+    path is the database file, ":memory:" keeps the database in memory. load() returns a new MQTTSession built
+    from the database, save() rewrites the rows of the session in a single transaction and message_queue()
+    only inserts the queued message.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            client_id TEXT PRIMARY KEY,
+            last_mid INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            client_id TEXT NOT NULL,
+            filter TEXT NOT NULL,
+            qos INTEGER NOT NULL,
+            PRIMARY KEY (client_id, filter));
+        CREATE TABLE IF NOT EXISTS messages (
+            client_id TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            mid INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            payload BLOB,
+            qos INTEGER NOT NULL,
+            retain INTEGER NOT NULL,
+            dup INTEGER NOT NULL,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (client_id, direction, mid));
+    """
+
+    def __init__(self, path):
+        super(SqliteSessionStore, self).__init__()
+        # The store is used by the network threads of the brokers and by the test thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self._SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def __contains__(self, client_id):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM sessions WHERE client_id = ?", (client_id,)).fetchone() is not None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def load(self, client_id):
+        with self._lock:
+            row = self._db.execute("SELECT last_mid FROM sessions WHERE client_id = ?", (client_id,)).fetchone()
+            if row is None:
+                return None
+
+            session = MQTTSession(client_id)
+            session.last_mid = row[0]
+            for sub, qos in self._db.execute(
+                    "SELECT filter, qos FROM subscriptions WHERE client_id = ? ORDER BY rowid", (client_id,)):
+                session.subscriptions[sub] = qos
+
+            for direction, mid, topic, payload, qos, retain, dup, state in self._db.execute(
+                    "SELECT direction, mid, topic, payload, qos, retain, dup, state FROM messages "
+                    "WHERE client_id = ? ORDER BY rowid", (client_id,)):
+                message = MQTTMessage()
+                message.mid = mid
+                message.topic = topic
+                message.payload = payload
+                message.qos = qos
+                message.retain = bool(retain)
+                message.dup = bool(dup)
+                message.state = state
+                messages = session.out_messages if direction == "out" else session.in_messages
+                messages[mid] = message
+            return session
+
+    def save(self, session):
+        client_id = session.client_id
+        with self._lock, self._db:
+            self._delete(client_id)
+            self._db.execute("INSERT INTO sessions VALUES (?, ?)", (client_id, session.last_mid))
+            self._db.executemany("INSERT INTO subscriptions VALUES (?, ?, ?)",
+                                 [(client_id, sub, qos) for sub, qos in session.subscriptions.items()])
+            self._db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [self._message_row(client_id, "out", m) for m in session.out_messages.values()] +
+                                 [self._message_row(client_id, "in", m) for m in session.in_messages.values()])
+
+    def remove(self, client_id):
+        with self._lock, self._db:
+            self._delete(client_id)
+
+    def message_queue(self, client_id, topic, payload, qos, retain=False):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT last_mid FROM sessions WHERE client_id = ?", (client_id,)).fetchone()
+            if row is None:
+                return 0
+
+            mids_in_use = set(mid for mid, in self._db.execute(
+                "SELECT mid FROM messages WHERE client_id = ? AND direction = 'out'", (client_id,)))
+            mid = _mid_next(row[0], mids_in_use)
+            if mid == 0:
+                return 0
+            message = MQTTMessage()
+            message.mid = mid
+            message.topic = topic
+            message.payload = payload
+            message.qos = qos
+            message.retain = retain
+            message.state = mqtt_ms_publish
+            self._db.execute("UPDATE sessions SET last_mid = ? WHERE client_id = ?", (mid, client_id))
+            self._db.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             self._message_row(client_id, "out", message))
+            return mid
+
+    def clear(self):
+        with self._lock, self._db:
+            for table in ("sessions", "subscriptions", "messages"):
+                self._db.execute("DELETE FROM " + table)
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _delete(self, client_id):
+        for table in ("sessions", "subscriptions", "messages"):
+            self._db.execute("DELETE FROM " + table + " WHERE client_id = ?", (client_id,))
+
+    @staticmethod
+    def _message_row(client_id, direction, message):
+        payload = message.payload
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is not None:
+            payload = bytes(payload)
+        return (client_id, direction, message.mid, message.topic, payload, message.qos, int(message.retain),
+                int(message.dup), message.state)
@@ -0,0 +1,162 @@
+"""
+Subscription table and PUBLISH fan-out of the mock brokers that serve many clients.
+"""
+
+import threading
+
+from tools.xi_mock_broker.mqtt_codec import MQTTCodec
+from tools.xi_mock_broker.xi_topic_tree import TopicTree
+
+
+class _OfflineSession(object):
+    """Stands in for the connection of a disconnected client that has a persistent session. The QoS 1 and 2
+    messages routed to it are queued in the session store, QoS 0 messages are dropped."""
+
+    def __init__(self, client_id, session_store):
+        self.client_id = client_id
+        self._session_store = session_store
+
+    def __repr__(self):
+        return "_OfflineSession(%s)" % self.client_id
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return 0, self._session_store.message_queue(self.client_id, topic, payload, qos, retain)
+
+    def _publish_encoded(self, packet):
+        return 0
+
+
+class SubscriptionRouter(object):
+    """Routes the messages published by the clients of a broker to the subscribed clients.
+
+    The subscription filters of all the connections are kept in a TopicTree, each filter maps the
+    subscribed connections to their granted QoS. route() delivers a message to every connection with a
+    matching subscription once, at the lower of the message QoS and the highest granted QoS of its
+    matching subscriptions. The QoS 0 deliveries share a single encoded PUBLISH packet, QoS 1 and 2
+    deliveries are published by the connections, since every session has its own message ids.
+
+    The connections are MockBroker instances. When a client with a persistent session disconnects, its
+    subscriptions are kept for an offline stand-in that queues the messages in the session store (see
+    session_detach()). The router is thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = TopicTree()
+        # Connection -> set of its subscription filters
+        self._connection_filters = {}
+        # Client ID -> _OfflineSession of the disconnected clients
+        self._offline_sessions = {}
+
+    def subscribe(self, connection, topics_and_qos):
+        """Add the (filter, granted QoS) pairs of a SUBACK to the subscriptions of connection. Refused
+        subscriptions (QoS 0x80) are ignored."""
+        with self._lock:
+            for sub, qos in topics_and_qos:
+                if qos > 2:
+                    continue
+                sub = self._filter_str(sub)
+                subscribers = self._subscriptions.get(sub)
+                if subscribers is None:
+                    subscribers = {}
+                    self._subscriptions.add(sub, subscribers)
+                subscribers[connection] = qos
+                self._connection_filters.setdefault(connection, set()).add(sub)
+
+    def unsubscribe(self, connection, topics):
+        """Remove the filters in topics from the subscriptions of connection."""
+        with self._lock:
+            filters = self._connection_filters.get(connection)
+            if filters is None:
+                return
+            for sub in topics:
+                sub = self._filter_str(sub)
+                if sub in filters:
+                    filters.discard(sub)
+                    self._subscriber_remove(sub, connection)
+            if not filters:
+                del self._connection_filters[connection]
+
+    def connection_remove(self, connection):
+        """Remove all the subscriptions of connection."""
+        with self._lock:
+            self._connection_remove(connection)
+
+    def session_detach(self, connection, client_id, session_store):
+        """Move the subscriptions of connection to the offline session of client_id. Until session_remove() is
+        called, the QoS 1 and 2 messages matching them are queued with session_store.message_queue()."""
+        offline = _OfflineSession(client_id, session_store)
+        with self._lock:
+            previous = self._offline_sessions.pop(client_id, None)
+            if previous is not None:
+                self._connection_remove(previous)
+            filters = self._connection_filters.pop(connection, set())
+            for sub in filters:
+                subscribers = self._subscriptions.get(sub)
+                subscribers[offline] = subscribers.pop(connection)
+            if filters:
+                self._connection_filters[offline] = filters
+                self._offline_sessions[client_id] = offline
+
+    def session_remove(self, client_id):
+        """Remove the subscriptions of the offline session of client_id, e.g. when the client reconnects."""
+        with self._lock:
+            offline = self._offline_sessions.pop(client_id, None)
+            if offline is not None:
+                self._connection_remove(offline)
+
+    def subscriptions(self, connection):
+        """Return the list of the subscription filters of connection."""
+        with self._lock:
+            return list(self._connection_filters.get(connection, ()))
+
+    def subscribers(self, topic):
+        """Return a dictionary that maps the connections subscribed to topic to their highest granted QoS."""
+        subscribers = {}
+        with self._lock:
+            for filter_subscribers in self._subscriptions.match(topic):
+                for connection, qos in filter_subscribers.items():
+                    if subscribers.get(connection, -1) < qos:
+                        subscribers[connection] = qos
+        return subscribers
+
+    def route(self, message):
+        """Publish message to every subscribed connection. Returns the number of deliveries."""
+        subscribers = self.subscribers(message.topic)
+        if not subscribers:
+            return 0
+
+        shared_packet = None
+        for connection, granted_qos in subscribers.items():
+            qos = min(message.qos, granted_qos)
+            if qos == 0:
+                if shared_packet is None:
+                    shared_packet = MQTTCodec.pack_publish(0, message.topic, message.payload_view)
+                connection._publish_encoded(shared_packet)
+            else:
+                connection.publish(message.topic, message.payload, qos)
+
+        return len(subscribers)
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    @staticmethod
+    def _filter_str(sub):
+        # Filters decoded from SUBSCRIBE and UNSUBSCRIBE packets are bytes
+        if isinstance(sub, bytes):
+            return sub.decode('utf-8')
+        return sub
+
+    def _connection_remove(self, connection):
+        for sub in self._connection_filters.pop(connection, ()):
+            self._subscriber_remove(sub, connection)
+
+    def _subscriber_remove(self, sub, connection):
+        subscribers = self._subscriptions.get(sub)
+        if subscribers is None:
+            return
+        subscribers.pop(connection, None)
+        if not subscribers:
+            self._subscriptions.remove(sub)
@@ -0,0 +1,114 @@
+"""
+Hashed timer wheel for the deadlines of the mock brokers, e.g. QoS retries and keep-alive expiry.
+"""
+
+import threading
+import time
+
+
+class TimerWheel(object):
+    """Deadlines of hashable keys, kept in the slots of a hashed timer wheel.
+
+    Time is divided into ticks of 'resolution' seconds and a deadline is stored in the slot of its tick,
+    modulo the number of slots. expire() only visits the slots of the ticks that passed since the previous
+    call, so its cost depends on the number of expired timers rather than on the number of pending ones.
+
+    A key has at most one deadline: schedule() replaces the previous deadline of the key and cancel()
+    removes it. Replaced and cancelled timers are left in their slots and dropped when their slot is
+    visited. The timer wheel is thread safe.
+    """
+
+    def __init__(self, resolution=1.0, slot_count=1024, now=None):
+        if resolution <= 0:
+            raise ValueError('Invalid resolution.')
+        if slot_count < 1:
+            raise ValueError('Invalid slot count.')
+
+        self._lock = threading.Lock()
+        self._resolution = resolution
+        self._slots = [[] for i in range(slot_count)]
+        self._deadlines = {}
+        # The tick of the first slot that has not been fully expired yet
+        self._next_tick = self._tick(time.time() if now is None else now)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def resolution_set(self, resolution):
+        """Set the length of a tick in seconds. The pending deadlines are kept."""
+        if resolution <= 0:
+            raise ValueError('Invalid resolution.')
+
+        with self._lock:
+            now = self._next_tick * self._resolution
+            self._resolution = resolution
+            self._next_tick = self._tick(now)
+            for slot in self._slots:
+                del slot[:]
+            for key, deadline in self._deadlines.items():
+                self._insert(key, deadline)
+
+    def schedule(self, key, deadline):
+        """Set the deadline of key to the 'deadline' timestamp, replacing its previous deadline."""
+        with self._lock:
+            self._deadlines[key] = deadline
+            self._insert(key, deadline)
+
+    def cancel(self, key):
+        """Remove the deadline of key. Does nothing if key has no deadline."""
+        with self._lock:
+            self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        """Return the deadline of key or None."""
+        with self._lock:
+            return self._deadlines.get(key)
+
+    def expire(self, now=None):
+        """Remove and return the list of keys whose deadline is not later than now, in no particular order."""
+        if now is None:
+            now = time.time()
+
+        expired = []
+        with self._lock:
+            current_tick = self._tick(now)
+            if current_tick < self._next_tick:
+                return expired
+
+            slot_count = len(self._slots)
+            for tick in range(self._next_tick, self._next_tick + min(current_tick - self._next_tick + 1, slot_count)):
+                slot = self._slots[tick % slot_count]
+                pending = []
+                for timer in slot:
+                    deadline, key = timer
+                    if self._deadlines.get(key) != deadline:
+                        # Replaced or cancelled
+                        continue
+                    if deadline <= now:
+                        del self._deadlines[key]
+                        expired.append(key)
+                    else:
+                        # Deadline of a later round of the wheel or later in the current tick
+                        pending.append(timer)
+                self._slots[tick % slot_count] = pending
+
+            # The slot of the current tick may get more expired timers, it is visited again next time
+            self._next_tick = current_tick
+
+        return expired
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _tick(self, timestamp):
+        return int(timestamp / self._resolution)
+
+    def _insert(self, key, deadline):
+        # Deadlines in the past go to the first slot that expire() is going to visit
+        tick = max(self._tick(deadline), self._next_tick)
+        self._slots[tick % len(self._slots)].append((deadline, key))
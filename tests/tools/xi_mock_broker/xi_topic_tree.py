@@ -0,0 +1,184 @@
+"""
+Topic tree index of MQTT subscription filters.
+"""
+
+from collections import OrderedDict
+
+
+class _TopicNode(object):
+    __slots__ = ('children', 'entry')
+
+    def __init__(self):
+        self.children = {}
+        # (sequence number, value) of the filter ending at this node or None
+        self.entry = None
+
+
+class TopicTree(object):
+    """Maps subscription filters to values and finds the values of the filters that match a topic.
+
+    The filters are stored in a tree of topic levels, so match() walks the levels of the topic once,
+    following the exact, '+' and '#' branches, instead of comparing the topic to every filter. The
+    wildcard rules are those of topic_matches_sub(): '+' matches a single level, '#' matches the remaining
+    levels including the parent level, and wildcards at the first level do not match topics starting
+    with '$'. Unlike topic_matches_sub(), 'a/#' also matches 'a/' as the MQTT specification requires.
+
+    Iterating the tree yields (filter, value) pairs in the order the filters were added.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._filters = OrderedDict()
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._filters)
+
+    def __iter__(self):
+        return iter(list(self._filters.items()))
+
+    def __contains__(self, sub):
+        return sub in self._filters
+
+    def get(self, sub, default=None):
+        """Return the value of the filter sub or default."""
+        return self._filters.get(sub, default)
+
+    def add(self, sub, value):
+        """Set the value of the filter sub. A filter that is already present keeps its position."""
+        node = self._root
+        for level in sub.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicNode()
+            node = child
+
+        if node.entry is None:
+            self._sequence += 1
+            node.entry = (self._sequence, value)
+        else:
+            node.entry = (node.entry[0], value)
+        self._filters[sub] = value
+
+    def remove(self, sub):
+        """Remove the filter sub and return its value, None if it is not present."""
+        if sub not in self._filters:
+            return None
+
+        path = [self._root]
+        for level in sub.split('/'):
+            path.append(path[-1].children[level])
+        path[-1].entry = None
+
+        # Prune the branch that has no more filters
+        levels = sub.split('/')
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.entry is not None or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+        return self._filters.pop(sub)
+
+    def clear(self):
+        self._root = _TopicNode()
+        self._filters.clear()
+
+    def match(self, topic):
+        """Return the values of the filters matching topic, in the order the filters were added."""
+        if not topic:
+            return []
+
+        entries = []
+        nodes = [self._root]
+        levels = topic.split('/')
+        dollar_topic = topic.startswith('$')
+
+        for i, level in enumerate(levels):
+            next_nodes = []
+            wildcards_allowed = i > 0 or not dollar_topic
+            for node in nodes:
+                children = node.children
+                if not children:
+                    continue
+                if wildcards_allowed:
+                    child = children.get('#')
+                    if child is not None and child.entry is not None:
+                        entries.append(child.entry)
+                    child = children.get('+')
+                    if child is not None:
+                        next_nodes.append(child)
+                if level != '+' and level != '#':
+                    child = children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        for node in nodes:
+            if node.entry is not None:
+                entries.append(node.entry)
+            # 'a/#' matches 'a' as well
+            child = node.children.get('#')
+            if child is not None and child.entry is not None:
+                entries.append(child.entry)
+
+        return self._entry_values(entries)
+
+    def match_filter(self, sub):
+        """Return the values of the keys matched by the subscription filter sub, in the order the keys were
+        added. This is the reverse of match(): the keys are topic names, e.g. those of retained messages,
+        and sub may contain wildcards."""
+        entries = []
+        nodes = [self._root]
+        levels = sub.split('/')
+
+        for i, level in enumerate(levels):
+            if level == '#':
+                # The parent level and everything below it
+                stack = []
+                for node in nodes:
+                    if node is not self._root and node.entry is not None:
+                        entries.append(node.entry)
+                    stack.extend(self._wildcard_children(node, i))
+                while stack:
+                    node = stack.pop()
+                    if node.entry is not None:
+                        entries.append(node.entry)
+                    stack.extend(node.children.values())
+                return self._entry_values(entries)
+
+            next_nodes = []
+            for node in nodes:
+                if level == '+':
+                    next_nodes.extend(self._wildcard_children(node, i))
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return []
+
+        for node in nodes:
+            if node.entry is not None:
+                entries.append(node.entry)
+        return self._entry_values(entries)
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    @staticmethod
+    def _wildcard_children(node, level_index):
+        # Wildcards at the first level do not match topics starting with '$'
+        if level_index > 0:
+            return node.children.values()
+        return [child for name, child in node.children.items() if not name.startswith('$')]
+
+    @staticmethod
+    def _entry_values(entries):
+        if len(entries) > 1:
+            entries.sort(key=lambda entry: entry[0])
+        return [entry[1] for entry in entries]